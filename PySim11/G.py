@@ -8,6 +8,34 @@ Global variables for PySim11
 # Otherwise, execution stops with an exception.
 UseSWI = 0
 
+# If set to 1, straight-line code is run from a cache of pre-decoded
+# basic blocks when not single-stepping or tracing (see blocks.py).
+UseBlockCache = 0
+
+# If set to 1, the 8-bit ALU helpers of ops.py are replaced by lookups in
+# precomputed tables (see alu.py).
+UseALUTables = 1
+
+# If set to 1, execution is recorded so that it can be run backwards (see
+# history.py). A checkpoint is taken every HistoryInterval cycles and the
+# last HistorySize checkpoints are kept.
+UseHistory = 0
+HistoryInterval = 20000
+HistorySize = 100
+
+# Number of instructions held by the binary instruction trace buffer (see
+# tracebuf.py), 24 bytes each.
+TraceCapacity = 1 << 20
+
+# When free-running (see SimState.freeRun()), the break event is only
+# checked once every this many instructions (or blocks, when the block
+# cache is used).
+BreakPollInterval = 1000
+
+# Seconds a batch job (see batch.py) may run before it is stopped and
+# reported as an error, unless its manifest entry gives a "timeout".
+BatchTimeout = 600
+
 # Indicate whether or not to use the various peripherals.
 Peripherals = {
   'Timer': [1, 'PySim11.pe_timer'],
@@ -7,22 +7,33 @@ PySim11VersionMinor = 5
 
 import sys
 import time
+import heapq
+import importlib
 
 from safestruct import *
 
 from PySim11.G import Peripherals
+import PySim11.G as G
 import PySim11.math11 as math11
 import PySim11.memory as memory
 import PySim11.state as state
 import PySim11.ints as ints
 import PySim11.ops as ops
 import PySim11.asm as asm
+import PySim11.blocks as blocks
+import PySim11.callgraph as callgraph
+import PySim11.coverage as coverage
+import PySim11.history as history
+import PySim11.profiler as profiler
+import PySim11.tracebuf as tracebuf
+import PySim11.watchpoints as watchpoints
 from PySim11.ops import IMM8, IMM16, EXT, DIR, INDX, INDY, INH, REL, BIT2DIR, BIT2INDX, BIT2INDY, BIT3DIR, BIT3INDX, BIT3INDY
 from PySim11.sysevents import SystemEvents
+from PySim11 import STOP_COUNT, STOP_BREAKPOINT, STOP_CYCLES, STOP_SWI, STOP_STOP, STOP_WAI, STOP_TEST, STOP_ILLEGAL, STOP_INTERRUPTED, STOP_ERROR, STOP_WATCHPOINT
 
 ################################################################################
 
-class ucBreakpoint(SafeStruct,Exception):
+class ucBreakpoint(SafeStruct):
   def __init__(self):
     super().__init__({
       'addr': 0xFFFF,
@@ -45,6 +56,85 @@ class ucBreakpoint(SafeStruct,Exception):
 
 ################################################################################
 
+# Bits of ucBreakpointList.map
+BP_BREAK   = 1    # There is a breakpoint at the address
+BP_VIRTUAL = 2    # There is a virtual function at the address
+
+# The breakpoints of a SimState, in the order they were added. Besides the
+# list, the 'map' bytearray flags every address execution must stop at
+# (where there is a breakpoint or a virtual function), so that checking
+# for a breakpoint takes the same time however many there are. Breakpoints
+# must therefore be added and removed through this class.
+class ucBreakpointList(SafeStruct):
+  def __init__(self):
+    super().__init__({
+      'list': [],               # The ucBreakpoint objects, in order
+      'byAddr': {},             # Indexed by address, the list of ucBreakpoint objects there
+      'map': bytearray(65536),  # BP_BREAK and BP_VIRTUAL bits for every address
+      'virtuals': frozenset(),  # Addresses flagged with BP_VIRTUAL
+      'touched': set(),         # Breakpoints whose count may have changed since restoreCounts()
+      'onAdd': None             # Called with an address when it becomes a stop
+    })
+
+  def __len__(self): return len(self.list)
+  def __iter__(self): return iter(self.list)
+  def __getitem__(self, index): return self.list[index]
+
+  def __delitem__(self, index): self.remove(self.list[index])
+
+  def stop(self, addr, bit):
+    old = self.map[addr]
+    self.map[addr] = old | bit
+    if not old and self.onAdd: self.onAdd(addr)
+
+  def append(self, br):
+    self.list.append(br)
+    try: self.byAddr[br.addr].append(br)
+    except KeyError: self.byAddr[br.addr] = [br]
+    self.stop(br.addr, BP_BREAK)
+
+  def remove(self, br):
+    self.list.remove(br)
+    self.touched.discard(br)
+    L = self.byAddr[br.addr]
+    L.remove(br)
+    if not L:
+      del self.byAddr[br.addr]
+      self.map[br.addr] &= ~BP_BREAK
+
+  def clear(self):
+    for addr in self.byAddr: self.map[addr] &= ~BP_BREAK
+    self.list = []
+    self.byAddr = {}
+    self.touched = set()
+
+  def setVirtuals(self, addrs):
+    # Flag the addresses of the virtual functions (which step() reads
+    # from SimState.VFlist before every run)
+    addrs = frozenset(addrs)
+    if addrs == self.virtuals: return
+    for addr in self.virtuals - addrs: self.map[addr] &= ~BP_VIRTUAL
+    for addr in addrs - self.virtuals: self.stop(addr, BP_VIRTUAL)
+    self.virtuals = addrs
+
+  def restoreCounts(self):
+    for br in self.touched: br.restoreCount()
+    self.touched = set()
+
+  def check(self, addr, simstate):
+    '''Count a hit of the breakpoints at 'addr'. Returns the first one that
+    stops execution (removing it if it is to be removed when hit), or
+    None.'''
+    stop = None
+    for br in list(self.byAddr.get(addr, ())):
+      self.touched.add(br)
+      if br.hit(simstate) and stop is None:
+        stop = br
+        if br.autoremove: self.remove(br)
+    return stop
+
+################################################################################
+
 class ucVirtualFunction(SafeStruct):
   def __init__(self, addr=0, func=None, text=""):
     super().__init__({
@@ -55,6 +145,13 @@ class ucVirtualFunction(SafeStruct):
 
 ################################################################################
 
+# A peripheral object is expected to have a sync() method that brings it
+# up to date with SimState.cycles and then posts the cycle of its next
+# event with SimState.schedule(). It may also have a rebaseCycles(delta)
+# method, called when SimState.cycles is reduced by 'delta' (see
+# SimState.resetCycles()) and snapshot()/restore(snap) methods, that return
+# its state as an immutable value and bring it back (rescheduling its next
+# event), for SimState.snapshot() and SimState.restore().
 class ucPeripheral(SafeStruct):
   def __init__(self, object, text=""):
     super().__init__({
@@ -64,6 +161,24 @@ class ucPeripheral(SafeStruct):
 
 ################################################################################
 
+# The state of a simulation as returned by SimState.snapshot(). Nothing in
+# it is ever modified, so a snapshot can be restored any number of times.
+class ucSnapshot(SafeStruct):
+  def __init__(self):
+    super().__init__({
+      'cycles': 0,
+      'registers': (),    # (PC, SP, X, Y, A, B, CC)
+      'regbase': 0x1000,
+      'pages': (),        # See ucMemory.snapshotPages()
+      'interrupts': (),   # (pending, ready, promoted, ccmask)
+      'peripherals': ()   # One (text, state) tuple per SimState.PElist entry
+    })
+
+################################################################################
+
+# Value of SimState.nextEvent when no peripheral event is scheduled
+NoEvent = 1 << 63
+
 class SimState(SafeStruct):
   def __init__(self, parentWindow=None, write=sys.stdout.write, breakEvent=None):
     super().__init__({
@@ -71,12 +186,24 @@ class SimState(SafeStruct):
       'ucMemory': None,
       'ucInterrupts': None,
       'ucEvents': None,
-      'BPlist': [],   # Breakpoint list, each entry is an object of ucBreakpoint class
+      'BPlist': None, # Breakpoint list, a ucBreakpointList of ucBreakpoint objects
       'VFlist': [],   # Virtual function list, each entry is ucVirtualFunction class
       'PElist': [],   # Peripheral hook list, each entry is a ucPeripheral object
       'mapfile': None, # symbol table and source code map, if present
       'BForce': 0,    # Allows forcing branch instructions in trace mode
       'cycles': 0,
+      'nextEvent': NoEvent, # Earliest cycle in eventQueue
+      'eventQueue': [], # Heap of (cycle, seqnum, peripheral object) tuples
+      'eventSeqs': {},  # Indexed by peripheral object, seqnum of its live entry in eventQueue
+      'eventSeq': 0,
+      'blockCache': None, # A blocks.BlockCache object when running from pre-decoded blocks
+      'snapPages': None,  # Memory pages of the last snapshot taken or restored
+      'history': None,    # A history.History object when recording execution
+      'tracer': None,     # A tracebuf.TraceBuffer object when tracing to a buffer
+      'profiler': None,   # A profiler.Profiler object when profiling
+      'callgraph': None,  # A callgraph.CallGraph object when accounting subroutine cycles
+      'coverage': None,   # A coverage.Coverage object when recording code coverage
+      'watchpoints': None, # A watchpoints.Watchpoints object
       'parent': parentWindow,
       'write': write,
       'breakEvent': breakEvent   # A threading.Event object used to notify step() it should stop
@@ -85,12 +212,18 @@ class SimState(SafeStruct):
     self.ucMemory = memory.ucMemory()
     self.ucInterrupts = ints.ucInterrupts()
     self.ucEvents = SystemEvents()
+    self.BPlist = ucBreakpointList()
+    self.BPlist.onAdd = self.stopAdded
+    self.watchpoints = watchpoints.Watchpoints(self)
+    self.ucMemory.addFilter(memory.ucMemoryFilter(self.ucMemory.HPRIO, self.ucMemory.HPRIO, None, None, self.ucInterrupts.writeHPRIO))
+    if G.UseBlockCache: self.enableBlockCache()
+    if G.UseHistory: self.enableHistory()
 
     for name, val in Peripherals.items():
       if val[0]:
         print(f'Installing {name} peripheral...')
-        exec(f'import {val[1]}')
-        exec(f'self.PElist.append({val[1]}.install(self, parentWindow))')
+        module = importlib.import_module(val[1])
+        self.PElist.append(module.install(self, parentWindow))
 
   def fetch8(self):
     PC = self.ucState.PC
@@ -151,8 +284,180 @@ class SimState(SafeStruct):
       return (addr, value, newpc, offset)
     else: raise ops.InternalError('Unknown instruction mode')
 
+  def enableBlockCache(self, enable=1):
+    if enable:
+      if self.blockCache is None: self.blockCache = blocks.BlockCache(self.ucMemory, self.BPlist.map)
+    elif self.blockCache is not None:
+      self.blockCache.flush()
+      self.ucMemory.CodeWriteHandler = None
+      self.blockCache = None
+
+  def stopAdded(self, addr):
+    # Cached blocks must not run past a new breakpoint or virtual function
+    if self.blockCache is not None: self.blockCache.invalidate(addr)
+
+  def enableHistory(self, enable=1, interval=None, size=None):
+    # Start or stop recording execution for reverse execution. Recording
+    # starts afresh if it was already on.
+    if self.history is not None:
+      self.history.close()
+      self.history = None
+    if enable: self.history = history.History(self, interval, size)
+
+  def enableTracer(self, enable=1, capacity=None, filename=None):
+    # Start or stop recording a binary instruction trace, to a new buffer
+    # (a memory-mapped file if 'filename' is given).
+    if self.tracer is not None:
+      self.tracer.close()
+      self.tracer = None
+    if enable: self.tracer = tracebuf.TraceBuffer(self, capacity, filename)
+    return self.tracer
+
+  def enableProfiler(self, enable=1):
+    # Start or stop profiling. The counts gathered so far are kept while
+    # profiling stays on.
+    if enable:
+      if self.profiler is None: self.profiler = profiler.Profiler(self)
+    elif self.profiler is not None:
+      self.profiler.close()
+      self.profiler = None
+    return self.profiler
+
+  def enableCallGraph(self, enable=1):
+    # Start or stop keeping a shadow call stack. The statistics gathered so
+    # far are kept while it stays on.
+    if enable:
+      if self.callgraph is None: self.callgraph = callgraph.CallGraph(self)
+    elif self.callgraph is not None:
+      self.callgraph.close()
+      self.callgraph = None
+    return self.callgraph
+
+  def enableCoverage(self, enable=1):
+    # Start or stop recording code coverage. The coverage recorded so far is
+    # kept while it stays on.
+    if enable:
+      if self.coverage is None: self.coverage = coverage.Coverage(self)
+    elif self.coverage is not None:
+      self.coverage.flush()
+      self.coverage = None
+    return self.coverage
+
+  def recorder(self):
+    # Return the function to call before every instruction to record it,
+    # or None if nothing is being recorded. A pending interrupt is taken
+    # there, between the hooks that see the state the last instruction left
+    # (the history, the branch outcomes of the coverage and the interrupt
+    # latencies of the call graph) and those that see the instruction about
+    # to execute, which is then the first one of the service routine.
+    before = []
+    if self.history is not None: before.append(self.history.record)
+    before += [obj.before for obj in (self.coverage, self.callgraph) if obj is not None]
+    after = [obj.record for obj in (self.coverage, self.callgraph, self.tracer, self.profiler) if obj is not None]
+    if not after: return before[0] if before else None
+
+    intr = self.ucInterrupts
+    interrupt = self.interrupt
+    def record():
+      for h in before: h()
+      if intr.ready: interrupt()
+      for h in after: h()
+    return record
+
+  def schedule(self, obj, cycle):
+    # Post 'cycle' as the next event of the peripheral object 'obj',
+    # replacing any earlier one. obj.sync() is called once self.cycles
+    # reaches that cycle. With 'cycle' None, the event is cancelled.
+    self.eventSeq += 1
+    if cycle is None:
+      self.eventSeqs.pop(obj, None)
+      return
+    self.eventSeqs[obj] = self.eventSeq
+    heapq.heappush(self.eventQueue, (cycle, self.eventSeq, obj))
+    if cycle < self.nextEvent: self.nextEvent = cycle
+
+  def runEvents(self):
+    queue = self.eventQueue
+    seqs = self.eventSeqs
+    while queue and queue[0][0] <= self.cycles:
+      cycle, seq, obj = heapq.heappop(queue)
+      if seqs.get(obj) == seq:    # Not superseded by a later schedule()
+        del seqs[obj]
+        obj.sync()
+    self.nextEvent = queue[0][0] if queue else NoEvent
+    # A watchpoint hit by the instruction just executed brings this forward
+    if self.watchpoints.hit is not None: self.watchpoints.stopIfHit()
+
+  def resetCycles(self):
+    # Set the cycle counter back to 0, rebasing pending peripheral events.
+    delta = self.cycles
+    self.cycles = 0
+    self.eventQueue = [(cycle-delta, seq, obj) for cycle, seq, obj in self.eventQueue]
+    if self.nextEvent != NoEvent: self.nextEvent -= delta
+    for periph in self.PElist:
+      if hasattr(periph.object, 'rebaseCycles'): periph.object.rebaseCycles(delta)
+    self.ucEvents.notifyEvent(self.ucEvents.CycReset)
+
+  def snapshot(self):
+    '''Return a ucSnapshot of the registers, memory, pending interrupts,
+    cycle count and peripheral state. Memory pages that haven't changed
+    since the previous snapshot (or restore) are shared with it, so taking
+    many snapshots of a running program is cheap.'''
+    st = self.ucState
+    intr = self.ucInterrupts
+    snap = ucSnapshot()
+    snap.cycles = self.cycles
+    snap.registers = (st.PC, st.SP, st.X, st.Y, st.A, st.B, st.CC)
+    snap.regbase = self.ucMemory.RegBase
+    snap.pages = self.snapPages = self.ucMemory.snapshotPages(self.snapPages)
+    snap.interrupts = (intr.pending, intr.ready, intr.promoted, intr.ccmask)
+    snap.peripherals = tuple((pe.text, pe.object.snapshot() if hasattr(pe.object, 'snapshot') else None)
+                             for pe in self.PElist)
+    return snap
+
+  def restore(self, snap):
+    '''Bring the simulation back to the state of a ucSnapshot taken from
+    this SimState, or from one with the same peripherals. Breakpoints,
+    virtual functions and the MAP file are left alone.'''
+    if [text for text, state in snap.peripherals] != [pe.text for pe in self.PElist]:
+      raise ValueError('Snapshot was taken with different peripherals')
+
+    st = self.ucState
+    PC, SP, X, Y, A, B, CC = snap.registers
+    st.setPC(PC)
+    st.setSP(SP)
+    st.setX(X)
+    st.setY(Y)
+    st.setA(A)
+    st.setB(B)
+    st.setCC(CC)
+
+    if self.ucMemory.RegBase != snap.regbase: self.ucMemory.mapRegisters(snap.regbase)
+    self.ucMemory.restorePages(snap.pages)
+    self.snapPages = snap.pages
+
+    intr = self.ucInterrupts
+    intr.pending, intr.ready, intr.promoted, intr.ccmask = snap.interrupts
+
+    # Restored peripherals post their next event again, the others keep theirs
+    self.cycles = snap.cycles
+    restored = [(pe.object, state) for pe, (text, state) in zip(self.PElist, snap.peripherals)
+                if state is not None]
+    objects = {obj for obj, state in restored}
+    self.eventQueue = [entry for entry in self.eventQueue if entry[2] not in objects]
+    heapq.heapify(self.eventQueue)
+    for obj in objects: self.eventSeqs.pop(obj, None)
+    self.nextEvent = self.eventQueue[0][0] if self.eventQueue else NoEvent
+    for obj, state in restored: obj.restore(state)
+
   def ifetch(self):
-    hipri = self.ucInterrupts.nextInt(self)
+    self.interrupt()
+    return self.ifetch_op()
+
+  def interrupt(self):
+    # Stack the registers and vector to the highest priority pending
+    # interrupt, if any.
+    hipri = self.ucInterrupts.ready
     if hipri:
       #print 'Interrupt', hipri, 'pending'
       self.ucState.push16(self.ucMemory, self.ucState.PC)
@@ -163,38 +468,99 @@ class SimState(SafeStruct):
       self.ucState.push8(self.ucMemory, self.ucState.CC)
       self.ucState.setI(state.CC_I)
       if hipri == ints.XIRQ: self.ucState.setXbit(state.CC_X)
+      self.ucInterrupts.setMask(self.ucState.CC)
 
       self.ucState.setPC(self.ucMemory.readUns16(ints.Vector[hipri]))
-    return self.ifetch_raw()
 
   def ifetch_raw(self):
-    opcode = self.fetch8()
-    if opcode in ops.PrebyteList: opcode = (opcode, self.fetch8())
-
-    try: instr, mode, cycles = ops.Ops[opcode]
-    except: raise ops.IllegalOperation
-
-    return (instr, mode, cycles)
-
-  def iexec(self, instr, mode, cycles, parms):
-    if mode == INH: exec(f'ops.{instr}(self)')
-
-    elif mode in [IMM8, IMM16, EXT, DIR, INDX, INDY]:
-      exec(f'ops.{instr}(self, parms[0], parms[1])')
-
-    elif mode == REL:
-      exec(f'ops.{instr}(self, parms[0])')
-
-    elif mode in [BIT2DIR, BIT2INDX, BIT2INDY]:
-      exec(f'ops.{instr}(self, parms[0], parms[1])')
-
-    elif mode in [BIT3DIR, BIT3INDX, BIT3INDY]:
-      exec(f'ops.{instr}(self, parms[0], parms[1], parms[2])')
-
-    else: raise ops.InternalError('Unknown instruction mode')
-
-    self.ucInterrupts.flush()
-    for periph in self.PElist: exec('periph.object.update(cycles)')
+    # Used for disassembly. Unlike ifetch_op(), bytes are fetched
+    # through the memory filters, like decode() does.
+    op = ops.OpTable[self.fetch8()]
+    if op.__class__ is list: op = op[self.fetch8()]
+    if op is None: raise ops.IllegalOperation
+    return op[:3]
+
+  def ifetch_op(self):
+    # Returns the ops.OpTable entry (instr, mode, cycles, handler, nargs, execute)
+    # of the instruction at the current PC and advances the PC past the opcode.
+    st = self.ucState
+    A = self.ucMemory.Array
+    PC = st.PC
+    op = ops.OpTable[A[PC]]
+    PC = PC+1 & 0xFFFF
+    if op.__class__ is list:
+      op = op[A[PC]]
+      PC = PC+1 & 0xFFFF
+    st.setPC(PC)
+    if op is None: raise ops.IllegalOperation
+    return op
+
+  def iexec(self, op, parms=None):
+    # With no decoded parameters, the instruction's specialized decoder
+    # fetches the operands and calls the handler itself.
+    if parms is None: op[5](self)
+    else: op[3](self, *parms[:op[4]])
+
+    if self.cycles >= self.nextEvent: self.runEvents()
+
+  def runBlock(self, cyclimit=0):
+    # Execute the cached basic block at the current PC, decoding it
+    # first if necessary. Stops early if an interrupt becomes pending, if
+    # the block is invalidated by a write or if the cycle limit is reached.
+    self.interrupt()
+    st = self.ucState
+    cache = self.blockCache
+    block = cache.get(st.PC)
+    if block is None:
+      self.ifetch_op()    # Raises IllegalOperation
+      return
+
+    generation = cache.generation
+    intr = self.ucInterrupts
+    for nextPC, cycles, run in block:
+      st.setPC(nextPC)
+      self.cycles += cycles
+      run(self)
+      if self.cycles >= self.nextEvent: self.runEvents()
+
+      if intr.ready: break
+      if cache.generation != generation: break
+      if cyclimit and self.cycles >= cyclimit: break
+
+  def freeRun(self, stops, cyclimit=0):
+    # Execute instructions until the PC reaches an address flagged in the
+    # 'stops' bytearray (the first instruction is always executed) or the
+    # cycle limit is reached. The break event is only polled every
+    # G.BreakPollInterval instructions (blocks with the block cache).
+    # Breakpoints that don't stop (e.g., whose condition is false or count
+    # hasn't run out) are counted here, so that a conditional breakpoint in
+    # a loop doesn't return to step() on every pass. Returns the breakpoint
+    # that stopped execution, if any.
+    st = self.ucState
+    check = self.BPlist.check
+    breakEvent = self.breakEvent
+    # Recording needs to see every instruction, so it doesn't use blocks
+    record = self.recorder()
+    runBlock = self.runBlock if self.blockCache is not None and not record else None
+    poll = n = G.BreakPollInterval
+    while 1:
+      if runBlock: runBlock(cyclimit)
+      else:
+        if record: record()
+        op = self.ifetch()
+        self.cycles += op[2]
+        self.iexec(op)
+
+      if cyclimit and self.cycles >= cyclimit: return None
+      n -= 1
+      if n <= 0:
+        if breakEvent and not breakEvent.isSet(): return None
+        n = poll
+      stop = stops[st.PC]
+      if stop:
+        if stop != BP_BREAK: return None
+        br = check(st.PC, self)
+        if br is not None: return br
 
   def printCurrentInstruction(self, instr, mode, parms, PC):
     if self.mapfile:
@@ -218,8 +584,9 @@ class SimState(SafeStruct):
     self.ucState.setPC(oldPC)
 
   def step(self, count = 0, trace = 0, cyclimit = 0, branchForce = 0):
+    # Returns one of the STOP_xxx constants of the PySim11 package
     done = 0
-    breakaddrs = {}
+    status = STOP_COUNT
     virtsubs = {}
 
     # We don't want to hit a breakpoint on the first instruction
@@ -228,15 +595,22 @@ class SimState(SafeStruct):
 
     # Notify subscribers that a simulation is to begin.
     self.ucEvents.notifyEvent(self.ucEvents.SimStart)
+    self.ucInterrupts.refresh(self)
+    if self.history is not None: self.history.begin(branchForce)
 
     start_clock = time.process_time()
     start_cyc = self.cycles
 
-    for br in self.BPlist:
-      br.restoreCount()
-      breakaddrs[br.addr] = br
-
+    breakpoints = self.BPlist
+    breakpoints.restoreCounts()
     for vs in self.VFlist: virtsubs[vs.addr] = vs.func
+    breakpoints.setVirtuals(virtsubs)
+    stops = breakpoints.map
+
+    # With no per-instruction work to do, run with freeRun() until one of
+    # the breakpoint or virtual function addresses is reached.
+    freeRun = not (count or trace or branchForce)
+    if not freeRun: record = self.recorder()
 
     cycthresh = None
     if cyclimit > 0: cycthresh = self.cycles + cyclimit
@@ -250,6 +624,7 @@ class SimState(SafeStruct):
           if detail: self.write(str(detail)+'\n')
           self.write('\n')
           done = 1
+          status = STOP_ERROR
           raise
         newPC = self.ucState.pull16(self.ucMemory)
         self.ucState.setPC(newPC)
@@ -262,56 +637,77 @@ class SimState(SafeStruct):
       if firstInstruction: self.BForce = branchForce
 
       try:
-        try: br = breakaddrs[PC]
-        except: br = None
-        if br and not firstInstruction and br.hit(self):
-          if br.autoremove: self.BPlist.remove(br)
-          raise br
+        br = None
+        if stops[PC] & BP_BREAK and not firstInstruction: br = breakpoints.check(PC, self)
         firstInstruction = 0
 
-        instr, mode, cycles = self.ifetch()
-
-        parms = self.decode(mode)
-        if trace: self.printCurrentInstruction(instr, mode, parms, PC)
-
-        # Updating self.cycles *prior* to execution is counted
-        # upon by peripheral modules.
-        self.cycles += cycles
-        try: self.iexec(instr, mode, cycles, parms)
-        except:
-          if trace: self.write('\n')
-          raise
-        if trace:
-          self.ucState.display(self.write)
-          self.write('\n')
-          self.printNextInstruction()
+        if br is None and freeRun: br = self.freeRun(stops, cyclimit)
 
-      except ucBreakpoint as br:
-        if br.text: self.write(br.text+'\n\n')
+        if br is not None:
+          if br.text: self.write(br.text+'\n\n')
+          status = STOP_BREAKPOINT
+          done = 1
+        elif not freeRun:
+          if record: record()
+          op = self.ifetch()
+
+          parms = None
+          if trace:
+            parms = self.decode(op[1])
+            self.printCurrentInstruction(op[0], op[1], parms, PC)
+
+          # Updating self.cycles *prior* to execution is counted
+          # upon by peripheral modules.
+          self.cycles += op[2]
+          try: self.iexec(op, parms)
+          except:
+            if trace: self.write('\n')
+            raise
+          if trace:
+            self.ucState.display(self.write)
+            self.write('\n')
+            self.printNextInstruction()
+
+      except watchpoints.WatchpointHit as detail:
+        self.write(str(detail)+'\n\n')
+        status = STOP_WATCHPOINT
         done = 1
       except ops.SWIInstruction:
         self.write('SWI instruction encountered\n\n')
+        status = STOP_SWI
         done = 1
       except ops.StopInstruction:
         self.write('STOP instruction encountered\n\n')
+        status = STOP_STOP
         done = 1
       except ops.WaitInstruction:
         self.write('WAI instruction encountered\n\n')
+        status = STOP_WAI
         done = 1
       except ops.TestInstruction:
         self.write('TEST instruction encountered\n\n')
+        status = STOP_TEST
         done = 1
       except ops.IllegalOperation:
         self.write('Illegal instruction encountered\n\n')
+        status = STOP_ILLEGAL
         done = 1
       except KeyboardInterrupt:
         self.write('Execution interrupted\n\n')
+        status = STOP_INTERRUPTED
         done = 1
       except Exception as detail:
         if detail: self.write(str(detail)+'\n\n')
+        status = STOP_ERROR
         done = 1
       # end try
 
+      # Peripherals still see the cycles of an instruction that stopped
+      # execution.
+      if done:
+        self.watchpoints.hit = None
+        if self.cycles >= self.nextEvent: self.runEvents()
+
       # Branch force only works in trace mode for the first instruction
       self.BForce = 0
 
@@ -321,14 +717,22 @@ class SimState(SafeStruct):
       if not done and cyclimit:
         if self.cycles >= cyclimit:
           done = 1
+          status = STOP_CYCLES
           self.write('Cycle limit exceeded\n')
 
       if self.breakEvent:
         if not self.breakEvent.isSet():
           done = 1
+          status = STOP_INTERRUPTED
           self.breakEvent.set()
     # end while
 
+    if self.history is not None: self.history.end()
+    if self.tracer is not None: self.tracer.flush()
+    if self.profiler is not None: self.profiler.flush()
+    if self.coverage is not None: self.coverage.flush()
+    if self.callgraph is not None: self.callgraph.flush()
+
     # Notify subscribers that a simulation ended
     self.ucEvents.notifyEvent(self.ucEvents.SimEnd)
 
@@ -338,3 +742,5 @@ class SimState(SafeStruct):
     # Uncomment the following to see how fast the simulator is
     #print (stop_clock-start_clock), 'seconds to compute', (stop_cyc-start_cyc), 'cycles: RTR=',
     #print (stop_clock-start_clock)/((stop_cyc-start_cyc)*0.5e-6)
+
+    return status
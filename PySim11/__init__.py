@@ -6,3 +6,17 @@
 # BFORCE_NEVER causes the current instruction, if a branch, to not be taken.
 BFORCE_ALWAYS = 1
 BFORCE_NEVER  = 2
+
+# These constants are returned by the step() function to tell why execution
+# stopped.
+STOP_COUNT       = 0  # The number of instructions asked for were executed
+STOP_BREAKPOINT  = 1
+STOP_CYCLES      = 2  # The cycle limit was reached
+STOP_SWI         = 3
+STOP_STOP        = 4
+STOP_WAI         = 5
+STOP_TEST        = 6
+STOP_ILLEGAL     = 7  # Illegal instruction
+STOP_INTERRUPTED = 8  # By the user (the break event or a KeyboardInterrupt)
+STOP_ERROR       = 9  # An exception, e.g., from a virtual function
+STOP_WATCHPOINT  = 10
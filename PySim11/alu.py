@@ -0,0 +1,234 @@
+'''
+Table-driven 8-bit ALU
+
+The 8-bit arithmetic, logic, shift and rotate helpers of ops.py (add8,
+sub8, and8, or8, eor8, asl8, asr8, lsr8, rol8, ror8, neg8 and daa) compute
+a (result, flags) tuple with a handful of tests each. This module computes
+both for every possible input once, using those very functions, and stores
+them in two bytes objects per helper: one for results and one for flags.
+makeTableOps() returns drop-in replacements for the helpers that just index
+the tables. ops.py uses them instead of the originals if G.UseALUTables
+is set.
+
+Tables are indexed as follows:
+
+  add8, sub8          u1 << 9 | u2, where u2 includes the carry-in (0-256)
+  and8, or8, eor8     u1 << 8 | u2
+  asl8, asr8, lsr8,
+  neg8                val
+  rol8, ror8          carry << 8 | val
+  daa                 c << 9 | h << 8 | A
+
+Building the tables takes a noticeable fraction of a second, so they are
+saved to a cache file in __pycache__ (if it can be written) and read back
+from there by later runs. The cache file name holds TableVersion, which
+should be incremented whenever the table layout changes. The file also
+starts with a signature of the reference helpers (a hash of their code and
+of their results for a sample of the inputs), and it is rebuilt if that
+doesn't match, so a change to a helper doesn't load stale tables. The file
+is written to a temporary file that is then renamed, so processes starting
+at the same time (e.g., batch workers) never read a partial file.
+
+Running this module (python -m PySim11.alu) checks that the tables agree
+with the reference helpers over every input.
+'''
+
+import hashlib
+import os
+import sys
+import tempfile
+
+TableVersion = 1
+
+# Helper name, number of table entries and function that calls the
+# reference helper f for table entry i
+TableSpecs = (
+  ('add8', 256 << 9, lambda f, i: f(i >> 9, i & 0x1FF)),
+  ('sub8', 256 << 9, lambda f, i: f(i >> 9, i & 0x1FF)),
+  ('and8', 256 << 8, lambda f, i: f(i >> 8, i & 0xFF)),
+  ('or8',  256 << 8, lambda f, i: f(i >> 8, i & 0xFF)),
+  ('eor8', 256 << 8, lambda f, i: f(i >> 8, i & 0xFF)),
+  ('asl8', 256,      lambda f, i: f(i)),
+  ('asr8', 256,      lambda f, i: f(i)),
+  ('lsr8', 256,      lambda f, i: f(i)),
+  ('neg8', 256,      lambda f, i: f(i)),
+  ('rol8', 512,      lambda f, i: f(i & 0xFF, i >> 8)),
+  ('ror8', 512,      lambda f, i: f(i & 0xFF, i >> 8)),
+  ('daa',  1024,     lambda f, i: f(i & 0xFF, i >> 9, i >> 8 & 1))
+  )
+
+def cacheFile():
+  return os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', f'alu{TableVersion}.tables')
+
+def buildTables(reference):
+  '''Return a dictionary indexed by helper name of (results, flags) bytes
+  objects computed with the helpers in the 'reference' dictionary.'''
+  tables = {}
+  for name, size, call in TableSpecs:
+    f = reference[name]
+    results = bytearray(size)
+    flags = bytearray(size)
+    for i in range(size):
+      results[i], flags[i] = call(f, i)
+    tables[name] = (bytes(results), bytes(flags))
+  return tables
+
+# Every SampleStep-th table entry is part of the signature
+SampleStep = 61
+
+def signature(reference):
+  '''Return a hash of the code of the helpers in the 'reference' dictionary
+  and of their results for a sample of the table entries.'''
+  h = hashlib.sha256()
+  for name, size, call in TableSpecs:
+    f = reference[name]
+    code = f.__code__
+    h.update(repr((name, code.co_code, code.co_consts, code.co_names)).encode())
+    h.update(repr([call(f, i) for i in range(0, size, SampleStep)]).encode())
+  return h.digest()
+
+def loadTables(reference):
+  '''Return the tables read from the cache file, or None if it is missing or
+  wasn't built with the helpers in the 'reference' dictionary'''
+  try:
+    with open(cacheFile(), 'rb') as fid: data = fid.read()
+  except OSError: return None
+
+  sig = signature(reference)
+  if data[:len(sig)] != sig: return None
+  data = data[len(sig):]
+  if len(data) != 2*sum(size for name, size, call in TableSpecs): return None
+  tables = {}
+  pos = 0
+  for name, size, call in TableSpecs:
+    tables[name] = (data[pos:pos+size], data[pos+size:pos+2*size])
+    pos += 2*size
+  return tables
+
+def saveTables(tables, reference):
+  dirname = os.path.dirname(cacheFile())
+  try:
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='alu', suffix='.tmp')
+  except OSError: return
+  try:
+    with os.fdopen(fd, 'wb') as fid:
+      fid.write(signature(reference))
+      for name, size, call in TableSpecs: fid.write(b''.join(tables[name]))
+    os.replace(tmpname, cacheFile())
+  except OSError:
+    try: os.remove(tmpname)
+    except OSError: pass
+
+def getTables(reference):
+  tables = loadTables(reference)
+  if tables is None:
+    tables = buildTables(reference)
+    saveTables(tables, reference)
+  return tables
+
+def makeTableOps(reference):
+  '''Return a dictionary of table-driven replacements for the helpers in
+  the 'reference' dictionary, indexed by helper name.'''
+  tables = getTables(reference)
+
+  ADD8R, ADD8F = tables['add8']
+  SUB8R, SUB8F = tables['sub8']
+  AND8R, AND8F = tables['and8']
+  OR8R, OR8F = tables['or8']
+  EOR8R, EOR8F = tables['eor8']
+  ASL8R, ASL8F = tables['asl8']
+  ASR8R, ASR8F = tables['asr8']
+  LSR8R, LSR8F = tables['lsr8']
+  NEG8R, NEG8F = tables['neg8']
+  ROL8R, ROL8F = tables['rol8']
+  ROR8R, ROR8F = tables['ror8']
+  DAAR, DAAF = tables['daa']
+
+  def add8(u1, u2):
+    i = u1 << 9 | u2
+    return (ADD8R[i], ADD8F[i])
+
+  def sub8(u1, u2):
+    i = u1 << 9 | u2
+    return (SUB8R[i], SUB8F[i])
+
+  def and8(u1, u2):
+    i = u1 << 8 | u2
+    return (AND8R[i], AND8F[i])
+
+  def or8(u1, u2):
+    i = u1 << 8 | u2
+    return (OR8R[i], OR8F[i])
+
+  def eor8(u1, u2):
+    i = u1 << 8 | u2
+    return (EOR8R[i], EOR8F[i])
+
+  def asl8(val): return (ASL8R[val], ASL8F[val])
+  def asr8(val): return (ASR8R[val], ASR8F[val])
+  def lsr8(val): return (LSR8R[val], LSR8F[val])
+  def neg8(val): return (NEG8R[val], NEG8F[val])
+
+  def rol8(val, carry):
+    i = carry << 8 | val
+    return (ROL8R[i], ROL8F[i])
+
+  def ror8(val, carry):
+    i = carry << 8 | val
+    return (ROR8R[i], ROR8F[i])
+
+  def daa(A, c, h):
+    i = c << 9 | h << 8 | A
+    return (DAAR[i], DAAF[i])
+
+  return {'add8': add8, 'sub8': sub8, 'and8': and8, 'or8': or8, 'eor8': eor8,
+          'asl8': asl8, 'asr8': asr8, 'lsr8': lsr8, 'neg8': neg8,
+          'rol8': rol8, 'ror8': ror8, 'daa': daa}
+
+def checkTableOps(reference, tableOps, write=sys.stdout.write):
+  '''Compare the table-driven helpers against the reference helpers over
+  every input they can be called with. Returns the number of mismatches.'''
+  def inputs(name):
+    if name in ('add8', 'sub8'):
+      # Every operand pair, with and without carry-in
+      for u1 in range(256):
+        for u2 in range(256):
+          yield (u1, u2)
+          yield (u1, u2+1)
+    elif name in ('and8', 'or8', 'eor8'):
+      for u1 in range(256):
+        for u2 in range(256): yield (u1, u2)
+    elif name in ('rol8', 'ror8'):
+      for val in range(256):
+        for carry in (0, 1): yield (val, carry)
+    elif name == 'daa':
+      for A in range(256):
+        for c in (0, 1):
+          for h in (0, 1): yield (A, c, h)
+    else:
+      for val in range(256): yield (val,)
+
+  errors = 0
+  for name, size, call in TableSpecs:
+    f = reference[name]
+    g = tableOps[name]
+    count = bad = 0
+    for args in inputs(name):
+      count += 1
+      if f(*args) != g(*args):
+        if not bad: write(f'{name}{args}: expected {f(*args)}, got {g(*args)}\n')
+        bad += 1
+    write(f'{name:5} {count:6} inputs, {bad} mismatches\n')
+    errors += bad
+  return errors
+
+if __name__ == '__main__':
+  import PySim11.ops as ops
+
+  reference = ops.ReferenceALU
+  tables = buildTables(reference)
+  if tables != loadTables(reference):
+    print('Cache file is stale or missing, rewriting it')
+    saveTables(tables, reference)
+  if checkTableOps(reference, makeTableOps(reference)): sys.exit(1)
@@ -0,0 +1,223 @@
+'''
+Parallel batch runner
+
+Runs many independent simulations (firmware image, start address, input
+stimuli, cycle limit) across a pool of worker processes, one simulator at a
+time per worker, checks their final registers and memory against expected
+values and writes a JSON report.
+
+  python -m PySim11.batch [-j N] [-o report.json] manifest.json
+
+The manifest is a JSON object:
+
+  {
+    "defaults": { ...job fields applied to every job... },
+    "jobs": [
+      {
+        "name":    "blink",                 # Defaults to the S19 or state file name
+        "s19":     "blink.s19",
+        "state":   "booted.state",          # Optional save-state file to start from
+        "map":     "blink.map",             # Optional
+        "start":   "0x2000",                # Optional, overrides the S19 file
+        "cycles":  100000,                  # Cycle limit, 0 for none
+        "timeout": 60,                      # Seconds before the job is stopped, 0 for none
+        "breaks":  ["0x2040"],              # Optional breakpoints
+        "stimuli": {"PA0": "ex2.sti"},      # Optional stimulus files by pin
+        "expect": {
+          "registers": {"A": 5, "PC": "0x2006"},
+          "memory":    {"0x0100": 42, "0x0110": [1, 2, 3]},
+          "output":    "SWI instruction encountered"
+        }
+      }
+    ]
+  }
+
+A job needs an "s19" file, a "state" file or both (see run.py).
+File names are relative to the directory of the manifest and numbers may
+be given as JSON numbers or as strings in any Python integer notation.
+"expect.output" is a string that must appear in the simulator's output
+(i.e., the reason execution stopped). A job still running after "timeout"
+seconds (G.BatchTimeout by default) is stopped and reported as an error, so
+that a job that never stops can't hold up the batch.
+
+The report is a JSON object with a "summary" (counts of passed, failed and
+errored jobs) and "results", one per job in manifest order, each with the
+job name, "status" ("pass", "fail" or "error"), the final registers and
+cycle count, the simulator output, the list of failed checks and the
+elapsed time. The exit status is 0 only if every job passed.
+'''
+
+import sys
+import os
+import io
+import json
+import time
+import getopt
+import threading
+import contextlib
+import concurrent.futures
+
+import PySim11.G as G
+import PySim11.run as run
+from PySim11 import STOP_INTERRUPTED
+
+Registers = ('PC', 'SP', 'X', 'Y', 'A', 'B', 'D', 'CC')
+
+def usage(arglist):
+  print('''\
+Usage:
+  python -m PySim11.batch [Options] manifest.json
+
+Options:
+  -j, --jobs=N     -- Number of worker processes (default: number of CPUs)
+  -o, --output=file -- Write the JSON report to file instead of stdout
+  -h, --help       -- Display this help summary\
+''')
+  sys.exit(1)
+
+def toInt(val):
+  if isinstance(val, str): return int(val, 0)
+  return int(val)
+
+def loadManifest(filename):
+  '''Return the list of jobs of a manifest file, with defaults applied and
+  file names made absolute.'''
+  with open(filename, 'rt') as fid: manifest = json.load(fid)
+  if isinstance(manifest, list): manifest = {'jobs': manifest}
+
+  base = os.path.dirname(os.path.abspath(filename))
+  def path(fname): return os.path.join(base, fname)
+
+  jobs = []
+  for entry in manifest.get('jobs', []):
+    job = dict(manifest.get('defaults', {}))
+    job.update(entry)
+    for key in ('s19', 'state', 'map'):
+      if job.get(key): job[key] = path(job[key])
+    job['stimuli'] = {pin: path(fname) for pin, fname in job.get('stimuli', {}).items()}
+    job.setdefault('name', os.path.splitext(os.path.basename(job.get('s19') or job['state']))[0])
+    jobs.append(job)
+  return jobs
+
+def jobOptions(job):
+  'Return the run.RunOptions for a job'
+  opts = run.RunOptions()
+  opts.S19FileName = job.get('s19')
+  opts.LoadState = job.get('state')
+  opts.MapFileName = job.get('map')
+  if job.get('start') is not None: opts.StartPC = toInt(job['start'])
+  opts.Cycles = toInt(job.get('cycles', 0))
+  opts.Breaks = [toInt(addr) for addr in job.get('breaks', [])]
+  opts.Stimuli = [(pin.upper(), fname) for pin, fname in job['stimuli'].items()]
+  return opts
+
+def checkJob(sim, job, output):
+  'Return the list of failed checks (strings) of a finished job'
+  expect = job.get('expect', {})
+  st = sim.ucState
+  failures = []
+
+  for reg, val in expect.get('registers', {}).items():
+    reg = reg.upper()
+    if reg not in Registers:
+      failures.append(f'Unknown register {reg}')
+      continue
+    actual = st.D() if reg == 'D' else getattr(st, reg)
+    if actual != toInt(val):
+      failures.append(f'{reg} is ${actual:X}, expected ${toInt(val):X}')
+
+  for addr, val in expect.get('memory', {}).items():
+    addr = toInt(addr)
+    if not isinstance(val, list): val = [val]
+    expected = [toInt(v) for v in val]
+    # Read raw, as reading some I/O registers through the memory filters
+    # changes them
+    actual = [sim.ucMemory.readRawUns8(addr+i) for i in range(len(expected))]
+    if actual != expected:
+      failures.append(f'Memory at ${addr:04X} is {bytes(actual).hex().upper()}, expected {bytes(expected).hex().upper()}')
+
+  if 'output' in expect and expect['output'] not in output:
+    failures.append(f'Output does not contain "{expect["output"]}"')
+  return failures
+
+def runJob(job):
+  '''Run a single job and return its result dictionary. This is what the
+  worker processes execute.'''
+  start = time.perf_counter()
+  result = {'name': job['name'], 'status': 'error', 'failures': []}
+  out = []
+  try:
+    # SimState() reports the peripherals it installs on stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+      sim = run.makeSim(jobOptions(job), out.append)
+      cyclimit = toInt(job.get('cycles', 0))
+      timeout = float(job.get('timeout', G.BatchTimeout))
+      # step() stops when the break event is cleared
+      sim.breakEvent = threading.Event()
+      sim.breakEvent.set()
+      timer = threading.Timer(timeout, sim.breakEvent.clear) if timeout else None
+      if timer: timer.start()
+      try: status = sim.step(0, 0, sim.cycles + cyclimit if cyclimit else 0)
+      finally:
+        if timer: timer.cancel()
+    output = ''.join(out)
+    if status == STOP_INTERRUPTED: raise TimeoutError(f'Stopped after {timeout:g} seconds')
+
+    st = sim.ucState
+    result['registers'] = {reg: st.D() if reg == 'D' else getattr(st, reg) for reg in Registers}
+    result['cycles'] = sim.cycles
+    result['output'] = output
+    result['failures'] = checkJob(sim, job, output)
+    result['status'] = 'fail' if result['failures'] else 'pass'
+  except Exception as detail:
+    result['output'] = ''.join(out)
+    result['failures'] = [f'{detail.__class__.__name__}: {detail}']
+  result['elapsed'] = round(time.perf_counter() - start, 3)
+  return result
+
+def runBatch(jobs, workers=None):
+  '''Run all jobs and return the report dictionary. With 1 worker, jobs run
+  in this process.'''
+  if workers == 1: results = [runJob(job) for job in jobs]
+  else:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+      results = list(pool.map(runJob, jobs))
+
+  summary = {'jobs': len(results)}
+  for status in ('pass', 'fail', 'error'):
+    summary[status] = sum(1 for r in results if r['status'] == status)
+  return {'summary': summary, 'results': results}
+
+def main(arglist=None):
+  if not arglist: arglist = sys.argv
+  try:
+    optlist, args = getopt.gnu_getopt(arglist[1:], 'hj:o:', ['help', 'jobs=', 'output='])
+  except getopt.error as detail:
+    print('Option error:', detail)
+    usage(arglist)
+
+  workers = None
+  reportfile = None
+  for w, val in optlist:
+    if w in ['-h', '--help']: usage(arglist)
+    elif w in ['-j', '--jobs']: workers = int(val)
+    elif w in ['-o', '--output']: reportfile = val
+  if len(args) != 1: usage(arglist)
+
+  try: jobs = loadManifest(args[0])
+  except Exception as detail:
+    print(f'Unable to read manifest "{args[0]}": {detail}')
+    return 2
+
+  report = runBatch(jobs, workers)
+  text = json.dumps(report, indent=2)
+  if reportfile:
+    with open(reportfile, 'wt') as fid: fid.write(text + '\n')
+  else: print(text)
+
+  S = report['summary']
+  sys.stderr.write(f"{S['jobs']} jobs: {S['pass']} passed, {S['fail']} failed, {S['error']} errors\n")
+  return 0 if S['pass'] == S['jobs'] else 1
+
+if __name__ == '__main__':
+  sys.exit(main())
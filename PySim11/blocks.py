@@ -0,0 +1,157 @@
+'''
+Basic-block translation cache
+
+Straight-line code is decoded once into a "block": the list of
+instructions from a starting PC up to and including the next instruction
+that can change the flow of control (branch, jump, subroutine call/return,
+RTI, SWI, etc.) Every instruction in a block is pre-decoded, i.e., its
+operands are read from memory once and bound to its handler, so running a
+tight loop from the cache doesn't decode the same bytes over and over.
+
+Blocks are keyed by their starting PC. Every byte covered by a cached block
+is flagged in the CodeMap of ucMemory so that a write to such a byte (self-
+modifying code, loading an S19 file, etc.) invalidates all blocks that cover
+it.
+
+Breakpoint and virtual function addresses ("stops", flagged in a bytearray
+shared with SimState.BPlist) are never included in a block except as its
+first instruction, so that SimState.step() sees every one of them. Adding a
+stop invalidates the blocks that cover it.
+'''
+
+from safestruct import *
+
+import PySim11.ops as ops
+from PySim11.ops import IMM8, IMM16, EXT, DIR, INDX, INDY, INH, REL, BIT2DIR, BIT2INDX, BIT2INDY, BIT3DIR, BIT3INDX, BIT3INDY
+
+# Longest run of instructions in a block
+MaxBlockLength = 64
+
+# Instructions that end a block as they (may) change the PC
+BlockEnders = {
+  'BRA', 'BRN', 'BHI', 'BLS', 'BHS', 'BLO', 'BNE', 'BEQ',
+  'BVC', 'BVS', 'BPL', 'BMI', 'BGE', 'BLT', 'BGT', 'BLE',
+  'BSR', 'BRSET', 'BRCLR', 'JMP', 'JSR', 'RTS', 'RTI',
+  'SWI', 'WAI', 'STOP', 'TEST'
+  }
+
+def bindOperands(op, A, PC, nextPC):
+  '''Return a function of one argument (the SimState) that calls the handler
+  of the instruction described by the ops.OpTable entry 'op', whose operands
+  start at address PC of the memory array A. Operands that don't depend on
+  the index registers are decoded here, once.'''
+  handler, mode = op[3], op[1]
+
+  if mode == INH: return handler
+
+  b0 = A[PC]
+  b1 = A[PC+1 & 0xFFFF]
+  b2 = A[PC+2 & 0xFFFF]
+
+  if mode == IMM8: return lambda sim: handler(sim, None, b0)
+  if mode == IMM16:
+    value = b0<<8 | b1
+    return lambda sim: handler(sim, None, value)
+  if mode == EXT:
+    addr = b0<<8 | b1
+    return lambda sim: handler(sim, addr, None)
+  if mode == DIR: return lambda sim: handler(sim, b0, None)
+  if mode == INDX: return lambda sim: handler(sim, b0 + sim.ucState.X & 0xFFFF, None)
+  if mode == INDY: return lambda sim: handler(sim, b0 + sim.ucState.Y & 0xFFFF, None)
+  if mode == REL:
+    target = nextPC + (b0 ^ 0x80) - 0x80 & 0xFFFF
+    return lambda sim: handler(sim, target)
+  if mode == BIT2DIR: return lambda sim: handler(sim, b0, b1)
+  if mode == BIT2INDX: return lambda sim: handler(sim, b0 + sim.ucState.X & 0xFFFF, b1)
+  if mode == BIT2INDY: return lambda sim: handler(sim, b0 + sim.ucState.Y & 0xFFFF, b1)
+
+  target = nextPC + (b2 ^ 0x80) - 0x80 & 0xFFFF
+  if mode == BIT3DIR: return lambda sim: handler(sim, b0, b1, target)
+  if mode == BIT3INDX: return lambda sim: handler(sim, b0 + sim.ucState.X & 0xFFFF, b1, target)
+  if mode == BIT3INDY: return lambda sim: handler(sim, b0 + sim.ucState.Y & 0xFFFF, b1, target)
+  raise ops.InternalError('Unknown instruction mode')
+
+class BlockCache(SafeStruct):
+  def __init__(self, memory, stops):
+    super().__init__({
+      'memory': memory,
+      'blocks': {},       # Indexed by starting PC, each entry is a list of
+                          # (nextPC, cycles, run) tuples, one per instruction
+      'covers': {},       # Indexed by address, each entry is the set of
+                          # starting PCs of the blocks covering that byte
+      'stops': stops,     # bytearray, nonzero at the addresses of stops
+      'generation': 0     # Incremented whenever blocks are invalidated
+    })
+    memory.CodeWriteHandler = self.codeWrite
+
+  def flush(self):
+    CodeMap = self.memory.CodeMap
+    for addr in self.covers: CodeMap[addr] = 0
+    self.blocks = {}
+    self.covers = {}
+    self.generation += 1
+
+  def get(self, PC):
+    '''Return the block starting at PC, decoding it if necessary. Returns
+    None if the instruction at PC is illegal.'''
+    try: return self.blocks[PC]
+    except KeyError: return self.build(PC)
+
+  def build(self, start):
+    A = self.memory.Array
+    CodeMap = self.memory.CodeMap
+    OpTable = ops.OpTable
+    ModeBytes = ops.ModeBytes
+    stops = self.stops
+
+    block = []
+    PC = start
+    while len(block) < MaxBlockLength:
+      if block and stops[PC]: break
+
+      opPC = PC
+      op = OpTable[A[PC]]
+      PC = PC+1 & 0xFFFF
+      if op.__class__ is list:
+        op = op[A[PC]]
+        PC = PC+1 & 0xFFFF
+      if op is None: break
+
+      nextPC = PC + ModeBytes[op[1]] & 0xFFFF
+      block.append((nextPC, op[2], bindOperands(op, A, PC, nextPC)))
+
+      addr = opPC
+      while addr != nextPC:
+        try: self.covers[addr].add(start)
+        except KeyError: self.covers[addr] = {start}
+        CodeMap[addr] = 1
+        addr = addr+1 & 0xFFFF
+
+      PC = nextPC
+      if op[0] in BlockEnders: break
+
+    if not block: return None
+    self.blocks[start] = block
+    return block
+
+  def invalidate(self, addr):
+    starts = self.covers.get(addr)
+    if not starts: return
+
+    CodeMap = self.memory.CodeMap
+    for start in list(starts):
+      block = self.blocks.pop(start)
+      first = start
+      last = block[-1][0]
+      while first != last:
+        S = self.covers[first]
+        S.discard(start)
+        if not S:
+          del self.covers[first]
+          CodeMap[first] = 0
+        first = first+1 & 0xFFFF
+    self.generation += 1
+
+  def codeWrite(self, addr, bits):
+    self.invalidate(addr)
+    if bits == 16: self.invalidate(addr+1 & 0xFFFF)
@@ -0,0 +1,279 @@
+'''
+Call graph and subroutine cycle accounting
+
+While enabled, the simulator keeps a shadow call stack: a frame is pushed
+when a subroutine is entered through JSR or BSR, or when an interrupt is
+taken, and popped when an RTS or RTI returns past it. When a frame is
+popped, its cycles are added to the statistics of the routine (keyed by
+its entry address):
+
+  - inclusive cycles, from its first instruction up to the instruction
+    following the return, including those of the routines it called;
+  - exclusive cycles, the inclusive ones less those of the routines it
+    called and of interrupts taken meanwhile;
+  - the worst-case execution time, the most inclusive cycles of a call;
+  - the most stack it used, from the SP before the call (so including the
+    return address, or the 9 bytes stacked by an interrupt) down to the
+    lowest SP reached before returning.
+
+Frames are popped by comparing stack pointers rather than by pairing calls
+and returns, so code that discards a return address (e.g., by pulling it
+and jumping) is accounted for when a later return unwinds past it. The
+cycles of code outside any routine go to a root frame with no address.
+
+For every interrupt source taken, the latency is the number of cycles from
+the instruction boundary at which the source was first seen active to the
+start of its service routine, i.e., it doesn't count the part of the
+instruction during which the source became active.
+
+If the cycle counter goes back (it is reset or the execution history goes
+back), the shadow stack is emptied and the statistics gathered so far are
+kept.
+'''
+
+from safestruct import *
+
+import PySim11.ints as ints
+import PySim11.profiler as profiler
+
+# Opcodes (as read at the PC) of the instructions that call a subroutine
+# (JSR in all modes and BSR) or return. The prebyte 18 is only followed by
+# AD (JSR ,Y) for a call.
+CallOpcodes = frozenset((0x8D, 0x9D, 0xAD, 0xBD))
+ReturnOpcodes = frozenset((0x39, 0x3B))
+
+# Frame fields, a frame being a list as it is updated on every instruction
+F_ENTRY, F_BASE, F_START, F_CHILD, F_MINSP = range(5)
+
+Names = dict((v, k) for k, v in vars(ints).items() if k.isupper() and isinstance(v, int) and 1 <= v <= 16)
+Names[ints.OC5I] = 'OC5I/IC4I'
+
+class ucRoutine(SafeStruct):
+  def __init__(self, addr):
+    super().__init__({
+      'addr': addr,       # Entry address
+      'calls': 0,         # Number of returns from it
+      'inclusive': 0,     # Total cycles, including those of callees
+      'exclusive': 0,     # Total cycles, excluding those of callees
+      'wcet': 0,          # Most inclusive cycles of a single call
+      'stack': 0,         # Most stack bytes used by a single call
+      'interrupt': 0      # Set if entered as an interrupt service routine
+    })
+
+class ucLatency(SafeStruct):
+  def __init__(self, source):
+    super().__init__({
+      'source': source,   # Interrupt source number, see ints.py
+      'count': 0,         # Number of times taken
+      'total': 0,         # Total latency, in cycles
+      'worst': 0          # Worst latency, in cycles
+    })
+
+class CallGraph(SafeStruct):
+  def __init__(self, sim):
+    super().__init__({
+      'sim': sim,
+      'routines': {},     # ucRoutine objects indexed by entry address
+      'latencies': {},    # ucLatency objects indexed by interrupt source
+      'maxDepth': 0,      # Most frames on the shadow stack, not counting the root
+      'stack': [],        # The shadow call stack, a list of frames
+      'before': None,     # Called before every instruction, before a pending interrupt is taken
+      'record': None,     # Called before every instruction, see makeRecorder()
+      'flush': None,      # Accounts the cycles of the last instruction run
+      'reset': None,      # Empties the shadow stack, forgetting the cycles recorded if given 1
+      'lowest': None,     # Returns the lowest SP seen in a routine, 0x10000 if none
+      'elapsed': None     # Returns the cycles recorded and those spent at top level
+    })
+    self.makeRecorder()
+    sim.ucEvents.addHandler(sim.ucEvents.CycReset, self.OnCycReset)
+
+  def close(self):
+    self.sim.ucEvents.removeHandler(self.sim.ucEvents.CycReset, self.OnCycReset)
+
+  def makeRecorder(self):
+    sim = self.sim
+    st = sim.ucState
+    A = sim.ucMemory.Array
+    intr = sim.ucInterrupts
+    routines = self.routines
+    latencies = self.latencies
+    stack = self.stack
+    calls = CallOpcodes
+    returns = ReturnOpcodes
+    last = sim.cycles # Cycle the previous instruction started on
+    base = None       # SP before the previous instruction, if it was a call
+    ret = 0           # The previous instruction was a return
+    lowest = 0x10000  # Lowest SP in the current frame
+    seen = 0          # Interrupt sources seen active
+    since = {}        # Cycle each source in 'seen' was first seen active
+    deepest = 0x10000 # Lowest SP in the frames popped
+    taken = None      # SP before the interrupt being taken, if any
+    before = (0, 0)   # elapsed() at the last reset
+
+    def reset(now, forget=0):
+      nonlocal last, lowest, deepest, before
+      if forget:
+        deepest = 0x10000
+        before = (0, 0)
+      elif stack:
+        deepest = lowestSeen()
+        before = elapsed(last)
+      # Stack pointers are 16 bits, so the root frame is never popped
+      del stack[:]
+      stack.append([None, 0x10000, now, 0, 0x10000])
+      lowest = 0x10000
+      last = now
+
+    def push(entry, SP, now, interrupt=0):
+      nonlocal lowest
+      stack[-1][F_MINSP] = lowest
+      stack.append([entry, SP, now, 0, SP])
+      lowest = SP
+      if len(stack) > self.maxDepth + 1: self.maxDepth = len(stack) - 1
+      if interrupt:
+        try: routines[entry].interrupt = 1
+        except KeyError:
+          r = routines[entry] = ucRoutine(entry)
+          r.interrupt = 1
+
+    def pop(SP, now):
+      nonlocal lowest, deepest
+      # Pop every frame the return unwinds past
+      while stack[-1][F_BASE] <= SP:
+        entry, fbase, start, child, minSP = stack.pop()
+        minSP = min(minSP, lowest)
+        incl = now - start
+        try: r = routines[entry]
+        except KeyError: r = routines[entry] = ucRoutine(entry)
+        r.calls += 1
+        r.inclusive += incl
+        r.exclusive += incl - child
+        if incl > r.wcet: r.wcet = incl
+        if fbase - minSP > r.stack: r.stack = fbase - minSP
+        if minSP < deepest: deepest = minSP
+        parent = stack[-1]
+        parent[F_CHILD] += incl
+        lowest = min(parent[F_MINSP], minSP)
+
+    # SimState.recorder() calls beforeInterrupt() ahead of dispatching a
+    # pending interrupt, which is when its latency is known, and record()
+    # after, so that the frame of the service routine starts at its entry.
+    def beforeInterrupt():
+      nonlocal last, seen, taken, base, ret
+      now = sim.cycles
+      if now < last: reset(now)
+      last = now
+
+      if ret:
+        pop(st.SP, now)
+        ret = 0
+      elif base is not None:
+        push(st.PC, base, now)
+        base = None
+
+      pending = intr.pending
+      if pending != seen:
+        for source in [s for s in since if not pending & 1 << s]: del since[source]
+        new = pending & ~seen
+        while new:
+          source = (new & -new).bit_length() - 1
+          since[source] = now
+          new &= new - 1
+        seen = pending
+
+      if intr.ready:
+        source = intr.ready
+        taken = st.SP
+        try: lat = latencies[source]
+        except KeyError: lat = latencies[source] = ucLatency(source)
+        delay = now - since.pop(source, now)
+        lat.count += 1
+        lat.total += delay
+        if delay > lat.worst: lat.worst = delay
+
+    def record():
+      nonlocal base, ret, lowest, taken
+      if taken is not None:
+        push(st.PC, taken, last, 1)
+        taken = None
+
+      SP = st.SP
+      if SP < lowest: lowest = SP
+      PC = st.PC
+      op = A[PC]
+      if op in calls or op == 0x18 and A[PC+1 & 0xFFFF] == 0xAD: base = SP
+      elif op in returns: ret = 1
+
+    # SimState.step() calls flush() when it stops, so that the cycles of the
+    # last instruction are kept if the cycle counter is reset before the
+    # next run.
+    def flush():
+      nonlocal last
+      if sim.cycles > last: last = sim.cycles
+
+    def lowestSeen():
+      # The SP at top level (e.g., before it is initialized) doesn't count
+      if len(stack) == 1: return deepest
+      return min([deepest, lowest] + [f[F_MINSP] for f in stack[1:-1]])
+
+    def elapsed(now=None):
+      if now is None: now = max(sim.cycles, last)
+      root = stack[0]
+      top = now - root[F_START] - root[F_CHILD]
+      if len(stack) > 1: top -= now - stack[1][F_START]
+      return before[0] + now - root[F_START], before[1] + top
+
+    self.before = beforeInterrupt
+    self.record = record
+    self.flush = flush
+    self.reset = lambda forget=0: reset(sim.cycles, forget)
+    self.lowest = lowestSeen
+    self.elapsed = elapsed
+    reset(sim.cycles)
+
+  def OnCycReset(self, event): self.reset()
+
+  def highWater(self):
+    '''Return the lowest SP seen while in a routine (or service routine), or
+    None if no routine was entered. Stack used by code at top level that
+    doesn't call any routine isn't seen.'''
+    SP = self.lowest()
+    return SP if SP < 0x10000 else None
+
+  def clear(self):
+    'Forget the statistics gathered so far and empty the shadow stack'
+    self.routines.clear()
+    self.latencies.clear()
+    self.maxDepth = 0
+    self.reset(1)
+
+  def report(self, write, mapfile=None, top=20):
+    '''Write the statistics of the 'top' routines with the most inclusive
+    cycles, the interrupt latencies, the deepest call nesting and the stack
+    high-water mark.'''
+    starts, syms = profiler.symbolRanges(mapfile) if mapfile is not None else ([], [])
+    names = dict(zip(starts, syms))
+    total, toplevel = self.elapsed()
+    write('%d cycles recorded, %d routines returned from\n' % (total, len(self.routines)))
+
+    rows = [(total, 0, total, toplevel, toplevel, 0, '(top level)')]
+    for r in self.routines.values():
+      name = '%s ($%04X)' % (names[r.addr], r.addr) if r.addr in names else '$%04X' % r.addr
+      if r.interrupt: name += ' [ISR]'
+      rows.append((r.inclusive, r.calls, r.inclusive, r.exclusive, r.wcet, r.stack, name))
+    rows.sort(key=lambda row: row[0], reverse=True)
+
+    write('\n     Calls  Inclusive      %  Exclusive       WCET  Stack  Routine\n')
+    for key, calls, incl, excl, wcet, stack, name in rows[:top]:
+      write('%10d %10d %5.1f%% %10d %10d %6d  %s\n' % (calls, incl, 100.0*incl/total if total else 0, excl, wcet, stack, name))
+    if len(rows) > top: write('(%d more)\n' % (len(rows)-top))
+
+    if self.latencies:
+      write('\n     Taken    Average      Worst  Interrupt latency\n')
+      for source in sorted(self.latencies):
+        lat = self.latencies[source]
+        write('%10d %10.1f %10d  %s\n' % (lat.count, lat.total/lat.count, lat.worst, Names[source]))
+
+    write('\nMaximum call depth: %d\n' % self.maxDepth)
+    SP = self.highWater()
+    if SP is not None: write('Stack high-water mark: SP=$%04X\n' % SP)
@@ -0,0 +1,365 @@
+'''
+Code coverage
+
+While enabled, the simulator marks in three 8192-byte bitmaps (one bit per
+address) the address of every instruction executed and, for every
+conditional branch (Bcc, BRSET and BRCLR; BRA, BRN and BSR always go the
+same way), whether it was taken and whether it was not. Recording an
+instruction costs two bit sets, so coverage can be left on for whole test
+suites.
+
+Coverage data is saved to, and loaded from, files of the bitmaps. Loading a
+file ORs its bitmaps into those held, so the coverage of any number of runs,
+e.g., of parallel test jobs, is merged by loading their files in turn:
+
+  python -m PySim11.coverage [Options] file.cov ...
+
+A coverage file is big-endian:
+
+  Header (HeaderFormat)
+    Magic       8 bytes, 'PySim11C'
+    Version     16 bits, FormatVersion
+  Executed      8192 bytes, the bit for address A is bit A&7 of byte A>>3
+  Taken         8192 bytes, branches taken
+  NotTaken      8192 bytes, branches not taken
+
+With a MAP file, the coverage is reported per source line, in the lcov
+tracefile format (read by genhtml, most CI services and editor plugins) or
+the Cobertura XML format. A line is executed if the instruction at its
+address is. The MAP file doesn't tell code from data, so lines that only
+define data are reported as not executed. Conditional branches are found
+at the lines' addresses in the memory image given to the reports (which
+should hold the code, e.g., as loaded from the S19 file), so that branches
+never reached are reported too; without one, only the branches executed
+are.
+'''
+
+import sys
+import os
+import getopt
+import struct
+import time
+import xml.etree.ElementTree as ET
+
+from safestruct import *
+
+import PySim11.ops as ops
+import PySim11.mapsym as mapsym
+
+Magic = b'PySim11C'
+FormatVersion = 1
+
+HeaderFormat = struct.Struct('>8sH')
+BitmapSize = 65536 // 8
+
+class CoverageError(Exception): pass
+
+def branchLengths():
+  '''Return (lengths, prebyte18): two 256-byte tables of the length of the
+  conditional branch instructions by opcode, 0 for other instructions.
+  lengths[0x18] is 1, the opcodes that follow the 18 prebyte being in
+  prebyte18.'''
+  modes = (ops.REL, ops.BIT3DIR, ops.BIT3INDX, ops.BIT3INDY)
+  always = ('BRA', 'BRN', 'BSR')
+  tables = []
+  for table, n in ((ops.OpTable, 1), (ops.OpTable[0x18], 2)):
+    lengths = bytearray(256)
+    for code, op in enumerate(table):
+      if op.__class__ is not list and op is not None and op[1] in modes and op[0] not in always:
+        lengths[code] = n + ops.ModeBytes[op[1]]
+    tables.append(lengths)
+  tables[0][0x18] = 1
+  return tables
+
+BranchLengths, Prebyte18Lengths = branchLengths()
+
+def branchLength(code, addr):
+  '''Return the length of the conditional branch instruction at 'addr' in
+  the memory image 'code', or 0 if it isn't one.'''
+  n = BranchLengths[code[addr]]
+  if n == 1: n = Prebyte18Lengths[code[addr+1 & 0xFFFF]]
+  return n
+
+def isSet(bitmap, addr): return bitmap[addr >> 3] >> (addr & 7) & 1
+
+def orBitmap(dest, src):
+  'OR the bitmap src into the bitmap dest (a bytearray)'
+  n = len(dest)
+  dest[:] = (int.from_bytes(dest, 'big') | int.from_bytes(src, 'big')).to_bytes(n, 'big')
+
+class Coverage(SafeStruct):
+  def __init__(self, sim=None):
+    super().__init__({
+      'sim': sim,
+      'executed': bytearray(BitmapSize),  # Addresses of the instructions executed
+      'taken': bytearray(BitmapSize),     # Addresses of the branches taken
+      'notTaken': bytearray(BitmapSize),  # Addresses of the branches not taken
+      'before': None,     # Called before every instruction, before a pending interrupt is taken
+      'record': None,     # Called before every instruction, see makeRecorder()
+      'flush': None       # Records the outcome of the last instruction run
+    })
+    if sim is not None: self.makeRecorder()
+
+  def makeRecorder(self):
+    sim = self.sim
+    st = sim.ucState
+    A = sim.ucMemory.Array
+    executed = self.executed
+    taken = self.taken
+    notTaken = self.notTaken
+    lengths = BranchLengths
+    prebyte18 = Prebyte18Lengths
+    branch = None     # Address of the previous instruction, if a conditional branch
+    fallthrough = 0   # Address of the instruction following it
+
+    def outcome(PC):
+      nonlocal branch
+      if PC == fallthrough: notTaken[branch >> 3] |= 1 << (branch & 7)
+      else: taken[branch >> 3] |= 1 << (branch & 7)
+      branch = None
+
+    # The outcome of a branch is seen before an interrupt is taken, so
+    # SimState.recorder() calls beforeInterrupt() ahead of dispatching it,
+    # and record() after.
+    def beforeInterrupt():
+      if branch is not None: outcome(st.PC)
+
+    def record():
+      nonlocal branch, fallthrough
+      PC = st.PC
+      executed[PC >> 3] |= 1 << (PC & 7)
+      n = lengths[A[PC]]
+      if n:
+        if n == 1: n = prebyte18[A[PC+1 & 0xFFFF]]
+        if n:
+          branch = PC
+          fallthrough = PC + n & 0xFFFF
+
+    # SimState.step() calls flush() when it stops, as the PC can be changed
+    # from the debugger before the next run.
+    def flush():
+      if branch is not None: outcome(st.PC)
+
+    self.before = beforeInterrupt
+    self.record = record
+    self.flush = flush
+
+  def clear(self):
+    if self.flush: self.flush()
+    for bitmap in (self.executed, self.taken, self.notTaken): bitmap[:] = bytes(BitmapSize)
+
+  def save(self, filename):
+    'Write the bitmaps to a coverage file'
+    if self.flush: self.flush()
+    with open(filename, 'wb') as fid:
+      fid.write(HeaderFormat.pack(Magic, FormatVersion))
+      for bitmap in (self.executed, self.taken, self.notTaken): fid.write(bitmap)
+
+  def load(self, filename):
+    '''OR the bitmaps of a coverage file into those held. Raises
+    CoverageError if the file isn't a coverage file of this version.'''
+    with open(filename, 'rb') as fid: buf = fid.read()
+    if len(buf) < HeaderFormat.size or buf[:len(Magic)] != Magic:
+      raise CoverageError(f'"{filename}" is not a coverage file')
+    magic, version = HeaderFormat.unpack_from(buf, 0)
+    if version != FormatVersion:
+      raise CoverageError(f'"{filename}" is a version {version} coverage file, expected version {FormatVersion}')
+    if len(buf) != HeaderFormat.size + 3*BitmapSize:
+      raise CoverageError(f'"{filename}" is truncated')
+    base = HeaderFormat.size
+    for bitmap in (self.executed, self.taken, self.notTaken):
+      orBitmap(bitmap, buf[base:base+BitmapSize])
+      base += BitmapSize
+
+  def merge(self, other):
+    "OR the bitmaps of another Coverage object into this one's"
+    for mine, theirs in ((self.executed, other.executed), (self.taken, other.taken), (self.notTaken, other.notTaken)):
+      orBitmap(mine, theirs)
+
+  def branches(self, code=None, addrs=None):
+    '''Return a sorted list of (address, taken, notTaken) tuples for the
+    conditional branches in the memory image 'code' at the addresses
+    'addrs', or for those executed if either is None.'''
+    if code is not None and addrs is not None:
+      addrs = sorted(a for a in addrs if BranchLengths[code[a]] and branchLength(code, a))
+    else:
+      either = int.from_bytes(self.taken, 'little') | int.from_bytes(self.notTaken, 'little')
+      addrs = []
+      while either:
+        low = either & -either
+        addrs.append(low.bit_length() - 1)
+        either ^= low
+    return [(a, isSet(self.taken, a), isSet(self.notTaken, a)) for a in addrs]
+
+  def byLine(self, mapfile, code=None):
+    '''Return a dictionary, indexed by source file name, of sorted lists of
+    (linenum, executed, branches) tuples, one for every source line with an
+    address in the MAP file. 'branches' is a list of (taken, notTaken)
+    tuples, one per conditional branch at the line's addresses.'''
+    lines = {}
+    for addr, (srcline, fname, linenum) in mapfile.addrmap.items():
+      try: entry = lines[(fname, linenum)]
+      except KeyError: entry = lines[(fname, linenum)] = [0, []]
+      if isSet(self.executed, addr): entry[0] = 1
+    for addr, t, nt in self.branches(code, mapfile.addrmap):
+      try: srcline, fname, linenum = mapfile.addrmap[addr]
+      except KeyError: continue
+      lines[(fname, linenum)][1].append((t, nt))
+    files = {}
+    for (fname, linenum), (hit, branches) in lines.items():
+      files.setdefault(fname, []).append((linenum, hit, branches))
+    for entries in files.values(): entries.sort(key=lambda e: e[0])
+    return files
+
+  def writeLcov(self, fid, mapfile, code=None, testname=''):
+    'Write the coverage per source line in the lcov tracefile format'
+    for fname, entries in sorted(self.byLine(mapfile, code).items()):
+      fid.write(f'TN:{testname}\nSF:{fname}\n')
+      brf = brh = 0
+      for linenum, hit, branches in entries:
+        for block, (t, nt) in enumerate(branches):
+          for branch, taken in enumerate((t, nt)):
+            fid.write('BRDA:%d,%d,%d,%s\n' % (linenum, block, branch, taken if hit else '-'))
+            brf += 1
+            brh += taken
+      for linenum, hit, branches in entries: fid.write('DA:%d,%d\n' % (linenum, hit))
+      fid.write('BRF:%d\nBRH:%d\n' % (brf, brh))
+      fid.write('LF:%d\nLH:%d\n' % (len(entries), sum(e[1] for e in entries)))
+      fid.write('end_of_record\n')
+
+  def writeCobertura(self, fid, mapfile, code=None, source='.'):
+    '''Write the coverage per source line in the Cobertura XML format, with
+    one class per source file. 'source' is the directory the file names are
+    relative to.'''
+    def rates(elem, lines, hits, branches, taken):
+      elem.set('line-rate', '%.4f' % (hits/lines if lines else 1))
+      elem.set('branch-rate', '%.4f' % (taken/branches if branches else 1))
+      elem.set('complexity', '0')
+
+    root = ET.Element('coverage')
+    ET.SubElement(ET.SubElement(root, 'sources'), 'source').text = source
+    package = ET.SubElement(ET.SubElement(root, 'packages'), 'package', name='firmware')
+    classes = ET.SubElement(package, 'classes')
+    totals = [0, 0, 0, 0]
+    for fname, entries in sorted(self.byLine(mapfile, code).items()):
+      cls = ET.SubElement(classes, 'class', name=os.path.splitext(os.path.basename(fname))[0], filename=fname)
+      ET.SubElement(cls, 'methods')
+      elines = ET.SubElement(cls, 'lines')
+      counts = [0, 0, 0, 0]
+      for linenum, hit, branches in entries:
+        line = ET.SubElement(elines, 'line', number=str(linenum), hits=str(hit))
+        counts[0] += 1
+        counts[1] += hit
+        if branches:
+          n = 2*len(branches)
+          covered = sum(t + nt for t, nt in branches)
+          line.set('branch', 'true')
+          line.set('condition-coverage', '%d%% (%d/%d)' % (100*covered//n, covered, n))
+          counts[2] += n
+          counts[3] += covered
+        else: line.set('branch', 'false')
+      rates(cls, *counts)
+      totals = [a+b for a, b in zip(totals, counts)]
+    rates(package, *totals)
+    rates(root, *totals)
+    root.set('lines-valid', str(totals[0]))
+    root.set('lines-covered', str(totals[1]))
+    root.set('branches-valid', str(totals[2]))
+    root.set('branches-covered', str(totals[3]))
+    root.set('version', 'PySim11')
+    root.set('timestamp', str(int(time.time()*1000)))
+    for elem in root.iter():
+      if len(elem): elem.text = '\n'
+      elem.tail = '\n'
+    fid.write('<?xml version="1.0" ?>\n')
+    fid.write('<!DOCTYPE coverage SYSTEM "http://cobertura.sourceforge.net/xml/coverage-04.dtd">\n')
+    fid.write(ET.tostring(root, encoding='unicode'))
+
+  def report(self, write, mapfile=None, code=None):
+    '''Write the number of instruction addresses executed and of branch
+    outcomes covered and, with a MAP file, the line and branch coverage of
+    every source file.'''
+    executed = sum(bin(b).count('1') for b in self.executed)
+    if mapfile is None:
+      branches = self.branches()
+      write('%d instruction addresses executed, %d branch outcomes covered in %d branches\n'
+            % (executed, sum(t + nt for a, t, nt in branches), len(branches)))
+      return
+
+    files = self.byLine(mapfile, code)
+    write('%d instruction addresses executed\n' % executed)
+    write('\n  Lines    Hit      %  Branches    Hit      %  File\n')
+    for fname, entries in sorted(files.items()):
+      lines = len(entries)
+      hits = sum(e[1] for e in entries)
+      n = 2*sum(len(e[2]) for e in entries)
+      covered = sum(t + nt for e in entries for t, nt in e[2])
+      write('%7d %6d %5.1f%% %9d %6d %5.1f%%  %s\n' % (lines, hits, 100.0*hits/lines if lines else 100,
+            n, covered, 100.0*covered/n if n else 100, fname))
+
+################################################################################
+
+def usage(arglist):
+  print('''\
+Usage:
+  python -m PySim11.coverage [Options] file.cov ...
+
+Merges the coverage files given and writes the result.
+
+Options:
+  -o, --output=file    -- Write the merged coverage to a coverage file
+  -m, --map=file       -- Load a MAP file, for the source line reports
+  -c, --code=file.S19  -- Find the branches not executed in this S19 (or
+                          Intel HEX or binary) file
+  -l, --lcov=file      -- Write an lcov tracefile (needs a MAP file)
+  -x, --cobertura=file -- Write a Cobertura XML file (needs a MAP file)
+  -h, --help           -- Display this help summary\
+''')
+  sys.exit(1)
+
+def main(arglist=None):
+  if not arglist: arglist = sys.argv
+  try:
+    optlist, args = getopt.gnu_getopt(arglist[1:], 'ho:m:c:l:x:', ['help', 'output=', 'map=', 'code=', 'lcov=', 'cobertura='])
+  except getopt.error as detail:
+    print('Option error:', detail)
+    usage(arglist)
+
+  output = mapname = codename = lcov = cobertura = None
+  for w, val in optlist:
+    if w in ['-h', '--help']: usage(arglist)
+    elif w in ['-o', '--output']: output = val
+    elif w in ['-m', '--map']: mapname = val
+    elif w in ['-c', '--code']: codename = val
+    elif w in ['-l', '--lcov']: lcov = val
+    elif w in ['-x', '--cobertura']: cobertura = val
+  if not args or (lcov or cobertura) and not mapname: usage(arglist)
+
+  cov = Coverage()
+  try:
+    for fname in args: cov.load(fname)
+    mapfile = code = None
+    if mapname:
+      with open(mapsym.add_extension(mapname), 'rt') as fid:
+        mapfile = mapsym.MapFile(fid, os.path.dirname(mapname) or '.')
+    if codename:
+      from PySim11.memory import ucMemory
+      from PySim11.s19 import ReadImage
+      mem = ucMemory()
+      ReadImage(codename, mem)
+      code = mem.Array
+
+    if output: cov.save(output)
+    if lcov:
+      with open(lcov, 'wt') as fid: cov.writeLcov(fid, mapfile, code)
+    if cobertura:
+      with open(cobertura, 'wt') as fid: cov.writeCobertura(fid, mapfile, code, os.path.dirname(mapname) or '.')
+  except Exception as detail:
+    print(detail)
+    return 1
+
+  cov.report(sys.stdout.write, mapfile, code)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
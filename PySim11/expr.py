@@ -0,0 +1,175 @@
+'''
+Expressions for conditional breakpoints
+
+An expression such as
+
+  A == 0 && w[PTR+2] >= $8000 || cycles > &100000
+
+is compiled once, by compileExpr(), into a Python function of the simulator
+that evaluates it, so that a conditional breakpoint in a loop that runs a
+million times doesn't parse its condition a million times.
+
+Operands are:
+
+  - numbers, in the EVBU notation: hexadecimal by default, or $HHHH,
+    %BBBB (binary), &DDDD (decimal), @NNNN (octal) or 0xHHHH
+  - the registers A, B, D, X, Y, SP, PC and CC (or CCR), and CYCLES (or
+    CYC), the cycle counter. A register name takes precedence over a
+    symbol or hexadecimal number of the same name ($A is the number)
+  - symbols of the MAP file loaded when the expression is compiled
+  - [expr], the byte at the address expr, and w[expr], the 16-bit word
+    there. Memory is read directly, without going through the memory
+    filters, so evaluating an expression has no side effects on the
+    peripherals
+
+Operators, from the lowest precedence to the highest, are || (or 'or'),
+&& ('and'), |, ^, &, == (or =) and !=, < <= > >=, << and >>, + and -,
+* / and %, and the unary -, ~ and ! ('not'). Arithmetic is done on unbounded
+integers and division is integer division.
+'''
+
+import re
+
+class ExprError(Exception): pass
+
+Registers = {
+  'A':  'st.A',
+  'B':  'st.B',
+  'D':  'st.D()',
+  'X':  'st.X',
+  'Y':  'st.Y',
+  'SP': 'st.SP',
+  'PC': 'st.PC',
+  'CC': 'st.CC',
+  'CCR': 'st.CC',
+  'CYC': 'sim.cycles',
+  'CYCLES': 'sim.cycles'
+}
+
+# Binary operators by precedence level, lowest first, with their Python
+# equivalents
+Levels = (
+  {'||': 'or', 'OR': 'or'},
+  {'&&': 'and', 'AND': 'and'},
+  {'|': '|'},
+  {'^': '^'},
+  {'&': '&'},
+  {'==': '==', '=': '==', '!=': '!='},
+  {'<': '<', '<=': '<=', '>': '>', '>=': '>='},
+  {'<<': '<<', '>>': '>>'},
+  {'+': '+', '-': '-'},
+  {'*': '*', '/': '//', '%': '%'}
+)
+
+_operator = re.compile(r'\s*(\|\||&&|==|!=|<=|>=|<<|>>|[|^&=<>+\-*/%]|(?:and|or)\b)', re.IGNORECASE)
+_number = re.compile(r'\s*(\$[0-9A-Fa-f]+|%[01]+|&[0-9]+|@[0-7]+|0[xX][0-9A-Fa-f]+)')
+_name = re.compile(r'\s*([A-Za-z_.?][A-Za-z0-9_.?]*)')
+_punct = re.compile(r'\s*([()\[\]~!-])')
+
+class Parser:
+  def __init__(self, text, symtab):
+    self.text = text
+    self.pos = 0
+    self.symtab = symtab
+
+  def error(self, msg):
+    raise ExprError(f'{msg} at position {self.pos+1} of "{self.text}"')
+
+  def match(self, regex):
+    m = regex.match(self.text, self.pos)
+    if m: self.pos = m.end()
+    return m
+
+  def expect(self, char):
+    m = self.match(_punct)
+    if not m or m.group(1) != char: self.error(f'Expecting "{char}"')
+
+  def parse(self):
+    src = self.binary(0)
+    if self.text[self.pos:].strip(): self.error('Unexpected text')
+    return src
+
+  def binary(self, level):
+    if level == len(Levels): return self.unary()
+    src = self.binary(level+1)
+    ops = Levels[level]
+    while 1:
+      pos = self.pos
+      m = self.match(_operator)
+      op = m and m.group(1).upper()
+      if op not in ops:
+        self.pos = pos
+        return src
+      src = f'({src} {ops[op]} {self.binary(level+1)})'
+
+  def unary(self):
+    pos = self.pos
+    m = self.match(_punct)
+    if m:
+      c = m.group(1)
+      if c == '-': return f'(-{self.unary()})'
+      if c == '~': return f'(~{self.unary()})'
+      if c == '!': return f'(not {self.unary()})'
+      if c == '(':
+        src = self.binary(0)
+        self.expect(')')
+        return src
+      if c == '[':
+        src = self.binary(0)
+        self.expect(']')
+        return f'A[{src} & 0xFFFF]'
+      self.pos = pos
+      self.error('Expecting an operand')
+    return self.operand()
+
+  def operand(self):
+    m = self.match(_number)
+    if m:
+      field = m.group(1)
+      if field[0] == '$': return str(int(field[1:], 16))
+      if field[0] == '%': return str(int(field[1:], 2))
+      if field[0] == '&': return str(int(field[1:]))
+      if field[0] == '@': return str(int(field[1:], 8))
+      return str(int(field[2:], 16))
+
+    m = self.match(_name)
+    if not m:
+      # Hexadecimal numbers may start with a digit
+      m = self.match(re.compile(r'\s*([0-9][0-9A-Za-z_.?]*)'))
+      if not m: self.error('Expecting an operand')
+    name = m.group(1)
+    upper = name.upper()
+    if upper == 'W' and self.text[self.pos:self.pos+1] == '[':
+      self.pos += 1
+      src = self.binary(0)
+      self.expect(']')
+      return f'word({src})'
+    if upper == 'NOT': return f'(not {self.unary()})'
+    if upper in Registers: return Registers[upper]
+    if upper in self.symtab: return str(self.symtab[upper])
+    try: return str(int(name, 16))
+    except ValueError: self.error(f'Unknown symbol "{name}"')
+
+def compileExpr(text, sim):
+  '''Compile the expression 'text' for the SimState 'sim'. Returns a
+  function taking no arguments that evaluates it, and the Python source of
+  the expression. Raises ExprError if the expression is invalid.'''
+  symtab = sim.mapfile.symtab if sim.mapfile else {}
+  src = Parser(text, symtab).parse()
+
+  A = sim.ucMemory.Array
+  def word(addr):
+    addr &= 0xFFFF
+    return A[addr] << 8 | A[addr+1 & 0xFFFF]
+
+  namespace = {'sim': sim, 'st': sim.ucState, 'A': A, 'word': word}
+  try: code = compile(f'lambda: {src}', f'<{text}>', 'eval')
+  except SyntaxError as detail: raise ExprError(f'Unable to compile "{text}": {detail}')
+  return eval(code, namespace), src
+
+def condition(text, sim):
+  '''Return a ucBreakpoint.action that lets the breakpoint hit only when
+  the expression 'text' is true. Raises ExprError if the expression is
+  invalid.'''
+  func, src = compileExpr(text, sim)
+  return lambda br, simstate: func()
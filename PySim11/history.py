@@ -0,0 +1,191 @@
+'''
+Execution history for reverse execution
+
+While recording, the simulator takes a checkpoint (a SimState.snapshot())
+every G.HistoryInterval cycles and keeps the last G.HistorySize of them in a
+ring. With every checkpoint goes a journal of the instructions executed
+since: the cycle each one started on and its PC.
+
+The simulation is deterministic, so any earlier state within the ring is
+reached by restoring the checkpoint before it and running forward again, up
+to the cycle the journal says the target instruction starts on. Going back
+N instructions, back to the last time the PC was at a breakpoint or to a
+given cycle thus costs at most HistoryInterval cycles of simulation. Memory
+use is bounded by the ring size: each checkpoint holds only the memory pages
+changed since the one before it (see ucMemory.snapshotPages()), and its
+journal takes 10 bytes per instruction.
+
+Changes made from the debugger between runs (registers, memory, etc.) are
+picked up by taking an extra checkpoint when the next run starts, as are
+branches forced by trace commands. Resetting the cycle counter clears the
+history.
+
+Virtual functions are called again when running forward from a checkpoint,
+but whatever the simulator writes while doing so is discarded.
+'''
+
+import array
+import collections
+
+from safestruct import *
+
+import PySim11.G as G
+import PySim11.ops as ops
+
+class HistoryError(Exception): pass
+
+class ucCheckpoint(SafeStruct):
+  def __init__(self, snap):
+    super().__init__({
+      'snap': snap,                   # The SimState.snapshot() taken
+      'cycles': array.array('Q'),     # Start cycle of every instruction executed since
+      'pcs': array.array('H')         # PC of every instruction executed since
+    })
+
+class History(SafeStruct):
+  def __init__(self, sim, interval=None, size=None):
+    super().__init__({
+      'sim': sim,
+      'interval': interval or G.HistoryInterval,
+      'checkpoints': collections.deque(maxlen=size or G.HistorySize),
+      'nextCheckpoint': 0,  # Cycle on or after which record() takes a checkpoint
+      'cycles': None,       # Journal of the last checkpoint
+      'pcs': None,
+      'last': None,         # Snapshot taken at the end of the last run
+      'forced': 0           # The current run starts with a forced branch
+    })
+    sim.ucEvents.addHandler(sim.ucEvents.CycReset, self.OnCycReset)
+
+  def close(self):
+    self.sim.ucEvents.removeHandler(self.sim.ucEvents.CycReset, self.OnCycReset)
+
+  def clear(self):
+    self.checkpoints.clear()
+    self.cycles = self.pcs = self.last = None
+    self.nextCheckpoint = 0
+
+  def OnCycReset(self, event): self.clear()
+
+  def checkpoint(self, snap=None):
+    cp = ucCheckpoint(snap or self.sim.snapshot())
+    self.checkpoints.append(cp)
+    self.cycles = cp.cycles
+    self.pcs = cp.pcs
+    self.nextCheckpoint = cp.snap.cycles + self.interval
+
+  def record(self):
+    # Called before every instruction while recording
+    sim = self.sim
+    if sim.cycles >= self.nextCheckpoint: self.checkpoint()
+    self.cycles.append(sim.cycles)
+    self.pcs.append(sim.ucState.PC)
+
+  # SimState.step() calls begin() before a run and end() after it
+
+  def begin(self, forced=0):
+    snap = self.sim.snapshot()
+    if not self.checkpoints or not sameState(snap, self.last): self.checkpoint(snap)
+    # The state after a forced branch can't be reached by running forward,
+    # so take a checkpoint right after it.
+    self.forced = forced
+    if forced: self.nextCheckpoint = self.sim.cycles + 1
+
+  def end(self):
+    snap = self.last = self.sim.snapshot()
+    if self.forced and snap.cycles >= self.nextCheckpoint: self.checkpoint(snap)
+    self.forced = 0
+
+  def oldest(self):
+    'Return the earliest cycle that can be gone back to, or None'
+    if not self.checkpoints: return None
+    return self.checkpoints[0].snap.cycles
+
+  def goToCycle(self, cycle):
+    '''Go back to the start of the first instruction that starts on or after
+    'cycle', which must not be later than the current cycle.'''
+    sim = self.sim
+    if cycle > sim.cycles: raise HistoryError(f'Cycle {cycle} is in the future')
+    if cycle == sim.cycles: return
+
+    cps = self.checkpoints
+    if not cps or cycle < cps[0].snap.cycles:
+      raise HistoryError(f'Cycle {cycle} is before the oldest checkpoint')
+
+    # Everything after the checkpoint is recorded again by running forward
+    while cps[-1].snap.cycles > cycle: cps.pop()
+    cp = cps[-1]
+    del cp.cycles[:]
+    del cp.pcs[:]
+    self.cycles = cp.cycles
+    self.pcs = cp.pcs
+    self.nextCheckpoint = cp.snap.cycles + self.interval
+    sim.restore(cp.snap)
+    self.replay(cycle)
+    self.last = sim.snapshot()
+
+  def stepBack(self, count=1):
+    '''Go back 'count' instructions. Returns the number of instructions
+    actually gone back, which is less if the history doesn't go that far.'''
+    count = min(count, sum(len(cp.cycles) for cp in self.checkpoints))
+    back = count
+    for cp in reversed(self.checkpoints):
+      if back <= len(cp.cycles):
+        if back: self.goToCycle(cp.cycles[-back])
+        break
+      back -= len(cp.cycles)
+    return count
+
+  def runBack(self, addrs, accept=None):
+    '''Go back to the last instruction executed at one of the addresses in
+    the 'addrs' set for which accept(), if given, returns true when called
+    there. Returns 1 if one was found, otherwise goes back to the oldest
+    checkpoint and returns 0.'''
+    while 1:
+      found = None
+      for cp in reversed(self.checkpoints):
+        pcs = cp.pcs
+        for i in range(len(pcs)-1, -1, -1):
+          if pcs[i] in addrs:
+            found = cp.cycles[i]
+            break
+        if found is not None: break
+      if found is None: break
+      # This drops the history from the instruction found on, so that the
+      # next search finds the one before it
+      self.goToCycle(found)
+      if accept is None or accept(): return 1
+    if self.checkpoints: self.goToCycle(self.checkpoints[0].snap.cycles)
+    return 0
+
+  def replay(self, cycle):
+    # Run forward, recording, until the start of the first instruction on
+    # or after 'cycle', as SimState.step() would have (but without stopping
+    # at breakpoints or on SWI, STOP, etc.)
+    sim = self.sim
+    st = sim.ucState
+    virtsubs = {vs.addr: vs.func for vs in sim.VFlist}
+    write = sim.write
+    sim.write = lambda s: None
+    try:
+      while sim.cycles < cycle:
+        func = virtsubs.get(st.PC)
+        if func:
+          func(sim)
+          st.setPC(st.pull16(sim.ucMemory))
+          continue
+
+        self.record()
+        try:
+          op = sim.ifetch()
+          sim.cycles += op[2]
+          sim.iexec(op)
+        except (ops.SWIInstruction, ops.StopInstruction, ops.WaitInstruction,
+                ops.TestInstruction, ops.IllegalOperation):
+          if sim.cycles >= sim.nextEvent: sim.runEvents()
+    finally: sim.write = write
+
+def sameState(a, b):
+  'True if the snapshots a and b hold the same state'
+  if a is None or b is None: return 0
+  return (a.cycles == b.cycles and a.registers == b.registers and a.regbase == b.regbase and
+          a.interrupts == b.interrupts and a.peripherals == b.peripherals and a.pages == b.pages)
@@ -1,17 +1,23 @@
 '''
 Interrupt generation and recognition
 
-The basic operation is as follows. After every instruction is executed
-(with iexec() in PySim11.py) the flush() method of ucInterrupts is called
-to clear all pending interrupts. Then, iexec() invokes each peripheral's
-"udpate" function to possibly generate new interrupts. These are added
-to the intdicts member of ucInterrupts (see the signal() method below
-for an example). The member intdicts is a dictionary so multiple sources
-of the same interrupt don't generate multiple interrupts. Finally,
-iexec() calls nextInt() where interrupt priority resolution takes place.
-This method either returns None if no interrupts are pending (or are
-masked) or it returns one of the integers from 1 to 16 (i.e., from
-XIRQ through SCI) to indicate the interrupt source.
+The basic operation is as follows. Interrupts are level-sensitive: a
+peripheral calls the signal() method of ucInterrupts when one of its
+interrupt sources becomes active (flag set and interrupt enabled) and the
+clear() method when it becomes inactive (flag cleared or interrupt
+disabled). Active sources are kept in the 'pending' bitmask of
+ucInterrupts, where bit N stands for interrupt source N, from XIRQ (1)
+through SCI (16).
+
+Interrupt priority resolution takes place in resolve(), only when
+something it depends on changes: a source being signalled or cleared,
+a write to HPRIO or a change to the I or X bits of the CC register (see
+setMask()). It leaves in the 'ready' member either 0, if no interrupts
+are pending (or are masked), or the integer from 1 to 16 of the interrupt
+to take. Before every instruction, ifetch() (in PySim11.py) only has to
+test 'ready'. Taking an interrupt sets the I bit (and the X bit for XIRQ)
+so a source that stays active doesn't interrupt again until it is
+unmasked.
 '''
 
 import sys
@@ -19,6 +25,8 @@ import string
 
 from safestruct import *
 
+from PySim11.state import CC_X, CC_I
+
 XIRQ = 1
 IRQ  = 2
 RTII = 3
@@ -64,28 +72,54 @@ Vector = {
 class ucInterrupts(SafeStruct):
   def __init__(self):
     super().__init__({
-       'intdict': {}
+       'pending': 0,              # Bit N set if interrupt source N is active
+       'ready': 0,                # Interrupt to take, 0 if none
+       'promoted': Promotions[6], # Source promoted by HPRIO (reset value $06)
+       'ccmask': CC_X | CC_I      # I and X bits of the CC register
     })
 
-  def flush(self): self.intdict = {}
-
-  def nextInt(self, simstate):
-    L = self.intdict.keys()
-    if L:
-      if XIRQ in L: hipri = XIRQ
-      else:
-        promoted = Promotions[simstate.ucMemory.readUns8(simstate.ucMemory.HPRIO) & 0xF]
-        if promoted in L: hipri = promoted
-        else: hipri = min(L)
-
-      if hipri == XIRQ:
-        if not simstate.ucState.isXSet():
-          del self.intdict[hipri]
-          return hipri
-      elif not simstate.ucState.isISet():
-        del self.intdict[hipri]
-        return hipri
+  def flush(self):
+    self.pending = 0
+    self.ready = 0
+
+  def resolve(self):
+    L = self.pending
+    if not L: self.ready = 0
+    elif L & 1 << XIRQ: self.ready = 0 if self.ccmask & CC_X else XIRQ
+    elif self.ccmask & CC_I: self.ready = 0
+    elif L & 1 << self.promoted: self.ready = self.promoted
+    else: self.ready = (L & -L).bit_length() - 1    # Lowest numbered source
+
+  def setMask(self, CC):
+    # Must be called when the I or X bits of the CC register change
+    if CC & (CC_X | CC_I) != self.ccmask:
+      self.ccmask = CC & (CC_X | CC_I)
+      self.resolve()
+
+  def setHPRIO(self, val):
+    self.promoted = Promotions[val & 0xF]
+    self.resolve()
+
+  def writeHPRIO(self, addr, bits, val, rw):
+    # Memory filter for writes to HPRIO
+    if bits == 16: val >>= 8
+    self.setHPRIO(val)
+
+  def refresh(self, simstate):
+    # Picks up changes made to HPRIO or the CC register behind our back,
+    # e.g., from the debugger.
+    self.promoted = Promotions[simstate.ucMemory.readRawUns8(simstate.ucMemory.HPRIO) & 0xF]
+    self.ccmask = simstate.ucState.CC & (CC_X | CC_I)
+    self.resolve()
 
   def signal(self, sig):
     assert 1 <= sig <= 16
-    self.intdict[sig] = 1
+    if not self.pending & 1 << sig:
+      self.pending |= 1 << sig
+      self.resolve()
+
+  def clear(self, sig):
+    assert 1 <= sig <= 16
+    if self.pending & 1 << sig:
+      self.pending &= ~(1 << sig)
+      self.resolve()
@@ -4,11 +4,19 @@ Abstraction for 16-bit addressed 8-bit data memory of 68HC11
 
 import sys
 import string
+import struct
 import operator
 
 from safestruct import *
 
-import PySim11.math11
+import PySim11.math11 as math11
+
+# Big-endian 16-bit access to the memory array
+_unpack16 = struct.Struct('>H').unpack_from
+_pack16 = struct.Struct('>H').pack_into
+
+# Number of 256-byte pages in the address space
+PageCount = 256
 
 printableInts = {}
 map(operator.setitem, [printableInts]*len(string.printable), \
@@ -88,10 +96,14 @@ class ucMemory(SafeStruct):
     super().__init__({
         'LowLimit': 0,
         'HighLimit': 65535,
-        'Array': [0]*65536,
+        'Array': bytearray(65536),
         'Filters': [],
-        'FilterAddressHash': {},
-        'RegBase': 0x1000
+        'PageMap': bytearray(256),  # Non-zero for 256-byte pages with filters, zero for plain RAM
+        'ReadPages': [None]*256,    # For pages with filters, a list of 256 tuples of read handlers
+        'WritePages': [None]*256,   # Same, for write handlers
+        'RegBase': 0x1000,
+        'CodeMap': bytearray(65536), # Non-zero for bytes holding cached, pre-decoded code
+        'CodeWriteHandler': None     # Called as f(addr, bits) on writes to such bytes
       })
     self.mapRegisters()
     self.reset()
@@ -110,14 +122,11 @@ class ucMemory(SafeStruct):
   def mapRegisters(self, base=0x1000):
     oldLow = self.RegBase
     oldHigh = oldLow + 0x3F
-    self.FilterAddressHash = {}
     for f in self.Filters:
       if oldLow <= f.ALow <= oldHigh:
         f.ALow += base - oldLow
         f.AHigh += base - oldLow
-        for addr in range(f.ALow, f.AHigh+1):
-          try: self.FilterAddressHash[addr].append(f)
-          except: self.FilterAddressHash[addr] = [f]
+    self.buildIOMap()
 
     self.RegBase = base
 
@@ -127,8 +136,10 @@ class ucMemory(SafeStruct):
     self.add_attributes(regdict)
 
     if oldLow != base:
+      for addr in list(range(oldLow, oldLow+0x40)) + list(range(base, base+0x40)):
+        if self.CodeMap[addr]: self.CodeWriteHandler(addr, 8)
       self.Array[base:base+0x40] = self.Array[oldLow:oldLow+0x40]
-      self.Array[oldLow:oldLow+0x40] = [0]*0x40
+      self.Array[oldLow:oldLow+0x40] = bytes(0x40)
 
   def readINIT(self, addr, bits, val, rw):
     val = self.readRawUns8(self.INIT) & 0xF0
@@ -143,144 +154,178 @@ class ucMemory(SafeStruct):
 
   def addFilter(self, f):
     self.Filters.append(f)
-    for addr in range (f.ALow, f.AHigh+1):
-      try: self.FilterAddressHash[addr].append(f)
-      except: self.FilterAddressHash[addr] = [f]
-
-  def _applyReadHandlers(self, addr, bits):
-    handlers = self.FilterAddressHash[addr]
+    self.buildIOMap()
+
+  def removeFilter(self, f):
+    self.Filters.remove(f)
+    self.buildIOMap()
+
+  # Builds the page map from the list of filters. For every address
+  # in a page that has filters, the handlers to call on a read or write
+  # are flattened into a tuple, in the order the filters were added
+  # and with the read/write handler of a filter before its read-only or
+  # write-only handler.
+  def buildIOMap(self):
+    self.PageMap = bytearray(256)
+    self.ReadPages = [None]*256
+    self.WritePages = [None]*256
 
-    for f in handlers:
-      if f.RWHandler:
-        f.RWHandler(*(addr, bits, 0, 0)) # The last 0 indicates READ
+    for f in self.Filters:
+      for addr in range(f.ALow, f.AHigh+1):
+        page = addr >> 8
+        if not self.PageMap[page]:
+          self.PageMap[page] = 1
+          self.ReadPages[page] = [()]*256
+          self.WritePages[page] = [()]*256
+
+        readers = [h for h in (f.RWHandler, f.ROHandler) if h]
+        writers = [h for h in (f.RWHandler, f.WOHandler) if h]
+        self.ReadPages[page][addr & 0xFF] += tuple(readers)
+        self.WritePages[page][addr & 0xFF] += tuple(writers)
 
-      if f.ROHandler:
-        f.ROHandler(*(addr, bits, 0, 0)) # The last 0 indicates READ
+  def _applyReadHandlers(self, addr, bits):
+    for h in self.ReadPages[addr >> 8][addr & 0xFF]:
+      h(addr, bits, 0, 0)   # The last 0 indicates READ
 
   def _applyWriteHandlers(self, addr, bits, val):
-    handlers = self.FilterAddressHash[addr]
-
-    for f in handlers:
-      if f.RWHandler: f.RWHandler(*(addr, bits, val, 1)) # The last 1 indicates WRITE
-      if f.WOHandler: f.WOHandler(*(addr, bits, val, 1)) # The last 1 indicates WRITE
+    for h in self.WritePages[addr >> 8][addr & 0xFF]:
+      h(addr, bits, val, 1) # The last 1 indicates WRITE
+
+  # A memory snapshot is a tuple of PageCount bytes objects, one per 256-byte
+  # page. Snapshots taken one after the other share the pages that didn't
+  # change in between, so that only the pages written to are copied.
+
+  def snapshotPages(self, base=None):
+    '''Return the memory contents as a snapshot. Pages equal to those of the
+    snapshot 'base', if given, are shared with it rather than copied.'''
+    pages = []
+    with memoryview(self.Array) as mv:
+      for page in range(PageCount):
+        data = mv[page << 8:(page+1) << 8]
+        if base is not None and data == base[page]: pages.append(base[page])
+        else: pages.append(data.tobytes())
+    return tuple(pages)
+
+  def restorePages(self, pages):
+    '''Set the memory contents from a snapshot. Only the pages that differ
+    are written, invalidating any cached code they hold.'''
+    Array = self.Array
+    CodeMap = self.CodeMap
+    with memoryview(Array) as mv:
+      for page in range(PageCount):
+        low = page << 8
+        high = low + 256
+        if mv[low:high] == pages[page]: continue
+        if any(CodeMap[low:high]):
+          for addr in range(low, high):
+            if CodeMap[addr]: self.CodeWriteHandler(addr, 8)
+        Array[low:high] = pages[page]
+
+  # Bulk accessors, for loading program images. They don't call the
+  # filters' handlers, as the memory is programmed rather than written to
+  # by the CPU.
+
+  def writeBlock(self, addr, data):
+    '''Copy the bytes 'data' to memory from 'addr', invalidating any cached
+    code they overwrite.'''
+    end = addr + len(data)
+    assert self.LowLimit <= addr and end <= self.HighLimit+1
+    CodeMap = self.CodeMap
+    if any(CodeMap[addr:end]):
+      for a in range(addr, end):
+        if CodeMap[a]: self.CodeWriteHandler(a, 8)
+    self.Array[addr:end] = data
+
+  def compareBlock(self, addr, data):
+    '''Return the first address from 'addr' where memory differs from the
+    bytes 'data', or None if it holds them.'''
+    end = addr + len(data)
+    assert self.LowLimit <= addr and end <= self.HighLimit+1
+    with memoryview(self.Array) as mv:
+      if mv[addr:end] == data: return None
+    Array = self.Array
+    for i in range(len(data)):
+      if Array[addr+i] != data[i]: return addr+i
 
   def readRawTuple8(self, addrLo, addrHi):
     assert self.LowLimit <= addrLo <= addrHi <= self.HighLimit
     return tuple(self.Array[addrLo:(addrHi+1)])
 
-  def readUns8(self, addr):
-    assert self.LowLimit <= addr <= self.HighLimit
+  # The accessors below don't check their arguments, which the CPU always
+  # passes in range: an address above $FFFF or a value out of range raises
+  # IndexError, ValueError or struct.error from the underlying bytearray,
+  # but a negative address silently indexes from the end of it (e.g., -1
+  # is $FFFF), as Python sequences do. The only 16-bit access that doesn't
+  # fit in the array is the one at $FFFF, which wraps around to $0000.
 
-    if addr in self.FilterAddressHash: self._applyReadHandlers(addr, 8)
+  def readUns8(self, addr):
+    if self.PageMap[addr >> 8]: self._applyReadHandlers(addr, 8)
     return self.Array[addr]
 
   def readSgn8(self, addr):
-    assert self.LowLimit <= addr <= self.HighLimit
-
-    if addr in self.FilterAddressHash: self._applyReadHandlers(addr, 8)
+    if self.PageMap[addr >> 8]: self._applyReadHandlers(addr, 8)
     return math11.TwosC8ToInt(self.Array[addr])
 
   def readUns16(self, addr):
-    assert self.LowLimit <= addr <= self.HighLimit
-
-    if addr in self.FilterAddressHash: self._applyReadHandlers(addr, 16)
-    if addr < self.HighLimit: val = (self.Array[addr]<<8) + self.Array[addr+1]
-    else: val = (self.Array[addr]<<8) + self.Array[0]
-    return val
+    if self.PageMap[addr >> 8]: self._applyReadHandlers(addr, 16)
+    if addr != 0xFFFF: return _unpack16(self.Array, addr)[0]
+    return self.Array[0xFFFF]<<8 | self.Array[0]
 
   def readSgn16(self, addr):
-    assert self.LowLimit <= addr <= self.HighLimit
-
-    if addr in self.FilterAddressHash: self._applyReadHandlers(addr, 16)
-    if addr < self.HighLimit: val = (self.Array[addr]<<8) + self.Array[addr+1]
-    else: val = (self.Array[addr]<<8) + self.Array[0]
-    return math11.TwosC16ToInt(val)
+    return math11.TwosC16ToInt(self.readUns16(addr))
 
   def readRawUns8(self, addr):
-    assert self.LowLimit <= addr <= self.HighLimit
-
     return self.Array[addr]
 
   def readRawSgn8(self, addr):
-    assert self.LowLimit <= addr <= self.HighLimit
-
     return math11.TwosC8ToInt(self.Array[addr])
 
   def readRawUns16(self, addr):
-    assert self.LowLimit <= addr <= self.HighLimit
-
-    if addr < self.HighLimit: val = (self.Array[addr]<<8) + self.Array[addr+1]
-    else: val = (self.Array[addr]<<8) + self.Array[0]
-    return val
+    if addr != 0xFFFF: return _unpack16(self.Array, addr)[0]
+    return self.Array[0xFFFF]<<8 | self.Array[0]
 
   def readRawSgn16(self, addr):
-    assert self.LowLimit <= addr <= self.HighLimit
-
-    if addr < self.HighLimit: val = (self.Array[addr]<<8) + self.Array[addr+1]
-    else: val = (self.Array[addr]<<8) + self.Array[0]
-    return math11.TwosC16ToInt(val)
+    return math11.TwosC16ToInt(self.readRawUns16(addr))
 
   def writeUns8(self, addr, val):
-    assert self.LowLimit <= addr <= self.HighLimit
-    assert 0 <= val <= 255
-
-    if addr in self.FilterAddressHash: self._applyWriteHandlers(addr, 8, val)
+    if self.PageMap[addr >> 8]: self._applyWriteHandlers(addr, 8, val)
+    if self.CodeMap[addr]: self.CodeWriteHandler(addr, 8)
     self.Array[addr] = val
 
   def writeSgn8(self, addr, val):
-    assert self.LowLimit <= addr <= self.HighLimit
     assert -128 <= val <= 127
-
-    if addr in self.FilterAddressHash: self._applyWriteHandlers(addr, 8, val)
-    self.Array[addr] = math11.IntToTwosC8(val)
+    if self.PageMap[addr >> 8]: self._applyWriteHandlers(addr, 8, val)
+    self.writeRawUns8(addr, val & 0xFF)
 
   def writeUns16(self, addr, val):
-    assert self.LowLimit <= addr <= self.HighLimit
-    assert 0 <= val <= 65535
-
-    if addr in self.FilterAddressHash: self._applyWriteHandlers(addr, 16, val)
-    self.Array[addr] = val >> 8
-    if addr < self.HighLimit: self.Array[addr+1] = val & 0xFF
-    else: self.Array[0] = val & 0xFF
+    if self.PageMap[addr >> 8]: self._applyWriteHandlers(addr, 16, val)
+    self.writeRawUns16(addr, val)
 
   def writeSgn16(self, addr, val):
-    assert self.LowLimit <= addr <= self.HighLimit
     assert -32768 <= val <= 32767
-
-    if addr in self.FilterAddressHash: self._applyWriteHandlers(addr, 16, val)
-    val = math11.IntToTwosC16(val)
-    self.Array[addr] = val >> 8
-    if addr < self.HighLimit: self.Array[addr+1] = val & 0xFF
-    else: self.Array[0] = val & 0xFF
+    if self.PageMap[addr >> 8]: self._applyWriteHandlers(addr, 16, val)
+    self.writeRawUns16(addr, val & 0xFFFF)
 
   def writeRawUns8(self, addr, val):
-    assert self.LowLimit <= addr <= self.HighLimit
-    assert 0 <= val <= 255
-
+    if self.CodeMap[addr]: self.CodeWriteHandler(addr, 8)
     self.Array[addr] = val
 
   def writeRawSgn8(self, addr, val):
-    assert self.LowLimit <= addr <= self.HighLimit
     assert -128 <= val <= 127
-
-    self.Array[addr] = math11.IntToTwosC8(val)
+    self.writeRawUns8(addr, val & 0xFF)
 
   def writeRawUns16(self, addr, val):
-    assert self.LowLimit <= addr <= self.HighLimit
-    assert 0 <= val <= 65535
-
-    self.Array[addr] = val >> 8
-    if addr < self.HighLimit: self.Array[addr+1] = val & 0xFF
-    else: self.Array[0] = val & 0xFF
+    if addr != 0xFFFF:
+      if self.CodeMap[addr] or self.CodeMap[addr+1]: self.CodeWriteHandler(addr, 16)
+      _pack16(self.Array, addr, val)
+    else:
+      if self.CodeMap[0xFFFF] or self.CodeMap[0]: self.CodeWriteHandler(addr, 16)
+      self.Array[0xFFFF] = val >> 8
+      self.Array[0] = val & 0xFF
 
   def writeRawSgn16(self, addr, val):
-    assert self.LowLimit <= addr <= self.HighLimit
     assert -32768 <= val <= 32767
-
-    val = math11.IntToTwosC16(val)
-    self.Array[addr] = val >> 8
-    if addr < self.HighLimit: self.Array[addr+1] = val & 0xFF
-    else: self.Array[0] = val & 0xFF
+    self.writeRawUns16(addr, val & 0xFFFF)
 
   def displayAscii(self, skip, addrLow, addrHigh, write):
     if skip: write(' '*skip)
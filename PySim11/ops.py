@@ -2,7 +2,7 @@
 68HC11 instruction set implementation
 '''
 
-from PySim11.G import UseSWI
+from PySim11.G import UseSWI, UseALUTables
 from PySim11.state import CC_S, CC_X, CC_I, CC_H, CC_N, CC_V, CC_Z, CC_C
 from PySim11 import BFORCE_ALWAYS,BFORCE_NEVER
 
@@ -529,10 +529,63 @@ def eor8(u1, u2):
   if not result & 0xFF: flags |= CC_Z
   return (result, flags)
 
+def daa(A, c, h):
+  "Decimal adjust 8-bit value given the carry and half-carry flags"
+  uhb = A >> 4 & 0x0F
+  lhb = A & 0x0F
+
+  offset = cout = 0
+  if c == 0 and h == 0:
+    if uhb <= 9 and lhb <= 9:
+      pass
+    elif uhb <= 8 and lhb >= 10:
+      offset = 0x06
+    elif uhb >= 10 and lhb <= 9:
+      offset = 0x60
+      cout = 1
+    elif uhb >= 9 and lhb >= 10:
+      offset = 0x66
+      cout = 1
+  elif c == 0 and h == 1:
+    if uhb <= 9 and lhb <= 3:
+      offset = 0x06
+    elif uhb >= 10 and lhb <= 3:
+      offset = 0x66
+      cout = 1
+  elif c == 1 and h == 0:
+    if uhb <= 2 and lhb <= 9:
+      offset = 0x60
+      cout = 1
+    elif uhb <= 2 and lhb >= 10:
+      offset = 0x66
+      cout = 1
+  elif uhb <= 3 and lhb <= 3:
+    offset = 0x66
+    cout = 1
+
+  result = A + offset & 0xFF
+  return (result, testNZ8(result) | cout * CC_C)
+
+# The helpers above, as computed. With G.UseALUTables, the module-level
+# names are rebound to table lookups that give the same results (see
+# alu.py) once all the handlers are defined.
+ReferenceALU = {name: globals()[name] for name in
+  ('add8', 'sub8', 'and8', 'or8', 'eor8', 'asl8', 'asr8', 'lsr8', 'rol8', 'ror8', 'neg8', 'daa')}
+
+# CC bits set by the ALU instructions. These pass their operands and the
+# helper above that computes their flags to ucState.lazyFlags() rather than
+# computing the flags themselves. Loads, stores and transfers set N and Z
+# from the value and clear V, which is exactly what adding 0 to it does.
+# Likewise, TST is a subtraction of 0.
+HNZVC = CC_H | CC_N | CC_Z | CC_V | CC_C
+NZVC = CC_N | CC_Z | CC_V | CC_C
+NZV = CC_N | CC_Z | CC_V
+
 def ABA(simstate):
-  A, flags = add8(simstate.ucState.A, simstate.ucState.B)
-  simstate.ucState.setA(A)
-  simstate.ucState.setHNZVC(flags)
+  A = simstate.ucState.A
+  B = simstate.ucState.B
+  simstate.ucState.setA(A + B & 0xFF)
+  simstate.ucState.lazyFlags(HNZVC, add8, A, B)
 
 def ABX(simstate):
   X = simstate.ucState.X + simstate.ucState.B & 0xFFFF
@@ -543,60 +596,48 @@ def ABY(simstate):
   simstate.ucState.setY(Y)
 
 def ADCA(simstate, addr, value):
-  if addr is None:
-    A, flags = add8(simstate.ucState.A, value + simstate.ucState.isCarrySet())
-  else:
-    A, flags = add8(simstate.ucState.A, simstate.ucMemory.readUns8(addr) + simstate.ucState.isCarrySet())
-  simstate.ucState.setA(A)
-  simstate.ucState.setHNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  value += simstate.ucState.isCarrySet()
+  A = simstate.ucState.A
+  simstate.ucState.setA(A + value & 0xFF)
+  simstate.ucState.lazyFlags(HNZVC, add8, A, value)
 
 def ADCB(simstate, addr, value):
-  if addr is None:
-    B, flags = add8(simstate.ucState.B, value + simstate.ucState.isCarrySet())
-  else:
-    B, flags = add8(simstate.ucState.B, simstate.ucMemory.readUns8(addr) + simstate.ucState.isCarrySet())
-  simstate.ucState.setB(B)
-  simstate.ucState.setHNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  value += simstate.ucState.isCarrySet()
+  B = simstate.ucState.B
+  simstate.ucState.setB(B + value & 0xFF)
+  simstate.ucState.lazyFlags(HNZVC, add8, B, value)
 
 def ADDA(simstate, addr, value):
-  if addr is None:
-    A, flags = add8(simstate.ucState.A, value)
-  else:
-    A, flags = add8(simstate.ucState.A, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setA(A)
-  simstate.ucState.setHNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  A = simstate.ucState.A
+  simstate.ucState.setA(A + value & 0xFF)
+  simstate.ucState.lazyFlags(HNZVC, add8, A, value)
 
 def ADDB(simstate, addr, value):
-  if addr is None:
-    B, flags = add8(simstate.ucState.B, value)
-  else:
-    B, flags = add8(simstate.ucState.B, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setB(B)
-  simstate.ucState.setHNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  B = simstate.ucState.B
+  simstate.ucState.setB(B + value & 0xFF)
+  simstate.ucState.lazyFlags(HNZVC, add8, B, value)
 
 def ADDD(simstate, addr, value):
-  if addr is None:
-    D, flags = add16(simstate.ucState.D(), value)
-  else:
-    D, flags = add16(simstate.ucState.D(), simstate.ucMemory.readUns16(addr))
-  simstate.ucState.setD(D)
-  simstate.ucState.setNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns16(addr)
+  D = simstate.ucState.D()
+  simstate.ucState.setD(D + value & 0xFFFF)
+  simstate.ucState.lazyFlags(NZVC, add16, D, value)
 
 def ANDA(simstate, addr, value):
-  if addr is None:
-    A, flags = and8(simstate.ucState.A, value)
-  else:
-    A, flags = and8(simstate.ucState.A, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setA(A)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  A = simstate.ucState.A
+  simstate.ucState.setA(A & value)
+  simstate.ucState.lazyFlags(NZV, and8, A, value)
 
 def ANDB(simstate, addr, value):
-  if addr is None:
-    B, flags = and8(simstate.ucState.B, value)
-  else:
-    B, flags = and8(simstate.ucState.B, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setB(B)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  B = simstate.ucState.B
+  simstate.ucState.setB(B & value)
+  simstate.ucState.lazyFlags(NZV, and8, B, value)
 
 def ASL(simstate, addr, value):
   M, flags = asl8(simstate.ucMemory.readUns8(addr))
@@ -655,18 +696,12 @@ def BHS(simstate, addr):
   branchIf(simstate, not simstate.ucState.isCarrySet(), addr)
 
 def BITA(simstate, addr, value):
-  if addr is None:
-    M, flags = and8(simstate.ucState.A, value)
-  else:
-    M, flags = and8(simstate.ucState.A, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  simstate.ucState.lazyFlags(NZV, and8, simstate.ucState.A, value)
 
 def BITB(simstate, addr, value):
-  if addr is None:
-    M, flags = and8(simstate.ucState.B, value)
-  else:
-    M, flags = and8(simstate.ucState.B, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  simstate.ucState.lazyFlags(NZV, and8, simstate.ucState.B, value)
 
 def BLE(simstate, addr):
   branchIf(simstate, (simstate.ucState.isNegativeSet() ^ simstate.ucState.isOverflowSet()) | simstate.ucState.isZeroSet(), addr)
@@ -716,12 +751,13 @@ def BVS(simstate, addr):
   branchIf(simstate, simstate.ucState.isOverflowSet(), addr)
 
 def CBA(simstate):
-  diff, flags = sub8(simstate.ucState.A, simstate.ucState.B)
-  simstate.ucState.setNZVC(flags)
+  simstate.ucState.lazyFlags(NZVC, sub8, simstate.ucState.A, simstate.ucState.B)
 
 def CLC(simstate): simstate.ucState.setC(0)
 
-def CLI(simstate): simstate.ucState.setI(0)
+def CLI(simstate):
+  simstate.ucState.setI(0)
+  simstate.ucInterrupts.setMask(simstate.ucState.CC)
 
 def CLR(simstate, addr, value):
   simstate.ucMemory.writeUns8(addr, 0)
@@ -738,18 +774,12 @@ def CLRB(simstate):
 def CLV(simstate): simstate.ucState.setV(0)
 
 def CMPA(simstate, addr, value):
-  if addr is None:
-    M, flags = sub8(simstate.ucState.A, value)
-  else:
-    M, flags = sub8(simstate.ucState.A, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  simstate.ucState.lazyFlags(NZVC, sub8, simstate.ucState.A, value)
 
 def CMPB(simstate, addr, value):
-  if addr is None:
-    M, flags = sub8(simstate.ucState.B, value)
-  else:
-    M, flags = sub8(simstate.ucState.B, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  simstate.ucState.lazyFlags(NZVC, sub8, simstate.ucState.B, value)
 
 def COM(simstate, addr, value):
   M = ~simstate.ucMemory.readUns8(addr) & 0xFF
@@ -766,40 +796,31 @@ def COMB(simstate):
   simstate.ucState.setNZVC(testNZ8(simstate.ucState.B) | CC_C)
 
 def CPD(simstate, addr, value):
-  if addr is None:
-    M, flags = sub16(simstate.ucState.D(), value)
-  else:
-    M, flags = sub16(simstate.ucState.D(), simstate.ucMemory.readUns16(addr))
-  simstate.ucState.setNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns16(addr)
+  simstate.ucState.lazyFlags(NZVC, sub16, simstate.ucState.D(), value)
 
 def CPX(simstate, addr, value):
-  if addr is None:
-    M, flags = sub16(simstate.ucState.X, value)
-  else:
-    M, flags = sub16(simstate.ucState.X, simstate.ucMemory.readUns16(addr))
-  simstate.ucState.setNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns16(addr)
+  simstate.ucState.lazyFlags(NZVC, sub16, simstate.ucState.X, value)
 
 def CPY(simstate, addr, value):
-  if addr is None:
-    M, flags = sub16(simstate.ucState.Y, value)
-  else:
-    M, flags = sub16(simstate.ucState.Y, simstate.ucMemory.readUns16(addr))
-  simstate.ucState.setNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns16(addr)
+  simstate.ucState.lazyFlags(NZVC, sub16, simstate.ucState.Y, value)
 
 def DEC(simstate, addr, value):
-  M, flags = sub8(simstate.ucMemory.readUns8(addr), 1)
-  simstate.ucMemory.writeUns8(addr, M)
-  simstate.ucState.setNZV(flags)
+  M = simstate.ucMemory.readUns8(addr)
+  simstate.ucMemory.writeUns8(addr, M - 1 & 0xFF)
+  simstate.ucState.lazyFlags(NZV, sub8, M, 1)
 
 def DECA(simstate):
-  A, flags = sub8(simstate.ucState.A, 1)
-  simstate.ucState.setA(A)
-  simstate.ucState.setNZV(flags)
+  A = simstate.ucState.A
+  simstate.ucState.setA(A - 1 & 0xFF)
+  simstate.ucState.lazyFlags(NZV, sub8, A, 1)
 
 def DECB(simstate):
-  B, flags = sub8(simstate.ucState.B, 1)
-  simstate.ucState.setB(B)
-  simstate.ucState.setNZV(flags)
+  B = simstate.ucState.B
+  simstate.ucState.setB(B - 1 & 0xFF)
+  simstate.ucState.lazyFlags(NZV, sub8, B, 1)
 
 def DES(simstate):
   S = simstate.ucState.SP - 1 & 0xFFFF
@@ -820,35 +841,31 @@ def DEY(simstate):
   simstate.ucState.setZ(flags)
 
 def EORA(simstate, addr, value):
-  if addr is None:
-    A, flags = eor8(simstate.ucState.A, value)
-  else:
-    A, flags = eor8(simstate.ucState.A, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setA(A)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  A = simstate.ucState.A
+  simstate.ucState.setA(A ^ value)
+  simstate.ucState.lazyFlags(NZV, eor8, A, value)
 
 def EORB(simstate, addr, value):
-  if addr is None:
-    B, flags = eor8(simstate.ucState.B, value)
-  else:
-    B, flags = eor8(simstate.ucState.B, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setB(B)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  B = simstate.ucState.B
+  simstate.ucState.setB(B ^ value)
+  simstate.ucState.lazyFlags(NZV, eor8, B, value)
 
 def INC(simstate, addr, value):
-  M, flags = add8(simstate.ucMemory.readUns8(addr), 1)
-  simstate.ucMemory.writeUns8(addr, M)
-  simstate.ucState.setNZV(flags)
+  M = simstate.ucMemory.readUns8(addr)
+  simstate.ucMemory.writeUns8(addr, M + 1 & 0xFF)
+  simstate.ucState.lazyFlags(NZV, add8, M, 1)
 
 def INCA(simstate):
-  A, flags = add8(simstate.ucState.A, 1)
-  simstate.ucState.setA(A)
-  simstate.ucState.setNZV(flags)
+  A = simstate.ucState.A
+  simstate.ucState.setA(A + 1 & 0xFF)
+  simstate.ucState.lazyFlags(NZV, add8, A, 1)
 
 def INCB(simstate):
-  B, flags = add8(simstate.ucState.B, 1)
-  simstate.ucState.setB(B)
-  simstate.ucState.setNZV(flags)
+  B = simstate.ucState.B
+  simstate.ucState.setB(B + 1 & 0xFF)
+  simstate.ucState.lazyFlags(NZV, add8, B, 1)
 
 def INS(simstate):
   S = simstate.ucState.SP + 1 & 0xFFFF
@@ -876,46 +893,34 @@ def JSR(simstate, addr, value):
   simstate.ucState.setPC(addr)
 
 def LDAA(simstate, addr, value):
-  if addr is None: A = value
-  else: A = simstate.ucMemory.readUns8(addr)
-  flags = testNZ8(A)
-  simstate.ucState.setA(A)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  simstate.ucState.setA(value)
+  simstate.ucState.lazyFlags(NZV, add8, value, 0)
 
 def LDAB(simstate, addr, value):
-  if addr is None: B = value
-  else: B = simstate.ucMemory.readUns8(addr)
-  flags = testNZ8(B)
-  simstate.ucState.setB(B)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  simstate.ucState.setB(value)
+  simstate.ucState.lazyFlags(NZV, add8, value, 0)
 
 def LDD(simstate, addr, value):
-  if addr is None: D = value
-  else: D = simstate.ucMemory.readUns16(addr)
-  flags = testNZ16(D)
-  simstate.ucState.setD(D)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns16(addr)
+  simstate.ucState.setD(value)
+  simstate.ucState.lazyFlags(NZV, add16, value, 0)
 
 def LDS(simstate, addr, value):
-  if addr is None: D = value
-  else: D = simstate.ucMemory.readUns16(addr)
-  flags = testNZ16(D)
-  simstate.ucState.setSP(D)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns16(addr)
+  simstate.ucState.setSP(value)
+  simstate.ucState.lazyFlags(NZV, add16, value, 0)
 
 def LDX(simstate, addr, value):
-  if addr is None: D = value
-  else: D = simstate.ucMemory.readUns16(addr)
-  flags = testNZ16(D)
-  simstate.ucState.setX(D)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns16(addr)
+  simstate.ucState.setX(value)
+  simstate.ucState.lazyFlags(NZV, add16, value, 0)
 
 def LDY(simstate, addr, value):
-  if addr is None: D = value
-  else: D = simstate.ucMemory.readUns16(addr)
-  flags = testNZ16(D)
-  simstate.ucState.setY(D)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns16(addr)
+  simstate.ucState.setY(value)
+  simstate.ucState.lazyFlags(NZV, add16, value, 0)
 
 def LSLD(simstate):
   D,flags = asl16(simstate.ucState.D())
@@ -960,20 +965,16 @@ def NEGB(simstate):
 def NOP(simstate): pass
 
 def ORAA(simstate, addr, value):
-  if addr is None:
-    A, flags = or8(simstate.ucState.A, value)
-  else:
-    A, flags = or8(simstate.ucState.A, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setA(A)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  A = simstate.ucState.A
+  simstate.ucState.setA(A | value)
+  simstate.ucState.lazyFlags(NZV, or8, A, value)
 
 def ORAB(simstate, addr, value):
-  if addr is None:
-    B, flags = or8(simstate.ucState.B, value)
-  else:
-    B, flags = or8(simstate.ucState.B, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setB(B)
-  simstate.ucState.setNZV(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  B = simstate.ucState.B
+  simstate.ucState.setB(B | value)
+  simstate.ucState.lazyFlags(NZV, or8, B, value)
 
 def PSHA(simstate):
   simstate.ucState.push8(simstate.ucMemory, simstate.ucState.A)
@@ -1041,92 +1042,88 @@ def RTI(simstate):
   # but is allowed to go from 1 to 0.
   oldCC = simstate.ucState.CC
   simstate.ucState.setCC(oldCC & newCC & CC_X | newCC & ~CC_X)
+  simstate.ucInterrupts.setMask(simstate.ucState.CC)
 
 def RTS(simstate):
   simstate.ucState.setPC(simstate.ucState.pull16(simstate.ucMemory))
 
 def SBA(simstate):
-  diff, flags = sub8(simstate.ucState.A, simstate.ucState.B)
-  simstate.ucState.setA(diff)
-  simstate.ucState.setNZVC(flags)
+  A = simstate.ucState.A
+  B = simstate.ucState.B
+  simstate.ucState.setA(A - B & 0xFF)
+  simstate.ucState.lazyFlags(NZVC, sub8, A, B)
 
 def SBCA(simstate, addr, value):
-  if addr is None:
-    A, flags = sub8(simstate.ucState.A, value + simstate.ucState.isCarrySet())
-  else:
-    A, flags = sub8(simstate.ucState.A, simstate.ucMemory.readUns8(addr) + simstate.ucState.isCarrySet())
-  simstate.ucState.setA(A)
-  simstate.ucState.setNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  value += simstate.ucState.isCarrySet()
+  A = simstate.ucState.A
+  simstate.ucState.setA(A - value & 0xFF)
+  simstate.ucState.lazyFlags(NZVC, sub8, A, value)
 
 def SBCB(simstate, addr, value):
-  if addr is None:
-    B, flags = sub8(simstate.ucState.B, value + simstate.ucState.isCarrySet())
-  else:
-    B, flags = sub8(simstate.ucState.B, simstate.ucMemory.readUns8(addr) + simstate.ucState.isCarrySet())
-  simstate.ucState.setB(B)
-  simstate.ucState.setNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  value += simstate.ucState.isCarrySet()
+  B = simstate.ucState.B
+  simstate.ucState.setB(B - value & 0xFF)
+  simstate.ucState.lazyFlags(NZVC, sub8, B, value)
 
 def SEC(simstate): simstate.ucState.setC(CC_C)
-def SEI(simstate): simstate.ucState.setI(CC_I)
+def SEI(simstate):
+  simstate.ucState.setI(CC_I)
+  simstate.ucInterrupts.setMask(simstate.ucState.CC)
 def SEV(simstate): simstate.ucState.setV(CC_V)
 
 def STAA(simstate, addr, value):
-  simstate.ucMemory.writeUns8(addr, simstate.ucState.A)
-  flags = testNZ8(simstate.ucState.A)
-  simstate.ucState.setNZV(flags)
+  A = simstate.ucState.A
+  simstate.ucMemory.writeUns8(addr, A)
+  simstate.ucState.lazyFlags(NZV, add8, A, 0)
 
 def STAB(simstate, addr, value):
-  simstate.ucMemory.writeUns8(addr, simstate.ucState.B)
-  flags = testNZ8(simstate.ucState.B)
-  simstate.ucState.setNZV(flags)
+  B = simstate.ucState.B
+  simstate.ucMemory.writeUns8(addr, B)
+  simstate.ucState.lazyFlags(NZV, add8, B, 0)
 
 def STD(simstate, addr, value):
-  simstate.ucMemory.writeUns16(addr, simstate.ucState.D())
-  flags = testNZ16(simstate.ucState.D())
-  simstate.ucState.setNZV(flags)
+  D = simstate.ucState.D()
+  simstate.ucMemory.writeUns16(addr, D)
+  simstate.ucState.lazyFlags(NZV, add16, D, 0)
 
 def STOP(simstate):
   if simstate.ucState.isStopSet(): return
   raise StopInstruction
 
 def STS(simstate, addr, value):
-  simstate.ucMemory.writeUns16(addr, simstate.ucState.SP)
-  flags = testNZ16(simstate.ucState.SP)
-  simstate.ucState.setNZV(flags)
+  SP = simstate.ucState.SP
+  simstate.ucMemory.writeUns16(addr, SP)
+  simstate.ucState.lazyFlags(NZV, add16, SP, 0)
 
 def STX(simstate, addr, value):
-  simstate.ucMemory.writeUns16(addr, simstate.ucState.X)
-  flags = testNZ16(simstate.ucState.X)
-  simstate.ucState.setNZV(flags)
+  X = simstate.ucState.X
+  simstate.ucMemory.writeUns16(addr, X)
+  simstate.ucState.lazyFlags(NZV, add16, X, 0)
 
 def STY(simstate, addr, value):
-  simstate.ucMemory.writeUns16(addr, simstate.ucState.Y)
-  flags = testNZ16(simstate.ucState.Y)
-  simstate.ucState.setNZV(flags)
+  Y = simstate.ucState.Y
+  simstate.ucMemory.writeUns16(addr, Y)
+  simstate.ucState.lazyFlags(NZV, add16, Y, 0)
 
 def SUBA(simstate, addr, value):
-  if addr is None:
-    A, flags = sub8(simstate.ucState.A, value)
-  else:
-    A, flags = sub8(simstate.ucState.A, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setA(A)
-  simstate.ucState.setNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  A = simstate.ucState.A
+  simstate.ucState.setA(A - value & 0xFF)
+  simstate.ucState.lazyFlags(NZVC, sub8, A, value)
 
 def SUBB(simstate, addr, value):
-  if addr is None:
-    B, flags = sub8(simstate.ucState.B, value)
-  else:
-    B, flags = sub8(simstate.ucState.B, simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setB(B)
-  simstate.ucState.setNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns8(addr)
+  B = simstate.ucState.B
+  simstate.ucState.setB(B - value & 0xFF)
+  simstate.ucState.lazyFlags(NZVC, sub8, B, value)
 
 def SUBD(simstate, addr, value):
-  if addr is None:
-    D, flags = sub16(simstate.ucState.D(), value)
-  else:
-    D, flags = sub16(simstate.ucState.D(), simstate.ucMemory.readUns16(addr))
-  simstate.ucState.setD(D)
-  simstate.ucState.setNZVC(flags)
+  if addr is not None: value = simstate.ucMemory.readUns16(addr)
+  D = simstate.ucState.D()
+  simstate.ucState.setD(D - value & 0xFFFF)
+  simstate.ucState.lazyFlags(NZVC, sub16, D, value)
 
 def SWI(simstate):
   if UseSWI:
@@ -1137,12 +1134,13 @@ def SWI(simstate):
     simstate.ucState.push8(simstate.ucMemory, simstate.ucState.B)
     simstate.ucState.push8(simstate.ucMemory, simstate.ucState.CC)
     simstate.ucState.setI(CC_I)
+    simstate.ucInterrupts.setMask(simstate.ucState.CC)
     simstate.ucState.setPC(simstate.ucMemory.readUns16(0xFFF6))
   else: raise SWIInstruction
 
 def TAB(simstate):
   simstate.ucState.setB(simstate.ucState.A)
-  simstate.ucState.setNZV(testNZ8(simstate.ucState.A))
+  simstate.ucState.lazyFlags(NZV, add8, simstate.ucState.A, 0)
 
 def TAP(simstate):
   # Remember...the X bit may be cleared but it may
@@ -1150,25 +1148,23 @@ def TAP(simstate):
   A = simstate.ucState.A
   oldCC = simstate.ucState.CC
   simstate.ucState.setCC(A & ~CC_X | A & oldCC & CC_X)
+  simstate.ucInterrupts.setMask(simstate.ucState.CC)
 
 def TBA(simstate):
   simstate.ucState.setA(simstate.ucState.B)
-  simstate.ucState.setNZV(testNZ8(simstate.ucState.A))
+  simstate.ucState.lazyFlags(NZV, add8, simstate.ucState.B, 0)
 
 def TEST(simstate): raise TestInstruction
 def TPA(simstate): simstate.ucState.setA(simstate.ucState.CC)
 
 def TST(simstate, addr, value):
-  flags = testNZ8(simstate.ucMemory.readUns8(addr))
-  simstate.ucState.setNZVC(flags)
+  simstate.ucState.lazyFlags(NZVC, sub8, simstate.ucMemory.readUns8(addr), 0)
 
 def TSTA(simstate):
-  flags = testNZ8(simstate.ucState.A)
-  simstate.ucState.setNZVC(flags)
+  simstate.ucState.lazyFlags(NZVC, sub8, simstate.ucState.A, 0)
 
 def TSTB(simstate):
-  flags = testNZ8(simstate.ucState.B)
-  simstate.ucState.setNZVC(flags)
+  simstate.ucState.lazyFlags(NZVC, sub8, simstate.ucState.B, 0)
 
 def TSX(simstate): simstate.ucState.setX(simstate.ucState.SP+1 & 0xFFFF)
 def TSY(simstate): simstate.ucState.setY(simstate.ucState.SP+1 & 0xFFFF)
@@ -1195,42 +1191,9 @@ def XGDY(simstate):
   simstate.ucState.setY(D)
 
 def DAA(simstate):
-  c = simstate.ucState.isCarrySet()
-  h = simstate.ucState.isHalfSet()
-  uhb = simstate.ucState.A >> 4 & 0x0F
-  lhb = simstate.ucState.A & 0x0F
-
-  offset = cout = 0
-  if c == 0 and h == 0:
-    if uhb <= 9 and lhb <= 9:
-      pass
-    elif uhb <= 8 and lhb >= 10:
-      offset = 0x06
-    elif uhb >= 10 and lhb <= 9:
-      offset = 0x60
-      cout = 1
-    elif uhb >= 9 and lhb >= 10:
-      offset = 0x66
-      cout = 1
-  elif c == 0 and h == 1:
-    if uhb <= 9 and lhb <= 3:
-      offset = 0x06
-    elif uhb >= 10 and lhb <= 3:
-      offset = 0x66
-      cout = 1
-  elif c == 1 and h == 0:
-    if uhb <= 2 and lhb <= 9:
-      offset = 0x60
-      cout = 1
-    elif uhb <= 2 and lhb >= 10:
-      offset = 0x66
-      cout = 1
-  elif uhb <= 3 and lhb <= 3:
-    offset = 0x66
-    cout = 1
-
-  simstate.ucState.setA(simstate.ucState.A + offset & 0xFF)
-  simstate.ucState.setNZVC(testNZ8(simstate.ucState.A) | cout * CC_C)
+  A, flags = daa(simstate.ucState.A, simstate.ucState.isCarrySet(), simstate.ucState.isHalfSet())
+  simstate.ucState.setA(A)
+  simstate.ucState.setNZVC(flags)
 
 def MUL(simstate):
   D = simstate.ucState.A * simstate.ucState.B
@@ -1269,3 +1232,175 @@ def FDIV(simstate):
   simstate.ucState.setX(Q)
   simstate.ucState.setD(R)
   simstate.ucState.setZVC(flags)
+
+################################################################################
+
+# Number of arguments (besides the simulator state) taken by the instruction
+# handlers of each addressing mode. These are the leading entries of the tuple
+# returned by SimState.decode() for that mode.
+ModeArgs = {
+  INH: 0,
+  REL: 1,
+  IMM8: 2, IMM16: 2, EXT: 2, DIR: 2, INDX: 2, INDY: 2,
+  BIT2DIR: 2, BIT2INDX: 2, BIT2INDY: 2,
+  BIT3DIR: 3, BIT3INDX: 3, BIT3INDY: 3
+  }
+
+# Number of operand bytes following the opcode byte(s) for each addressing mode
+ModeBytes = {
+  INH: 0,
+  REL: 1,
+  IMM8: 1, IMM16: 2, EXT: 2, DIR: 1, INDX: 1, INDY: 1,
+  BIT2DIR: 2, BIT2INDX: 2, BIT2INDY: 2,
+  BIT3DIR: 3, BIT3INDX: 3, BIT3INDY: 3
+  }
+
+def makeExecutor(mode, handler):
+  '''Return a function that decodes the operands of an instruction with the
+  given addressing mode and calls its handler. The function expects the PC
+  to point just past the opcode byte(s). Operands are fetched directly from the
+  memory array and passed straight to the handler, so unlike
+  SimState.decode(), no parameter tuple is built. The results are the same
+  as those of SimState.decode() followed by a call to the handler.'''
+  if mode == INH: return handler
+
+  if mode == IMM8:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      value = simstate.ucMemory.Array[PC]
+      st.setPC(PC+1 & 0xFFFF)
+      handler(simstate, None, value)
+  elif mode == IMM16:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      A = simstate.ucMemory.Array
+      value = A[PC]<<8 | A[PC+1 & 0xFFFF]
+      st.setPC(PC+2 & 0xFFFF)
+      handler(simstate, None, value)
+  elif mode == EXT:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      A = simstate.ucMemory.Array
+      addr = A[PC]<<8 | A[PC+1 & 0xFFFF]
+      st.setPC(PC+2 & 0xFFFF)
+      handler(simstate, addr, None)
+  elif mode == DIR:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      addr = simstate.ucMemory.Array[PC]
+      st.setPC(PC+1 & 0xFFFF)
+      handler(simstate, addr, None)
+  elif mode == INDX:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      addr = simstate.ucMemory.Array[PC] + st.X & 0xFFFF
+      st.setPC(PC+1 & 0xFFFF)
+      handler(simstate, addr, None)
+  elif mode == INDY:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      addr = simstate.ucMemory.Array[PC] + st.Y & 0xFFFF
+      st.setPC(PC+1 & 0xFFFF)
+      handler(simstate, addr, None)
+  elif mode == REL:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      rel = simstate.ucMemory.Array[PC]
+      PC = PC+1 & 0xFFFF
+      st.setPC(PC)
+      handler(simstate, PC + (rel ^ 0x80) - 0x80 & 0xFFFF)
+  elif mode == BIT2DIR:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      A = simstate.ucMemory.Array
+      addr = A[PC]
+      mask = A[PC+1 & 0xFFFF]
+      st.setPC(PC+2 & 0xFFFF)
+      handler(simstate, addr, mask)
+  elif mode == BIT2INDX:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      A = simstate.ucMemory.Array
+      addr = A[PC] + st.X & 0xFFFF
+      mask = A[PC+1 & 0xFFFF]
+      st.setPC(PC+2 & 0xFFFF)
+      handler(simstate, addr, mask)
+  elif mode == BIT2INDY:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      A = simstate.ucMemory.Array
+      addr = A[PC] + st.Y & 0xFFFF
+      mask = A[PC+1 & 0xFFFF]
+      st.setPC(PC+2 & 0xFFFF)
+      handler(simstate, addr, mask)
+  elif mode == BIT3DIR:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      A = simstate.ucMemory.Array
+      addr = A[PC]
+      mask = A[PC+1 & 0xFFFF]
+      rel = A[PC+2 & 0xFFFF]
+      PC = PC+3 & 0xFFFF
+      st.setPC(PC)
+      handler(simstate, addr, mask, PC + (rel ^ 0x80) - 0x80 & 0xFFFF)
+  elif mode == BIT3INDX:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      A = simstate.ucMemory.Array
+      addr = A[PC] + st.X & 0xFFFF
+      mask = A[PC+1 & 0xFFFF]
+      rel = A[PC+2 & 0xFFFF]
+      PC = PC+3 & 0xFFFF
+      st.setPC(PC)
+      handler(simstate, addr, mask, PC + (rel ^ 0x80) - 0x80 & 0xFFFF)
+  elif mode == BIT3INDY:
+    def execute(simstate):
+      st = simstate.ucState
+      PC = st.PC
+      A = simstate.ucMemory.Array
+      addr = A[PC] + st.Y & 0xFFFF
+      mask = A[PC+1 & 0xFFFF]
+      rel = A[PC+2 & 0xFFFF]
+      PC = PC+3 & 0xFFFF
+      st.setPC(PC)
+      handler(simstate, addr, mask, PC + (rel ^ 0x80) - 0x80 & 0xFFFF)
+  else: raise InternalError('Unknown instruction mode')
+
+  return execute
+
+def buildOpTable():
+  '''Resolve every opcode in Ops to its handler once, so that executing an
+  instruction is a matter of indexing a list rather than looking up the
+  handler by name. The returned table is indexed by the first opcode byte.
+  Each entry is None (illegal opcode), an
+  (instr, mode, cycles, handler, nargs, execute) tuple or, for the bytes in
+  PrebyteList, a 256-entry sub-table of such tuples indexed by the second
+  opcode byte. The 'execute' member is the specialized decoder returned by
+  makeExecutor().'''
+  table = [None]*256
+  for prebyte in PrebyteList: table[prebyte] = [None]*256
+
+  for opcode, (instr, mode, cycles) in Ops.items():
+    handler = globals()[instr]
+    entry = (instr, mode, cycles, handler, ModeArgs[mode], makeExecutor(mode, handler))
+    if isinstance(opcode, tuple): table[opcode[0]][opcode[1]] = entry
+    else: table[opcode] = entry
+  return table
+
+OpTable = buildOpTable()
+
+if UseALUTables:
+  import PySim11.alu as alu
+  globals().update(alu.makeTableOps(ReferenceALU))
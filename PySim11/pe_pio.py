@@ -27,6 +27,11 @@ The following are NOT handled:
 The Timer module keeps track of the various flags
 associated with the pulse accumulator and input
 capture.
+
+Like the Timer, this peripheral is updated lazily. It
+posts the simulator cycle of the next input stimulus (or
+of the next pulse accumulator overflow in gated time
+accumulation mode) with SimState.schedule().
 -------------------------------------------------
 
 The logic of Port A is as follows:
@@ -48,13 +53,13 @@ The logic of Port A is as follows:
 '''
 
 import operator
+import re
 
 from safestruct import *
 
 import PySim11.memory
 import PySim11.state
 import PySim11.ints
-import PySim11.laframe
 
 from PySim11.PySim11 import ucPeripheral
 
@@ -111,8 +116,11 @@ OC1M3 = 0x08
 PAOVF = 0x20
 PAIF  = 0x10
 
-try: from PySim11.laframe import LAFrame   #import wx
-except: print('Main import failed')
+# Members that make up the state of the parallel I/O, see PIO.snapshot()
+SnapshotMembers = (
+  'pacnt', 'pa_counter', 'lastsync', 'oc1m_cache', 'tctl1_cache', 'pactl_cache',
+  'PAI', 'PAW', 'PAO', 'PCI', 'PCW', 'PCO', 'PDI', 'PDW', 'PDO', 'PEI'
+  )
 
 class PIO(SafeStruct):
   def __init__(self, parentWindow):
@@ -126,7 +134,10 @@ class PIO(SafeStruct):
       'laframe': None,
       'parent': parentWindow,
       'stimuli': None,   # List of (Cycles, Value, PortPin) tuples for input stimuli
+      'stimulusList': [], # Same, set with setStimuli() when there is no LA panel
       'pacnt': 0,
+      'pa_counter': 0,   # E clocks towards the next PACNT increment in gated mode
+      'lastsync': 0,     # Simulator cycle pa_counter was last brought up to date with
       'oc1m_cache': 0,
       'tctl1_cache': 0,
       'pactl_cache': 0,
@@ -145,8 +156,13 @@ class PIO(SafeStruct):
       'PEI': 0      # Input value (i.e., reads) of Port E as driven by stimulus
     })
 
-    self.laframe = PySim11.laframe.LAFrame(self.parent, -1, 'Parallel I/O')
+    # The waveform display/stimulus interface needs wxPython, so there is
+    # none when running without a GUI (i.e., no parent window).
+    if self.parent is None: return
+
     try:
+      import PySim11.laframe
+      self.laframe = PySim11.laframe.LAFrame(self.parent, -1, 'Parallel I/O')
       self.laframe.Show(1)
 
       # self.la is the LAPanel instance
@@ -160,24 +176,66 @@ class PIO(SafeStruct):
 
   def BuildStimulusList(self):
     if self.la: self.stimuli = self.la.BuildStimulusList()
-    else: self.stimuli = None
+    else: self.stimuli = list(self.stimulusList)
+    self.schedule()
 
-  def update(self, cycles):
+  def setStimuli(self, stimuli):
+    '''Set the input stimuli, a list of (Cycles, Value, PortPin) tuples,
+    when running without the LA panel.'''
+    self.stimulusList = sorted(stimuli)
+    self.BuildStimulusList()
     self.ProcessStimuli(self.sim.cycles)
+    self.schedule()
 
-    if self.pactl_cache & PAEN:
-      if self.pactl_cache & (PAMOD|DDRA7) == PAMOD:   # Gated time accumulation mode
-        # Check for count inhibited
-        if self.pactl_cache & PEDGE == PEDGE and self.PAI & PA == 0 or \
-           self.pactl_cache & PEDGE == 0     and self.PAI & PA == PA:
-          self.pa_counter += cycles
-          if self.pa_counter >= 64:
-            self.pa_counter -= 64
-            self.pacnt += 1
-            # Note: No PAIF event in gated mode
-            if self.pacnt == 256:
-              self.pacnt = 0
-              self.events.notifyEvent(self.events.PAOV)
+  def sync(self):
+    self.ProcessStimuli(self.sim.cycles)
+    self.accumulate(self.sim.cycles)
+    self.schedule()
+
+  def schedule(self):
+    # Post the simulator cycle of the next stimulus or pulse accumulator
+    # overflow, whichever comes first.
+    nextcyc = None
+    if self.stimuli: nextcyc = self.stimuli[0][0]
+    if self.isAccumulating():
+      paov = self.lastsync + (256-self.pacnt)*64 - self.pa_counter
+      if nextcyc is None or paov < nextcyc: nextcyc = paov
+    self.sim.schedule(self, nextcyc)
+
+  def rebaseCycles(self, delta): self.lastsync -= delta
+
+  # See SimState.snapshot(). The stimuli yet to be applied are part of the
+  # state, the waveforms shown by the LA panel are not.
+  def snapshot(self):
+    stimuli = tuple(self.stimuli) if self.stimuli is not None else None
+    return (tuple(getattr(self, m) for m in SnapshotMembers), stimuli)
+
+  def restore(self, snap):
+    members, stimuli = snap
+    for m, val in zip(SnapshotMembers, members): setattr(self, m, val)
+    self.stimuli = list(stimuli) if stimuli is not None else None
+    self.schedule()
+
+  def isAccumulating(self):
+    # True in gated time accumulation mode when the count isn't inhibited
+    pactl = self.pactl_cache
+    if pactl & (PAEN|PAMOD|DDRA7) != PAEN|PAMOD: return 0
+    if pactl & PEDGE: return self.PAI & PA == 0
+    return self.PAI & PA == PA
+
+  def accumulate(self, toCycle):
+    # Count E/64 clocks in gated time accumulation mode up to 'toCycle'
+    if toCycle <= self.lastsync: return
+    if self.isAccumulating():
+      self.pa_counter += toCycle - self.lastsync
+      while self.pa_counter >= 64:
+        self.pa_counter -= 64
+        self.pacnt += 1
+        # Note: No PAIF event in gated mode
+        if self.pacnt == 256:
+          self.pacnt = 0
+          self.events.notifyEvent(self.events.PAOV)
+    self.lastsync = toCycle
 
   def updatePAO(self):
     # Update voltages driven on Port A pins based on changes to PAW or
@@ -321,13 +379,19 @@ class PIO(SafeStruct):
     self.updatePAO()
 
   def writePACTL(self, addr, bits, val, rw):
+    self.accumulate(self.sim.cycles)
     self.pactl_cache = val
     self.updatePAO()
+    self.schedule()
 
   def readPACNT(self, addr, bits, val, rw):
+    self.accumulate(self.sim.cycles)
     self.memory.writeRawUns8(self.memory.PACNT, self.pacnt)
 
-  def writePACNT(self, addr, bits, val, rw): self.pacnt = val
+  def writePACNT(self, addr, bits, val, rw):
+    self.accumulate(self.sim.cycles)
+    self.pacnt = val
+    self.schedule()
 
   def OCEvent(self, event, exactcycle=None):
     tctl1 = self.tctl1_cache
@@ -384,9 +448,11 @@ class PIO(SafeStruct):
         newPAO = newPAO & ~OC5 | oc1d & OC1M3
       self.notifyPAO(newPAO, exactcycle)
 
-  def OnSimStart(self, event): self.la.IsSimulating(1)
+  def OnSimStart(self, event):
+    if self.la: self.la.IsSimulating(1)
 
-  def OnSimEnd(self, event): self.la.IsSimulating(0)
+  def OnSimEnd(self, event):
+    if self.la: self.la.IsSimulating(0)
 
   def ProcessStimuli(self, toCycle):
     while self.stimuli:
@@ -394,6 +460,7 @@ class PIO(SafeStruct):
 
       if S[0] <= toCycle:
         del self.stimuli[0]
+        self.accumulate(S[0])
         self.StimPortBit(S[2], S[1], S[0])
       else: break
 
@@ -464,6 +531,36 @@ class PIO(SafeStruct):
 
     self.BuildStimulusList()
     self.ProcessStimuli(0)
+    self.schedule()
+
+def ReadStimulusFile(filename, portpin):
+  '''Read a stimulus file (see doc/waveform.html) for the given port pin
+  (e.g., 'PA0') and return its edges as a list of (Cycles, Value, PortPin)
+  tuples. Raises IOError if the file can't be read or is malformed.'''
+  pat_c = re.compile(r'^\s*(\d+)\s+(0|1)')      # CycleNumber Value
+  comment_c = re.compile(r'^\s*(?:#.*)?$')
+
+  with open(filename, 'rt') as fid: lines = fid.readlines()
+
+  events = []
+  linenum = 0
+  for line in lines:
+    linenum += 1
+    match = pat_c.match(line)
+    if match is None:
+      if comment_c.match(line) is None:
+        raise IOError(f'Error at "{filename}" line {linenum}: line is not in the format "CYCLE ZeroOrOne"')
+      continue
+
+    cycle = int(match.group(1))
+    val   = int(match.group(2))
+
+    if events:
+      if cycle <= events[-1][0]:
+        raise IOError(f'Error at "{filename}" line {linenum}: cycle time not in ascending order')
+      if val != events[-1][1]: events.append((cycle, val, portpin))
+    else: events.append((cycle, val, portpin))
+  return events
 
 def install(sim, parentWindow):
   T = PIO(parentWindow)
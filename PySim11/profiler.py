@@ -0,0 +1,170 @@
+'''
+Execution profiler
+
+While profiling, the simulator counts, for every address, the number of
+instructions executed there and the cycles they took, in two 65536-entry
+arrays. The cycles of an instruction are those that elapse until the next
+one starts, so they include any extra cycles the peripherals account to it.
+The cycles of stacking the registers for an interrupt are those of the
+first instruction of the service routine.
+
+The counts are reported per address, per source line or per routine when a
+MAP file is loaded. A routine is all the code from a symbol up to the next
+symbol, so local labels split routines unless they are not in the MAP file.
+writeFolded() exports the cycles in the "folded stacks" format read by
+flame graph tools (e.g., flamegraph.pl or speedscope), one frame per routine
+and one per source line.
+'''
+
+import array
+import bisect
+
+from safestruct import *
+
+class Profiler(SafeStruct):
+  def __init__(self, sim):
+    super().__init__({
+      'sim': sim,
+      'counts': array.array('Q', bytes(8*65536)),   # Instructions executed at each address
+      'cycles': array.array('Q', bytes(8*65536)),   # Cycles taken by them
+      'record': None,     # Called before every instruction, see makeRecorder()
+      'flush': None       # Accounts the cycles of the last instruction run
+    })
+    self.makeRecorder()
+    sim.ucEvents.addHandler(sim.ucEvents.CycReset, self.OnCycReset)
+
+  def close(self):
+    self.flush()
+    self.sim.ucEvents.removeHandler(self.sim.ucEvents.CycReset, self.OnCycReset)
+
+  def makeRecorder(self):
+    sim = self.sim
+    st = sim.ucState
+    counts = self.counts
+    cycles = self.cycles
+    lastPC = None     # Address of the instruction being run
+    lastCycle = 0     # Cycle it started on
+
+    def record():
+      nonlocal lastPC, lastCycle
+      now = sim.cycles
+      if lastPC is not None: cycles[lastPC] += now - lastCycle
+      lastPC = st.PC
+      lastCycle = now
+      counts[lastPC] += 1
+
+    # SimState.step() calls flush() when it stops, as the cycles can be
+    # changed (or gone back) from the debugger before the next run.
+    def flush():
+      nonlocal lastPC
+      if lastPC is not None: cycles[lastPC] += max(sim.cycles - lastCycle, 0)
+      lastPC = None
+
+    self.record = record
+    self.flush = flush
+
+  def OnCycReset(self, event): self.flush()
+
+  def clear(self):
+    self.flush()
+    for arr in (self.counts, self.cycles): arr[:] = array.array('Q', bytes(8*65536))
+
+  def totals(self):
+    'Return the total (cycles, instructions) profiled'
+    return sum(self.cycles), sum(self.counts)
+
+  def byAddress(self):
+    '''Return a list of (cycles, count, address) tuples for every address
+    executed, most cycles first.'''
+    counts = self.counts
+    cycles = self.cycles
+    return sorted(((cycles[PC], counts[PC], PC) for PC in range(65536) if counts[PC]), reverse=True)
+
+  def byLine(self, mapfile):
+    '''Return a list of (cycles, count, fname, linenum, srcline) tuples for
+    every source line executed, most cycles first. Addresses not in the MAP
+    file have a fname of None and a linenum of the address.'''
+    lines = {}
+    for cyc, count, PC in self.byAddress():
+      try:
+        srcline, fname, linenum = mapfile.addrmap[PC]
+        key = (fname, linenum)
+      except KeyError:
+        srcline = ''
+        key = (None, PC)
+      try: entry = lines[key]
+      except KeyError: entry = lines[key] = [0, 0, srcline]
+      entry[0] += cyc
+      entry[1] += count
+    return sorted(((cyc, count, fname, linenum, srcline.rstrip())
+                   for (fname, linenum), (cyc, count, srcline) in lines.items()), key=lambda r: (r[0], r[1]), reverse=True)
+
+  def bySymbol(self, mapfile):
+    '''Return a list of (cycles, count, symbol, address) tuples for every
+    routine executed, most cycles first. Code before the first symbol is
+    reported with a symbol of None and an address of 0.'''
+    starts, names = symbolRanges(mapfile)
+    routines = {}
+    for cyc, count, PC in self.byAddress():
+      i = bisect.bisect_right(starts, PC) - 1
+      key = i if i >= 0 else None
+      try: entry = routines[key]
+      except KeyError: entry = routines[key] = [0, 0]
+      entry[0] += cyc
+      entry[1] += count
+    return sorted(((cyc, count, names[i] if i is not None else None, starts[i] if i is not None else 0)
+                   for i, (cyc, count) in routines.items()), key=lambda r: r[0], reverse=True)
+
+  def report(self, write, mapfile=None, lines=0, top=20):
+    '''Write the 'top' hottest routines (or source lines, if 'lines' is set)
+    with their share of the cycles. Without a MAP file, the hottest
+    addresses are written instead.'''
+    total, instrs = self.totals()
+    write('%d cycles, %d instructions profiled\n' % (total, instrs))
+    if not instrs: return
+    if mapfile is None:
+      title = 'Address'
+      rows = [(cyc, count, '$%04X' % PC) for cyc, count, PC in self.byAddress()]
+    elif lines:
+      title = 'Source line'
+      rows = [(cyc, count, '%s:%d  %s' % (fname, linenum, srcline) if fname else '$%04X' % linenum)
+              for cyc, count, fname, linenum, srcline in self.byLine(mapfile)]
+    else:
+      title = 'Routine'
+      rows = [(cyc, count, '%s ($%04X)' % (sym, addr) if sym else '(no symbol)')
+              for cyc, count, sym, addr in self.bySymbol(mapfile)]
+
+    write('\n    Cycles      %%     Instrs  %s\n' % title)
+    for cyc, count, text in rows[:top]:
+      write('%10d %5.1f%% %10d  %s\n' % (cyc, 100.0*cyc/total if total else 0, count, text))
+    if len(rows) > top: write('(%d more)\n' % (len(rows)-top))
+
+  def writeFolded(self, fid, mapfile=None):
+    '''Write the cycles in the folded stacks format, one line per address
+    executed: "routine;line cycles". Without a MAP file, addresses are used
+    for both frames.'''
+    if mapfile is not None: starts, names = symbolRanges(mapfile)
+    folded = {}
+    for cyc, count, PC in self.byAddress():
+      if not cyc: continue
+      routine = line = '$%04X' % PC
+      if mapfile is not None:
+        i = bisect.bisect_right(starts, PC) - 1
+        if i >= 0: routine = names[i]
+        try:
+          srcline, fname, linenum = mapfile.addrmap[PC]
+          line = '%s:%d' % (fname, linenum)
+        except KeyError: pass
+      key = routine + ';' + line
+      folded[key] = folded.get(key, 0) + cyc
+    for key in sorted(folded): fid.write('%s %d\n' % (key, folded[key]))
+
+def symbolRanges(mapfile):
+  '''Return (starts, names): the sorted addresses of the symbols defined on
+  source lines of a MAP file and their names (the first alphabetically when
+  several share an address).'''
+  syms = {}
+  for addr, sym in mapfile.linemap.values():
+    if sym and (addr not in syms or sym < syms[addr]): syms[addr] = sym
+  starts = sorted(syms)
+  return starts, [syms[addr] for addr in starts]
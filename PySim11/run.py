@@ -0,0 +1,228 @@
+'''
+Headless simulator runner
+
+Loads an S19, Intel HEX or binary file, or resumes from a save-state file
+(see savestate.py), and runs it to a stop condition (SWI, STOP, WAI, TEST,
+illegal instruction, breakpoint or cycle limit) without any GUI, then prints
+the registers and cycle count. The Timer and Parallel I/O peripherals are
+installed without their waveform display, so wxPython is never imported.
+
+  python -m PySim11.run [Options] Filename.S19
+  python -m PySim11.run [Options] --load-state=file [Filename.S19]
+'''
+
+import sys
+import os
+import getopt
+
+from safestruct import *
+
+import PySim11.G as G
+
+def usage(arglist):
+  print('''\
+Usage:
+  python -m PySim11.run [Options] Filename.S19
+  python -m PySim11.run [Options] --load-state=file [Filename.S19]
+
+Options:
+  -c, --cycles=N   -- Stop after N cycles (default: no limit)
+  -m, --map=file   -- Load a MAP file for source-level trace output
+  -s, --start=addr -- Specify starting address (overrides S19 file)
+  -a, --load-address=addr
+                   -- Load a binary image (.bin) at addr rather than so
+                      that it ends at $FFFF
+  -b, --break=addr -- Stop when the PC reaches addr (may be repeated)
+  -i, --stimulus=pin=file
+                   -- Drive input pin (e.g., PA0) from a stimulus file
+                      (may be repeated)
+  -l, --load-state=file
+                   -- Resume from a save-state file (an S19 file, if also
+                      given, is then loaded on top of it)
+  -w, --save-state=file
+                   -- Save the state to a file when execution stops
+  -t, --trace      -- Trace every instruction
+  -T, --trace-file=file
+                   -- Record a binary trace of the last instructions
+                      executed to a file (see PySim11.tracedump)
+  --trace-size=N   -- Number of instructions the trace file holds
+  -p, --profile    -- Print the routines (or addresses, with no MAP file)
+                      that took the most cycles
+  --flame=file     -- Write the profile to a file in the folded stacks
+                      format read by flame graph tools
+  --call-graph     -- Print the cycles, worst-case execution time and stack
+                      use of every subroutine and the interrupt latencies
+  --coverage=file  -- Write the code coverage to a file (see
+                      PySim11.coverage to merge and report such files)
+  --lcov=file      -- Write the code coverage to an lcov tracefile (needs a
+                      MAP file)
+  --cobertura=file -- Write the code coverage to a Cobertura XML file (needs
+                      a MAP file)
+  --use-swi        -- Allow SWI instructions to execute
+  --block-cache    -- Run from the basic-block cache
+  --no-timer       -- Do not install the timer peripheral
+  --no-pio         -- Do not install the parallel I/O peripheral
+  -h, --help       -- Display this help summary\
+''')
+  sys.exit(1)
+
+class RunOptions(SafeStruct):
+  def __init__(self):
+    super().__init__({
+      'S19FileName': None,
+      'MapFileName': None,
+      'StartPC': None,
+      'LoadAddress': None, # Address of a binary image
+      'Cycles': 0,
+      'Breaks': [],
+      'Stimuli': [],      # List of (PortPin, Filename) tuples
+      'LoadState': None,  # Save-state file to resume from
+      'SaveState': None,  # Save-state file to write when execution stops
+      'Trace': 0,
+      'TraceFile': None,  # Binary trace file, see tracebuf.py
+      'TraceSize': None,
+      'Profile': 0,
+      'FlameFile': None,  # Folded stacks file, see profiler.py
+      'CallGraph': 0,
+      'Coverage': None,   # Coverage file, see coverage.py
+      'Lcov': None,
+      'Cobertura': None
+    })
+
+def parseArgs(arglist):
+  '''Parse the command line and set the PySim11.G globals accordingly.
+  Returns a RunOptions object.'''
+  opts = RunOptions()
+  try:
+    optlist, args = getopt.gnu_getopt(arglist[1:], 'hc:m:s:a:b:i:l:w:tT:p',
+      ['help', 'cycles=', 'map=', 'start=', 'load-address=', 'break=', 'stimulus=', 'load-state=', 'save-state=', 'trace', 'trace-file=', 'trace-size=',
+       'profile', 'flame=', 'call-graph', 'coverage=', 'lcov=', 'cobertura=', 'use-swi', 'block-cache', 'no-timer', 'no-pio'])
+  except getopt.error as detail:
+    print('Option error:', detail)
+    usage(arglist)
+
+  try:
+    for w, val in optlist:
+      if w in ['-h', '--help']: usage(arglist)
+      elif w in ['-c', '--cycles']: opts.Cycles = int(val, 0)
+      elif w in ['-m', '--map']: opts.MapFileName = val
+      elif w in ['-s', '--start']: opts.StartPC = int(val, 0)
+      elif w in ['-a', '--load-address']: opts.LoadAddress = int(val, 0)
+      elif w in ['-b', '--break']: opts.Breaks.append(int(val, 0))
+      elif w in ['-i', '--stimulus']:
+        pin, fname = val.split('=', 1)
+        opts.Stimuli.append((pin.upper(), fname))
+      elif w in ['-l', '--load-state']: opts.LoadState = val
+      elif w in ['-w', '--save-state']: opts.SaveState = val
+      elif w in ['-t', '--trace']: opts.Trace = 1
+      elif w in ['-T', '--trace-file']: opts.TraceFile = val
+      elif w == '--trace-size': opts.TraceSize = int(val, 0)
+      elif w in ['-p', '--profile']: opts.Profile = 1
+      elif w == '--flame': opts.FlameFile = val
+      elif w == '--call-graph': opts.CallGraph = 1
+      elif w == '--coverage': opts.Coverage = val
+      elif w == '--lcov': opts.Lcov = val
+      elif w == '--cobertura': opts.Cobertura = val
+      elif w == '--use-swi': G.UseSWI = 1
+      elif w == '--block-cache': G.UseBlockCache = 1
+      elif w == '--no-timer': G.Peripherals['Timer'][0] = 0
+      elif w == '--no-pio': G.Peripherals['ParallelIO'][0] = 0
+  except ValueError as detail:
+    print('Option error:', detail)
+    usage(arglist)
+
+  if len(args) > 1 or not (args or opts.LoadState): usage(arglist)
+  if (opts.Lcov or opts.Cobertura) and not opts.MapFileName:
+    print('Option error: coverage reports need a MAP file')
+    usage(arglist)
+  if args: opts.S19FileName = args[0]
+  return opts
+
+def makeSim(opts, write=sys.stdout.write):
+  '''Create a SimState, with no parent window, and load the save-state
+  file, S19 file and MAP file given by 'opts' (any of which may be absent).
+  Raises an exception if a file can't be loaded.'''
+  # The simulator modules read some of the PySim11.G globals when they are
+  # imported, so they are only imported once the options are known.
+  from PySim11 import PySim11, mapsym, pe_pio, savestate
+  from PySim11.s19 import ReadImage
+
+  sim = PySim11.SimState(None, write)
+
+  if opts.LoadState: savestate.loadState(sim, opts.LoadState)
+
+  if opts.S19FileName:
+    addr, diag = ReadImage(opts.S19FileName, sim.ucMemory, opts.LoadAddress)
+    if diag: write(diag)
+    if addr is not None and not opts.LoadState: sim.ucState.setPC(addr)
+  if opts.StartPC is not None: sim.ucState.setPC(opts.StartPC)
+
+  if opts.MapFileName:
+    with open(mapsym.add_extension(opts.MapFileName), 'rt') as fid:
+      sim.mapfile = mapsym.MapFile(fid, os.path.dirname(opts.MapFileName) or '.')
+
+  if opts.Stimuli:
+    pio = [pe.object for pe in sim.PElist if pe.text == 'Parallel I/O']
+    if not pio: raise ValueError('Stimuli require the parallel I/O peripheral')
+    stimuli = []
+    for pin, fname in opts.Stimuli: stimuli += pe_pio.ReadStimulusFile(fname, pin)
+    pio[0].setStimuli(stimuli)
+
+  for addr in opts.Breaks:
+    br = PySim11.ucBreakpoint()
+    br.addr = addr
+    br.text = f'Breakpoint at {addr:04X}'
+    sim.BPlist.append(br)
+
+  if opts.TraceFile: sim.enableTracer(1, opts.TraceSize, opts.TraceFile)
+  if opts.Profile or opts.FlameFile: sim.enableProfiler(1)
+  if opts.CallGraph: sim.enableCallGraph(1)
+  if opts.Coverage or opts.Lcov or opts.Cobertura: sim.enableCoverage(1)
+  return sim
+
+def run(sim, opts, write=sys.stdout.write):
+  'Run until a stop condition, then display the registers and cycle count'
+  cyclimit = sim.cycles + opts.Cycles if opts.Cycles else 0
+  sim.step(0, opts.Trace, cyclimit)
+  if sim.tracer is not None: sim.enableTracer(0)
+  sim.ucState.display(write)
+  write(f'\nCycles: {sim.cycles}\n')
+
+  if opts.Profile:
+    write('\n')
+    sim.profiler.report(write, sim.mapfile)
+  if opts.FlameFile:
+    with open(opts.FlameFile, 'wt') as fid: sim.profiler.writeFolded(fid, sim.mapfile)
+    write(f'Profile written to "{opts.FlameFile}"\n')
+  if opts.CallGraph:
+    write('\n')
+    sim.callgraph.report(write, sim.mapfile)
+
+  if opts.Coverage:
+    sim.coverage.save(opts.Coverage)
+    write(f'Coverage written to "{opts.Coverage}"\n')
+  if opts.Lcov:
+    with open(opts.Lcov, 'wt') as fid: sim.coverage.writeLcov(fid, sim.mapfile, sim.ucMemory.Array)
+    write(f'Coverage written to "{opts.Lcov}"\n')
+  if opts.Cobertura:
+    with open(opts.Cobertura, 'wt') as fid:
+      sim.coverage.writeCobertura(fid, sim.mapfile, sim.ucMemory.Array, os.path.dirname(opts.MapFileName) or '.')
+    write(f'Coverage written to "{opts.Cobertura}"\n')
+
+  if opts.SaveState:
+    from PySim11 import savestate
+    savestate.saveState(sim, opts.SaveState)
+    write(f'State saved to "{opts.SaveState}"\n')
+
+def main(arglist=None):
+  if not arglist: arglist = sys.argv
+  opts = parseArgs(arglist)
+  try: sim = makeSim(opts)
+  except Exception as detail:
+    print(detail)
+    return 1
+  run(sim, opts)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
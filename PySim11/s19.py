@@ -1,28 +1,95 @@
 '''
-Read and verify S19 files
+Read and verify program images: S19 (Motorola S-record), Intel HEX and raw
+binary files
+
+Files are read a record at a time, and the data of every record is copied to
+(or compared with) memory in one go, without calling the memory filters'
+handlers, i.e., loading a program doesn't look like CPU writes to the
+peripherals (or to watchpoints).
+
+S-records may use 16-bit (S1/S9), 24-bit (S2/S8) or 32-bit (S3/S7)
+addresses, as long as the data fits in the 64K address space, and files
+may have any of the usual extensions (.s19, .s28, .s37, .srec or .mot); a
+file name without an extension gets .s19. S0 (header) and S5/S6 (record
+count) records are checked but not loaded. Intel HEX files
+may use extended segment or linear address records likewise. A binary image
+is loaded at a given address or, by default, so that it ends at $FFFF (a
+ROM image with the interrupt vectors at its end).
 '''
 
 import os
 import string
-import re
 
 import PySim11.memory
 
-__all__ = ["ReadS19","VerifyS19"]
+__all__ = ["ReadS19","VerifyS19","ReadIntelHex","VerifyIntelHex","ReadBinary","VerifyBinary",
+           "ReadImage","VerifyImage","imageFormat"]
 
-s19pat = r'S(\d)([\da-fA-F]{2,2})([\da-fA-F]{4,4})([\da-fA-F]*)([\da-fA-F]{2,2})'
-s19re = re.compile(s19pat)
+# Address bytes of the S-record types supported
+AddrBytes = {'0': 2, '1': 2, '2': 3, '3': 4, '5': 2, '6': 3, '7': 4, '8': 3, '9': 2}
+
+# File name extensions of the image formats
+SRecExtensions = ('.s19', '.s28', '.s37', '.srec', '.mot')
+HexExtensions = ('.hex', '.ihx', '.ihex')
+BinExtensions = ('.bin',)
 
 def add_extension(filename):
-  try: filename, ext = filename.rsplit('.',1)
-  except: pass
-  ext = 's19'
-  return filename + '.' + ext
+  if not os.path.splitext(filename)[1]: filename += '.s19'
+  return filename
+
+def imageFormat(Filename):
+  '''Return 's19', 'hex' or 'bin': the format of an image file by its
+  extension. Files with an extension not listed above are read as S-records.'''
+  ext = os.path.splitext(Filename)[1].lower()
+  if ext in SRecExtensions: return 's19'
+  if ext in HexExtensions: return 'hex'
+  if ext in BinExtensions: return 'bin'
+  return 's19'
 
 def ReadS19(Filename, Memory): return S19reader(Filename, Memory, 0)
 
 def VerifyS19(Filename, Memory): return S19reader(Filename, Memory, 1)
 
+def ReadIntelHex(Filename, Memory): return IntelHexReader(Filename, Memory, 0)
+
+def VerifyIntelHex(Filename, Memory): return IntelHexReader(Filename, Memory, 1)
+
+def ReadBinary(Filename, Memory, base=None): return BinaryReader(Filename, Memory, 0, base)
+
+def VerifyBinary(Filename, Memory, base=None): return BinaryReader(Filename, Memory, 1, base)
+
+def ReadImage(Filename, Memory, base=None):
+  '''Read an S19, Intel HEX or binary file, by its extension (see
+  imageFormat()). 'base' is the address of a binary image.'''
+  fmt = imageFormat(Filename)
+  if fmt == 'hex': return IntelHexReader(Filename, Memory, 0)
+  if fmt == 'bin': return BinaryReader(Filename, Memory, 0, base)
+  return S19reader(Filename, Memory, 0)
+
+def VerifyImage(Filename, Memory, base=None):
+  fmt = imageFormat(Filename)
+  if fmt == 'hex': return IntelHexReader(Filename, Memory, 1)
+  if fmt == 'bin': return BinaryReader(Filename, Memory, 1, base)
+  return S19reader(Filename, Memory, 1)
+
+def commit(Memory, addr, data, verify, Filename, where):
+  # Write or verify the data of a record. 'where' describes the record for
+  # error messages.
+  if addr + len(data) > 0x10000:
+    raise ValueError(f'{where} loads $%X-$%X, beyond the 64K address space' % (addr, addr+len(data)-1))
+  if verify:
+    bad = Memory.compareBlock(addr, data)
+    if bad is not None:
+      s = 'Verify error at $%04X\n' % bad
+      s += '  Memory: $%02X  %s: $%02X' % (Memory.readRawUns8(bad), Filename, data[bad-addr])
+      raise ValueError(s)
+  else: Memory.writeBlock(addr, data)
+
+def diagnostics(warnings, ignoreCount, what):
+  if ignoreCount:
+    warnings.append(f'Ignored {ignoreCount} {what}{"" if ignoreCount == 1 else "s"} of unsupported format')
+  return ''.join(w + '\n' for w in warnings) or None
+
 def S19reader(Filename, Memory, verify = 0):
   '''This function returns a tuple (address, diagnostics) which contains the
   address to run at (if any) and the diagnostics, if not None, contains
@@ -30,61 +97,114 @@ def S19reader(Filename, Memory, verify = 0):
   S-records).'''
 
   Filename = add_extension(Filename)
-  with open(Filename, 'rt') as fid: lines = fid.readlines(); fid.close()
 
   retaddr = None
   ignoreCount = 0
-
-  lineix = 0
-  for line in lines:
-    lineix += 1
-    m = s19re.match(line)
-    if not m: raise ValueError(f'S19 format error at line {lineix}')
-
-    typ, count, addr, data, chksum = m.groups()
-
-    if typ in '19':
-      if len(data) & 0x01:
-        raise ValueError(f'Odd-length data at line {lineix}')
-
-      count = int(count,16)
-      addr = int(addr, 16)
-      chksum = int(chksum, 16) + count + int(addr/256) + addr%256 + 1
-
-      if count != 3+int(len(data)/2):
+  dataCount = 0
+  warnings = []
+
+  with open(Filename, 'rt') as fid:
+    for lineix, line in enumerate(fid, 1):
+      line = line.strip()
+      if not line: continue
+      if len(line) < 4 or line[0] != 'S': raise ValueError(f'S19 format error at line {lineix}')
+      typ = line[1]
+      try: rec = bytes.fromhex(line[2:])
+      except ValueError: raise ValueError(f'S19 format error at line {lineix}') from None
+
+      if rec[0] != len(rec)-1:
         raise ValueError(f'Record count mismatch at line {lineix}')
-
-      if typ == '9':
-        if count > 3:
-          raise ValueError(f'Unexpected data in S9 record at line {lineix}')
-        s = None
-        if ignoreCount:
-          s = f'Ignored {ignoreCount} S-record{"" if ignoreCount == 1 else "s"} of unsupported format\n'
-        return addr, s
-
-      retaddr = retaddr or addr
-
-      if count <= 3:
-        raise ValueError(f'Unexpected empty S1 record at line {lineix}')
-
-      for count in range(int(len(data)/2)):
-        val = int(data[2*count:2*count+2],16)
-        if verify:
-          if Memory.readUns8(addr+count) != val:
-            s = 'Verify error at $%04X\n' % (addr+count)
-            s += '  Memory: $%02X  %s: $%02X' % (Memory.readUns8(addr+count), Filename, val)
-            raise ValueError(s)
-        else: Memory.writeUns8(addr+count, val)
-        chksum += val
-
-      if (chksum & 0xFF): raise ValueError(f'Checksum error at line {lineix}')
-
-    else: ignoreCount += 1
+      if sum(rec) & 0xFF != 0xFF: raise ValueError(f'Checksum error at line {lineix}')
+
+      try: n = AddrBytes[typ]
+      except KeyError:
+        ignoreCount += 1
+        continue
+      if len(rec) < n+2:
+        raise ValueError(f'S{typ} record too short for its {8*n}-bit address at line {lineix}')
+      addr = int.from_bytes(rec[1:n+1], 'big')
+      data = rec[n+1:-1]
+
+      if typ in '789':
+        if data:
+          raise ValueError(f'Unexpected data in S{typ} record at line {lineix}')
+        if addr > 0xFFFF:
+          raise ValueError(f'S{typ} record at line {lineix} starts at ${addr:X}, beyond the 64K address space')
+        return addr, diagnostics(warnings, ignoreCount, 'S-record')
+
+      if typ in '123':
+        if not data:
+          raise ValueError(f'Unexpected empty S{typ} record at line {lineix}')
+        commit(Memory, addr, data, verify, Filename, f'S{typ} record at line {lineix}')
+        if retaddr is None: retaddr = addr
+        dataCount += 1
+      elif typ in '56' and addr != dataCount & (0xFFFF if typ == '5' else 0xFFFFFF):
+        warnings.append(f'WARNING: S{typ} record at line {lineix} counts {addr} data records, found {dataCount}')
 
   retaddr = retaddr or 0
 
-  s = 'WARNING: No S9 record found'
-  if ignoreCount:
-    s += f'\nIgnored {ignoreCount} S-records of unsupported format'
+  warnings.append('WARNING: No S9 record found')
+  return retaddr, diagnostics(warnings, ignoreCount, 'S-record')
+
+def IntelHexReader(Filename, Memory, verify = 0):
+  '''Read or verify an Intel HEX file. Returns (address, diagnostics) as
+  S19reader() does, the address being that of the start address record, or
+  of the first data record if there is none.'''
 
-  return retaddr, s
+  retaddr = None
+  start = None
+  upper = 0         # Address of the extended segment or linear address record
+  ignoreCount = 0
+  warnings = []
+
+  with open(Filename, 'rt') as fid:
+    for lineix, line in enumerate(fid, 1):
+      line = line.strip()
+      if not line: continue
+      if line[0] != ':': raise ValueError(f'Intel HEX format error at line {lineix}')
+      try: rec = bytes.fromhex(line[1:])
+      except ValueError: raise ValueError(f'Intel HEX format error at line {lineix}') from None
+
+      if len(rec) < 5 or rec[0] != len(rec)-5:
+        raise ValueError(f'Record length mismatch at line {lineix}')
+      if sum(rec) & 0xFF: raise ValueError(f'Checksum error at line {lineix}')
+
+      typ = rec[3]
+      addr = rec[1] << 8 | rec[2]
+      data = rec[4:-1]
+      if typ == 0:
+        commit(Memory, upper + addr, data, verify, Filename, f'Data record at line {lineix}')
+        if retaddr is None: retaddr = upper + addr
+      elif typ == 1:
+        if start is None: start = retaddr or 0
+        return start, diagnostics(warnings, ignoreCount, 'record')
+      elif typ in (2, 3, 4, 5):
+        if len(data) != (2 if typ in (2, 4) else 4):
+          raise ValueError(f'Record of type {typ:02X} with {len(data)} data bytes at line {lineix}')
+        val = int.from_bytes(data, 'big')
+        if typ == 2: upper = val << 4
+        elif typ == 4: upper = val << 16
+        else:
+          start = (val >> 16 << 4) + (val & 0xFFFF) if typ == 3 else val
+          if start > 0xFFFF:
+            raise ValueError(f'Start address record at line {lineix} starts at ${start:X}, beyond the 64K address space')
+      else: ignoreCount += 1
+
+  if start is None: start = retaddr or 0
+  warnings.append('WARNING: No end of file record found')
+  return start, diagnostics(warnings, ignoreCount, 'record')
+
+def BinaryReader(Filename, Memory, verify = 0, base = None):
+  '''Read or verify a binary image at the address 'base' or, if it is None,
+  so that it ends at $FFFF. Returns (address, None), the address being the
+  reset vector if the image holds it, or else the base address.'''
+
+  with open(Filename, 'rb') as fid: data = fid.read()
+  if not data: raise ValueError(f'"{Filename}" is empty')
+  if base is None:
+    if len(data) > 0x10000: raise ValueError(f'"{Filename}" is larger than the 64K address space')
+    base = 0x10000 - len(data)
+  commit(Memory, base, data, verify, Filename, f'"{Filename}" at ${base:04X}')
+
+  if base + len(data) == 0x10000 and len(data) >= 2: return data[-2] << 8 | data[-1], None
+  return base, None
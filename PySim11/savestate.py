@@ -0,0 +1,146 @@
+'''
+Save-state files
+
+A save-state file holds a SimState.snapshot() (registers, memory, pending
+interrupts, cycle count and peripheral state) so that a simulation can be
+resumed later, or many times over, without loading the S19 file and running
+the initialization code again. The format is binary, big-endian:
+
+  Header (HeaderFormat)
+    Magic       8 bytes, 'PySim11S'
+    Version     16 bits, FormatVersion
+    Cycles      64 bits
+    PC SP X Y   16 bits each
+    A B CC      8 bits each
+    RegBase     16 bits
+    Pending     32 bits, ucInterrupts.pending
+    Ready, Promoted, CCMask
+                8 bits each, the other ucInterrupts members
+    Count       16 bits, number of peripherals
+  Memory        65536 bytes
+  Peripherals   Count times: the name (as in SimState.PElist) and the state
+                returned by its snapshot() method, both encoded as values
+
+Values are encoded with a one-byte tag: 'N' for None, 'I' followed by a
+64-bit signed integer, 'S' followed by a 32-bit length and a UTF-8 string
+or 'T' followed by a 32-bit count and that many values, for tuples and
+lists (decoded as tuples).
+
+Files are read through mmap, so that loading doesn't copy the file before
+decoding it. FormatVersion must be incremented whenever the layout, or the
+state saved by a peripheral, changes.
+'''
+
+import mmap
+import struct
+
+from PySim11.PySim11 import ucSnapshot
+from PySim11.memory import PageCount
+
+Magic = b'PySim11S'
+FormatVersion = 1
+
+HeaderFormat = struct.Struct('>8sHQ4H3BHI3BH')
+_int = struct.Struct('>q')
+_len = struct.Struct('>I')
+
+MemorySize = PageCount*256
+
+class SaveStateError(Exception): pass
+
+def encodeValue(val, out):
+  if val is None: out += b'N'
+  elif isinstance(val, int):
+    out += b'I'
+    out += _int.pack(val)
+  elif isinstance(val, str):
+    data = val.encode('utf-8')
+    out += b'S'
+    out += _len.pack(len(data))
+    out += data
+  elif isinstance(val, (tuple, list)):
+    out += b'T'
+    out += _len.pack(len(val))
+    for item in val: encodeValue(item, out)
+  else: raise SaveStateError(f'Unable to save a value of type {type(val).__name__}')
+
+def decodeValue(buf, pos):
+  '''Return the value encoded at offset 'pos' of 'buf' and the offset
+  following it.'''
+  tag = buf[pos:pos+1]
+  pos += 1
+  if tag == b'N': return None, pos
+  if tag == b'I': return _int.unpack_from(buf, pos)[0], pos+_int.size
+  if tag == b'S':
+    size = _len.unpack_from(buf, pos)[0]
+    pos += _len.size
+    return str(buf[pos:pos+size], 'utf-8'), pos+size
+  if tag == b'T':
+    count = _len.unpack_from(buf, pos)[0]
+    pos += _len.size
+    items = []
+    for i in range(count):
+      item, pos = decodeValue(buf, pos)
+      items.append(item)
+    return tuple(items), pos
+  raise SaveStateError(f'Bad value tag {tag!r} at offset {pos-1}')
+
+def writeSnapshot(snap, filename):
+  'Write a ucSnapshot to a save-state file'
+  PC, SP, X, Y, A, B, CC = snap.registers
+  pending, ready, promoted, ccmask = snap.interrupts
+
+  out = bytearray(HeaderFormat.pack(Magic, FormatVersion, snap.cycles, PC, SP, X, Y, A, B, CC,
+                                    snap.regbase, pending, ready, promoted, ccmask, len(snap.peripherals)))
+  for page in snap.pages: out += page
+  for text, state in snap.peripherals:
+    encodeValue(text, out)
+    encodeValue(state, out)
+
+  with open(filename, 'wb') as fid: fid.write(out)
+
+def readSnapshot(filename):
+  '''Return the ucSnapshot stored in a save-state file. Raises
+  SaveStateError if the file isn't a save-state file of this version.'''
+  with open(filename, 'rb') as fid:
+    try: buf = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError: raise SaveStateError(f'"{filename}" is empty')
+
+  with buf:
+    if len(buf) < HeaderFormat.size + MemorySize or buf[:len(Magic)] != Magic:
+      raise SaveStateError(f'"{filename}" is not a save-state file')
+
+    (magic, version, cycles, PC, SP, X, Y, A, B, CC, regbase, pending, ready, promoted, ccmask,
+     count) = HeaderFormat.unpack_from(buf, 0)
+    if version != FormatVersion:
+      raise SaveStateError(f'"{filename}" is a version {version} save-state file, expected version {FormatVersion}')
+
+    snap = ucSnapshot()
+    snap.cycles = cycles
+    snap.registers = (PC, SP, X, Y, A, B, CC)
+    snap.regbase = regbase
+    snap.interrupts = (pending, ready, promoted, ccmask)
+
+    pos = HeaderFormat.size
+    snap.pages = tuple(buf[pos+page*256:pos+(page+1)*256] for page in range(PageCount))
+    pos += MemorySize
+
+    peripherals = []
+    try:
+      for i in range(count):
+        text, pos = decodeValue(buf, pos)
+        state, pos = decodeValue(buf, pos)
+        peripherals.append((text, state))
+    except (struct.error, UnicodeDecodeError):
+      raise SaveStateError(f'"{filename}" is truncated or corrupt')
+    snap.peripherals = tuple(peripherals)
+  return snap
+
+def saveState(sim, filename):
+  'Save the state of a SimState to a save-state file'
+  writeSnapshot(sim.snapshot(), filename)
+
+def loadState(sim, filename):
+  '''Bring a SimState to the state saved in a save-state file. The SimState
+  must have the same peripherals installed as the one that was saved.'''
+  sim.restore(readSnapshot(filename))
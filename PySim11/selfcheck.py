@@ -0,0 +1,65 @@
+'''
+Consistency checks of the execution recorders
+
+Runs a small program, whose main loop calls subroutines while the real-time
+interrupt is taken, with the call graph alone and then together with the
+other recorders (coverage, profiler and tracer), and checks that the call
+graph sees the same routines, interrupt service routine and latencies in
+every case, since the recorders share the dispatch of interrupts (see
+SimState.recorder()).
+
+  python -m PySim11.selfcheck
+'''
+
+import sys
+
+# Main program at $2000: enable the real-time interrupt, then call a
+# subroutine ($2010) that calls another one ($2017) forever
+MainCode = bytes.fromhex('8E00FF 8640 B71024 0E BD2010 20FB 0101 8605 8D03 39 0101 4A 26FD 39'.replace(' ', ''))
+# Real-time interrupt service routine at $2100, which clears the flag and
+# calls the second subroutine through JSR ,Y
+ISRCode = bytes.fromhex('8640 B71025 8603 18CE2017 18AD00 3B'.replace(' ', ''))
+ISR = 0x2100
+Cycles = 200000
+
+def runProgram(coverage=0, profiler=0, tracer=0):
+  '''Run the program with the call graph and the recorders given. Returns
+  (routines, latencies, maxDepth, cycles recorded): the first two as sorted
+  lists of tuples.'''
+  from PySim11 import PySim11
+  sim = PySim11.SimState(None, lambda s: None)
+  A = sim.ucMemory.Array
+  A[0x2000:0x2000+len(MainCode)] = MainCode
+  A[ISR:ISR+len(ISRCode)] = ISRCode
+  A[0xFFF0:0xFFF2] = ISR.to_bytes(2, 'big')
+  sim.ucState.setPC(0x2000)
+
+  C = sim.enableCallGraph(1)
+  if coverage: sim.enableCoverage(1)
+  if profiler: sim.enableProfiler(1)
+  if tracer: sim.enableTracer(1)
+  sim.step(0, 0, Cycles)
+  if tracer: sim.enableTracer(0)
+
+  routines = sorted((r.addr, r.calls, r.inclusive, r.exclusive, r.interrupt) for r in C.routines.values())
+  latencies = sorted((l.source, l.count, l.total, l.worst) for l in C.latencies.values())
+  return routines, latencies, C.maxDepth, C.elapsed()[0]
+
+def main(arglist=None):
+  expected = runProgram()
+  routines, latencies, depth, cycles = expected
+  errors = []
+  if not any(r[0] == ISR and r[1] and r[4] for r in routines): errors.append('call graph: no return from the interrupt service routine')
+  if not latencies: errors.append('call graph: no interrupt latency recorded')
+  if cycles != Cycles: errors.append(f'call graph: {cycles} cycles recorded, expected {Cycles}')
+
+  for opts in ({'coverage': 1}, {'profiler': 1}, {'tracer': 1}, {'coverage': 1, 'profiler': 1, 'tracer': 1}):
+    if runProgram(**opts) != expected:
+      errors.append('call graph with %s: differs from the call graph alone' % ', '.join(opts))
+
+  for e in errors: print(e)
+  print('%d check%s failed' % (len(errors), '' if len(errors) == 1 else 's') if errors else 'All checks passed')
+  return 1 if errors else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -5,8 +5,6 @@ This module abstracts the state of the 68HC11
 import sys
 import string
 
-from safestruct import *
-
 ccbits = 'sxhinzvc'
 CC_S = 0x80
 CC_X = 0x40
@@ -17,25 +15,83 @@ CC_Z = 0x04
 CC_V = 0x02
 CC_C = 0x01
 
-class ucState(SafeStruct):
+# Registers that can be watched, see ucState.watch()
+Registers = ('PC', 'SP', 'X', 'Y', 'A', 'B', 'D', 'CC')
+
+# The register file. Registers are slots rather than SafeStruct members: a
+# slot is faster to get and set than an instance dictionary entry and a
+# misspelled member still raises AttributeError, as with TrappingStruct.
+#
+# Condition codes are evaluated lazily. An ALU instruction calls lazyFlags()
+# with the operands of its operation and the function that computes its
+# flags instead of computing them itself. The flags are only computed when
+# CC is read (a branch, TPA, an interrupt stack frame, a register display,
+# etc.) Most of them are overwritten by a later instruction before that.
+#
+# The setters of this class just store the new value. While at least one
+# handler is watching a register (see watch()), the object is switched over
+# to the ucStateWatched subclass, whose setters call the handlers of the
+# register first, as h(state, newvalue). The common case of no handlers
+# thus doesn't pay for a loop over empty lists on every register change.
+class ucState:
+  __slots__ = ('PC', 'SP', 'X', 'Y', 'A', 'B', 'rawCC',
+               'flagMask', 'flagFn', 'flagU1', 'flagU2',
+               'PChandlers', 'SPhandlers', 'Xhandlers', 'Yhandlers',
+               'Ahandlers', 'Bhandlers', 'Dhandlers', 'CChandlers')
+
   def __init__(self):
-    super().__init__({
-       'PC': 0,
-       'SP': 0,
-       'X': 0,
-       'Y': 0,
-       'A': 0,
-       'B': 0,
-       'CC': 0x55,
-       'PChandlers': [],
-       'SPhandlers': [],
-       'Xhandlers': [],
-       'Yhandlers': [],
-       'Ahandlers': [],
-       'Bhandlers': [],
-       'Dhandlers': [],
-       'CChandlers': []
-    })
+    self.PC = 0
+    self.SP = 0
+    self.X = 0
+    self.Y = 0
+    self.A = 0
+    self.B = 0
+    self.rawCC = 0x55     # CC, except for the bits in flagMask
+    self.flagMask = 0     # CC bits yet to be computed as flagFn(flagU1, flagU2)[1]
+    self.flagFn = None
+    self.flagU1 = 0
+    self.flagU2 = 0
+    self.PChandlers = []
+    self.SPhandlers = []
+    self.Xhandlers = []
+    self.Yhandlers = []
+    self.Ahandlers = []
+    self.Bhandlers = []
+    self.Dhandlers = []
+    self.CChandlers = []
+
+  def watch(self, reg, handler):
+    getattr(self, reg + 'handlers').append(handler)
+    self.__class__ = ucStateWatched
+
+  def unwatch(self, reg, handler):
+    getattr(self, reg + 'handlers').remove(handler)
+    if not any(getattr(self, r + 'handlers') for r in Registers):
+      self.__class__ = ucState
+
+  def getCC(self):
+    if self.flagMask: self.evalFlags()
+    return self.rawCC
+
+  def putCC(self, CC):
+    self.flagMask = 0
+    self.rawCC = CC
+
+  CC = property(getCC, putCC)
+
+  def evalFlags(self):
+    mask = self.flagMask
+    self.rawCC = self.rawCC & ~mask | self.flagFn(self.flagU1, self.flagU2)[1] & mask
+    self.flagMask = 0
+
+  # The CC bits in 'mask' are to be set as computed by fn(u1, u2), which
+  # returns a (result, flags) tuple like ops.add8() and friends.
+  def lazyFlags(self, mask, fn, u1, u2):
+    if self.flagMask & ~mask: self.evalFlags()
+    self.flagMask = mask
+    self.flagFn = fn
+    self.flagU1 = u1
+    self.flagU2 = u2
 
   def display(self, write=None):
     if not write: write = sys.stdout.write
@@ -48,40 +104,95 @@ class ucState(SafeStruct):
       else: c = '.'           #print just a dot for clear bits
       write(f'{c}')
 
+  def setA(self, A): self.A = A
+  def setB(self, B): self.B = B
+  def setX(self, X): self.X = X
+  def setY(self, Y): self.Y = Y
+  def setPC(self, PC): self.PC = PC
+  def setSP(self, SP): self.SP = SP
+  def setCC(self, CC): self.CC = CC
+
+  def D(self): return self.A*256 + self.B
+
+  def setD(self, D): self.A, self.B = divmod(D, 256)
+
+  def setHNZVC(self, flags): self.CC = self.CC & 0xD0 | flags
+  def setNZVC(self, flags): self.CC = self.CC & 0xF0 | flags
+  def setNZV(self, flags): self.CC = self.CC & 0xF1 | flags
+  def setZVC(self, flags): self.CC = self.CC & 0xF8 | flags
+  def setC(self, flags): self.CC = self.CC & 0xFE | flags
+  def setI(self, flags): self.CC = self.CC & 0xEF | flags
+  def setV(self, flags): self.CC = self.CC & 0xFD | flags
+  def setZ(self, flags): self.CC = self.CC & 0xFB | flags
+  def setXbit(self, flags): self.CC = self.CC & 0xBF | flags
+
+  def isCarrySet(self): return 1 if self.CC & CC_C else 0
+  def isZeroSet(self): return 1 if self.CC & CC_Z else 0
+  def isNegativeSet(self): return 1 if self.CC & CC_N else 0
+  def isOverflowSet(self): return 1 if self.CC & CC_V else 0
+  def isStopSet(self): return 1 if self.CC & CC_S else 0
+  def isHalfSet(self): return 1 if self.CC & CC_H else 0
+  def isXSet(self): return 1 if self.CC & CC_X else 0
+  def isISet(self): return 1 if self.CC & CC_I else 0
+
+  def push8(self, memory, data):
+    memory.writeUns8(self.SP, data)
+    self.setSP(self.SP-1 & 0xFFFF)
+
+  def push16(self, memory, data):
+    ea = self.SP-1 & 0xFFFF
+    memory.writeUns16(ea, data)
+    self.setSP(self.SP-2 & 0xFFFF)
+
+  def pull8(self, memory):
+    self.setSP(self.SP+1 & 0xFFFF)
+    return memory.readUns8(self.SP)
+
+  def pull16(self, memory):
+    ea = self.SP+1 & 0xFFFF
+    self.setSP(self.SP+2 & 0xFFFF)
+    return memory.readUns16(ea)
+
+# Observing setters, in use while handlers are watching registers
+class ucStateWatched(ucState):
+  __slots__ = ()
+
   def setA(self, A):
-    for h in self.Ahandlers: h(*self, A)
+    for h in self.Ahandlers: h(self, A)
     self.A = A
 
   def setB(self, B):
-    for h in self.Bhandlers: h(*self, B)
+    for h in self.Bhandlers: h(self, B)
     self.B = B
 
   def setX(self, X):
-    for h in self.Xhandlers: h(*self, X)
+    for h in self.Xhandlers: h(self, X)
     self.X = X
 
   def setY(self, Y):
-    for h in self.Yhandlers: h(*self, Y)
+    for h in self.Yhandlers: h(self, Y)
     self.Y = Y
 
   def setPC(self, PC):
-    for h in self.PChandlers: h(*self, PC)
+    for h in self.PChandlers: h(self, PC)
     self.PC = PC
 
   def setSP(self, SP):
-    for h in self.SPhandlers: h(*self, SP)
+    for h in self.SPhandlers: h(self, SP)
     self.SP = SP
 
   def setCC(self, CC):
-    for h in self.CChandlers: h(*self, CC)
+    for h in self.CChandlers: h(self, CC)
     self.CC = CC
 
-  def D(self): return self.A*256 + self.B
-
   def setD(self, D):
-    for h in self.Dhandlers: h(*self, D)
+    for h in self.Dhandlers: h(self, D)
     self.A, self.B = divmod(D, 256)
 
+  # CC handlers see every change, so flags can't be deferred
+  def lazyFlags(self, mask, fn, u1, u2):
+    self.setCC(self.CC & ~mask | fn(u1, u2)[1] & mask)
+
   def setHNZVC(self, flags): self.setCC(self.CC & 0xD0 | flags)
   def setNZVC(self, flags): self.setCC(self.CC & 0xF0 | flags)
   def setNZV(self, flags): self.setCC(self.CC & 0xF1 | flags)
@@ -92,29 +203,20 @@ class ucState(SafeStruct):
   def setZ(self, flags): self.setCC(self.CC & 0xFB | flags)
   def setXbit(self, flags): self.setCC(self.CC & 0xBF | flags)
 
-  def isCarrySet(self): return 1 if self.CC & CC_C else 0
-  def isZeroSet(self): return 1 if self.CC & CC_Z else 0
-  def isNegativeSet(self): return 1 if self.CC & CC_N else 0
-  def isOverflowSet(self): return 1 if self.CC & CC_V else 0
-  def isStopSet(self): return 1 if self.CC & CC_S else 0
-  def isHalfSet(self): return 1 if self.CC & CC_H else 0
-  def isXSet(self): return 1 if self.CC & CC_X else 0
-  def isISet(self): return 1 if self.CC & CC_I else 0
-
-  def push8(self, memory, data):
-    memory.writeUns8(self.SP, data)
-    self.setSP(self.SP-1 & 0xFFFF)
-
-  def push16(self, memory, data):
-    ea = self.SP-1 & 0xFFFF
-    memory.writeUns16(ea, data)
-    self.setSP(self.SP-2 & 0xFFFF)
-
-  def pull8(self, memory):
-    self.setSP(self.SP+1 & 0xFFFF)
-    return memory.readUns8(self.SP)
-
-  def pull16(self, memory):
-    ea = self.SP+1 & 0xFFFF
-    self.setSP(self.SP+2 & 0xFFFF)
-    return memory.readUns16(ea)
+if __name__ == "__main__":
+  S = ucState()
+  log = []
+  S.setA(1)
+  def watcher(st, CC): log.append(CC)
+  S.watch('CC', watcher)
+  assert S.__class__ is ucStateWatched
+  S.setNZVC(0x0F)
+  S.lazyFlags(0x0E, lambda u1, u2: (0, u1 | u2), 0x08, 0x02)
+  S.setA(2)
+  S.unwatch('CC', watcher)
+  assert S.__class__ is ucState
+  S.setCC(0)
+  S.lazyFlags(0x0F, lambda u1, u2: (0, u1 | u2), 0x04, 0x01)
+  S.lazyFlags(0x0E, lambda u1, u2: (0, u1 | u2), 0x08, 0x00)
+  assert log == [0x5F, 0x5B] and (S.A, S.CC) == (2, 0x09), (log, S.A, S.CC)
+  print('ucState OK')
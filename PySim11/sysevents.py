@@ -36,6 +36,9 @@ class SystemEvents(SafeStruct):
     try: self.handlers[event].append(handler)
     except: self.handlers[event] = [handler]
 
+  def removeHandler(self, event, handler):
+    self.handlers[event].remove(handler)
+
   def notifyEvent(self, event, args=()):
     assert hasattr(self, event)
     if event in self.handlers:
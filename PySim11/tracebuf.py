@@ -0,0 +1,143 @@
+'''
+Binary instruction trace
+
+A TraceBuffer records every instruction executed, as a fixed-size binary
+record, into a ring buffer: a preallocated bytearray or a memory-mapped file.
+Recording an instruction is a single struct.pack_into(), so tracing a whole
+program is much cheaper than the text trace of SimState.step(), and the
+result can be post-processed. Use tracedump.py to decode a trace file.
+
+A trace file (written by save(), or directly when the buffer is a file) is
+big-endian:
+
+  Header (HeaderFormat)
+    Magic       8 bytes, 'PySim11T'
+    Version     16 bits, FormatVersion
+    RecordSize  16 bits
+    Capacity    32 bits, number of record slots
+    Count       64 bits, number of records written in all
+  Records       Capacity slots of RecordSize bytes (RecordFormat). Once Count
+                exceeds Capacity, the oldest record is in slot Count % Capacity.
+
+Each record holds the cycle an instruction started on, its PC, the next 5
+bytes of memory at the PC (enough for any instruction) and the registers A,
+B, X, Y, SP and CC *before* the instruction executes. An interrupt taken
+before an instruction has already been stacked, so the PC is that of the
+first instruction of the service routine.
+'''
+
+import mmap
+import struct
+
+from safestruct import *
+
+import PySim11.G as G
+
+Magic = b'PySim11T'
+FormatVersion = 1
+
+HeaderFormat = struct.Struct('>8sHHIQ')
+RecordFormat = struct.Struct('>QH5sBBHHHB')
+
+class TraceError(Exception): pass
+
+class TraceBuffer(SafeStruct):
+  def __init__(self, sim, capacity=None, filename=None):
+    super().__init__({
+      'sim': sim,
+      'capacity': capacity or G.TraceCapacity,
+      'buffer': None,     # bytearray or mmap, a header followed by the records
+      'file': None,       # The open file, for a memory-mapped buffer
+      'record': None,     # Called before every instruction, see makeRecorder()
+      'count': None       # Returns the number of records written in all
+    })
+    size = HeaderFormat.size + self.capacity*RecordFormat.size
+    if filename:
+      self.file = open(filename, 'w+b')
+      self.file.truncate(size)
+      self.buffer = mmap.mmap(self.file.fileno(), size)
+    else: self.buffer = bytearray(size)
+    self.makeRecorder()
+    self.flush()
+
+  def makeRecorder(self):
+    sim = self.sim
+    st = sim.ucState
+    A = sim.ucMemory.Array
+    buf = self.buffer
+    pack = RecordFormat.pack_into
+    size = RecordFormat.size
+    base = HeaderFormat.size
+    end = base + self.capacity*size
+    pos = base
+    laps = 0
+
+    def record():
+      nonlocal pos, laps
+      PC = st.PC
+      pack(buf, pos, sim.cycles, PC, A[PC:PC+5], st.A, st.B, st.X, st.Y, st.SP, st.CC)
+      pos += size
+      if pos == end:
+        pos = base
+        laps += 1
+
+    def count(): return laps*self.capacity + (pos-base)//size
+
+    self.record = record
+    self.count = count
+
+  def flush(self):
+    # Bring the header up to date. SimState.step() calls this when it stops.
+    HeaderFormat.pack_into(self.buffer, 0, Magic, FormatVersion, RecordFormat.size, self.capacity, self.count())
+    if self.file: self.buffer.flush()
+
+  def close(self):
+    self.flush()
+    if self.file:
+      self.buffer.close()
+      self.file.close()
+      self.file = None
+
+  def records(self):
+    'Return a list of the records held, oldest first, as RecordFormat tuples'
+    return list(iterRecords(self.buffer, self.capacity, self.count()))
+
+  def save(self, filename):
+    'Write the records held to a trace file, oldest first'
+    count = self.count()
+    held = min(count, self.capacity)
+    base = HeaderFormat.size
+    size = RecordFormat.size
+    first = count % self.capacity if count > self.capacity else 0
+    with open(filename, 'wb') as fid:
+      fid.write(HeaderFormat.pack(Magic, FormatVersion, size, held, held))
+      fid.write(self.buffer[base+first*size:base+held*size])
+      fid.write(self.buffer[base:base+first*size])
+
+def iterRecords(buf, capacity, count):
+  'Yield the records of a trace buffer, oldest first, as RecordFormat tuples'
+  unpack = RecordFormat.unpack_from
+  size = RecordFormat.size
+  base = HeaderFormat.size
+  held = min(count, capacity)
+  first = count % capacity if count > capacity else 0
+  for i in range(held):
+    yield unpack(buf, base + (first+i) % capacity*size)
+
+def readTrace(filename):
+  '''Return the records of a trace file, oldest first, as a list of
+  RecordFormat tuples. Raises TraceError if the file isn't a trace file of
+  this version.'''
+  with open(filename, 'rb') as fid:
+    try: buf = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError: raise TraceError(f'"{filename}" is empty')
+
+  with buf:
+    if len(buf) < HeaderFormat.size or buf[:len(Magic)] != Magic:
+      raise TraceError(f'"{filename}" is not a trace file')
+    magic, version, size, capacity, count = HeaderFormat.unpack_from(buf, 0)
+    if version != FormatVersion or size != RecordFormat.size:
+      raise TraceError(f'"{filename}" is a version {version} trace file, expected version {FormatVersion}')
+    if len(buf) < HeaderFormat.size + min(count, capacity)*size:
+      raise TraceError(f'"{filename}" is truncated')
+    return list(iterRecords(buf, capacity, count))
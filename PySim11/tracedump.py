@@ -0,0 +1,117 @@
+'''
+Offline decoder for binary instruction traces
+
+Prints the instructions recorded in a trace file (see tracebuf.py), one per
+line: the cycle the instruction started on, its address, bytes, cycle count
+and disassembly, and the registers before it executed. With a MAP file, each
+line is preceded by the source file name and line number of the instruction.
+
+  python -m PySim11.tracedump [Options] trace.bin
+'''
+
+import sys
+import os
+import getopt
+
+import PySim11.ops as ops
+import PySim11.asm as asm
+import PySim11.mapsym as mapsym
+import PySim11.tracebuf as tracebuf
+from PySim11.ops import IMM8, IMM16, EXT, DIR, INDX, INDY, INH, REL, BIT2DIR, BIT2INDX, BIT2INDY, BIT3DIR
+
+def usage(arglist):
+  print('''\
+Usage:
+  python -m PySim11.tracedump [Options] trace.bin
+
+Options:
+  -m, --map=file   -- Load a MAP file to show source file names and lines
+  -n, --last=N     -- Only print the last N instructions
+  -h, --help       -- Display this help summary\
+''')
+  sys.exit(1)
+
+def decodeInstruction(code, PC):
+  '''Decode the instruction whose bytes start 'code' and that is at address
+  PC. Returns (instr, mode, cycles, parms, length), where parms is as
+  returned by SimState.decode() (except that indexed addresses are None)
+  and length is the number of bytes of the instruction.'''
+  op = ops.OpTable[code[0]]
+  n = 1
+  if op.__class__ is list:
+    op = op[code[1]]
+    n = 2
+  if op is None: return ('ILLOP', INH, 0, (), n)
+
+  instr, mode, cycles = op[:3]
+  length = n + ops.ModeBytes[mode]
+  b = code[n:length]
+  nextPC = PC + length & 0xFFFF
+
+  if mode == INH: parms = ()
+  elif mode == IMM8: parms = (None, b[0], None)
+  elif mode == IMM16: parms = (None, b[0]<<8 | b[1], None)
+  elif mode == EXT: parms = (b[0]<<8 | b[1], None, None)
+  elif mode == DIR: parms = (b[0], None, None)
+  elif mode in (INDX, INDY): parms = (None, None, b[0])
+  elif mode == REL: parms = (nextPC + (b[0] ^ 0x80) - 0x80 & 0xFFFF,)
+  elif mode == BIT2DIR: parms = (b[0], b[1], None)
+  elif mode in (BIT2INDX, BIT2INDY): parms = (None, b[1], b[0])
+  else:
+    newpc = nextPC + (b[2] ^ 0x80) - 0x80 & 0xFFFF
+    if mode == BIT3DIR: parms = (b[0], b[1], newpc, None)
+    else: parms = (None, b[1], newpc, b[0])
+  return (instr, mode, cycles, parms, length)
+
+def formatRecord(rec, mapfile=None):
+  cycle, PC, code, A, B, X, Y, SP, CC = rec
+  instr, mode, cycles, parms, length = decodeInstruction(code, PC)
+  s = '%10d  ' % cycle
+  if mapfile:
+    try:
+      srcline, fname, linenum = mapfile.addrmap[PC]
+      s += '%s:%d  ' % (fname, linenum)
+    except KeyError: pass
+  s += asm.dasm_line(PC, code[:length], instr, mode, parms, cycles)
+  return '%-66s A-%02X B-%02X X-%04X Y-%04X SP-%04X CCR-%02X' % (s, A, B, X, Y, SP, CC)
+
+def dump(records, mapfile=None, write=sys.stdout.write):
+  for rec in records: write(formatRecord(rec, mapfile) + '\n')
+
+def main(arglist=None):
+  if not arglist: arglist = sys.argv
+  try:
+    optlist, args = getopt.gnu_getopt(arglist[1:], 'hm:n:', ['help', 'map=', 'last='])
+  except getopt.error as detail:
+    print('Option error:', detail)
+    usage(arglist)
+
+  mapname = None
+  last = None
+  try:
+    for w, val in optlist:
+      if w in ['-h', '--help']: usage(arglist)
+      elif w in ['-m', '--map']: mapname = val
+      elif w in ['-n', '--last']: last = int(val, 0)
+  except ValueError as detail:
+    print('Option error:', detail)
+    usage(arglist)
+  if len(args) != 1: usage(arglist)
+
+  try:
+    records = tracebuf.readTrace(args[0])
+    mapfile = None
+    if mapname:
+      with open(mapsym.add_extension(mapname), 'rt') as fid:
+        mapfile = mapsym.MapFile(fid, os.path.dirname(mapname) or '.')
+  except Exception as detail:
+    print(detail)
+    return 1
+
+  if last is not None: records = records[-last:] if last else []
+  try: dump(records, mapfile)
+  except BrokenPipeError: pass
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,145 @@
+'''
+Data watchpoints
+
+A watchpoint stops execution when the program reads, writes or changes
+(writes a different value to) any byte in a range of addresses, optionally
+only when the byte's value satisfies a condition, e.g., '= $FF'. The value
+tested is the one written, or the one read.
+
+Every watchpoint is a memory filter (see memory.py) over its range, so it is
+checked in the same I/O dispatch path as the peripheral registers and
+costs nothing for accesses to the 256-byte pages it doesn't cover. The
+filter also covers the byte before the range, so that a 16-bit access that
+starts there is seen.
+
+The instruction that triggers a watchpoint (for the registers stacked by an
+interrupt, the first instruction of the service routine) runs to
+completion: the filter only notes the hit and brings the next peripheral
+event forward, and SimState.runEvents(), which runs right after the
+instruction, calls stopIfHit() to raise WatchpointHit. SimState.step()
+returns STOP_WATCHPOINT when it catches it. Accesses made from the debugger
+between runs are not watched.
+'''
+
+import operator
+
+from safestruct import *
+
+import PySim11.memory as memory
+
+# Accesses a watchpoint is triggered by (ucWatchpoint.kind bits)
+WP_READ   = 1
+WP_WRITE  = 2
+WP_CHANGE = 4     # A write of a value different from the one in memory
+
+KindNames = {WP_READ: 'R', WP_WRITE: 'W', WP_READ | WP_WRITE: 'RW', WP_CHANGE: 'C'}
+
+Conditions = {
+  '=':  operator.eq,
+  '==': operator.eq,
+  '!=': operator.ne,
+  '<':  operator.lt,
+  '<=': operator.le,
+  '>':  operator.gt,
+  '>=': operator.ge
+}
+
+class WatchpointHit(Exception): pass
+
+class ucWatchpoint(SafeStruct):
+  def __init__(self, low, high, kind=WP_WRITE, cond=None):
+    super().__init__({
+      'low': low,         # First and last address watched
+      'high': high,
+      'kind': kind,       # WP_READ, WP_WRITE and WP_CHANGE bits
+      'cond': cond,       # None, or an (operator, value) tuple, with an operator in Conditions
+      'hits': 0,          # Number of times it triggered
+      'filter': None      # The ucMemoryFilter installed for it
+    })
+
+  def describe(self):
+    s = '$%04X' % self.low
+    if self.high != self.low: s += '-$%04X' % self.high
+    s += ' ' + KindNames[self.kind]
+    if self.cond: s += ' if %s $%02X' % self.cond
+    return s
+
+class Watchpoints(SafeStruct):
+  def __init__(self, sim):
+    super().__init__({
+      'sim': sim,
+      'list': [],         # The ucWatchpoint objects, in the order they were added
+      'active': 0,        # Set while the simulation is running
+      'hit': None         # Message for the first watchpoint hit by the current instruction
+    })
+    sim.ucEvents.addHandler(sim.ucEvents.SimStart, self.OnSimStart)
+    sim.ucEvents.addHandler(sim.ucEvents.SimEnd, self.OnSimEnd)
+
+  def __len__(self): return len(self.list)
+  def __iter__(self): return iter(self.list)
+  def __getitem__(self, index): return self.list[index]
+
+  def OnSimStart(self, event):
+    self.hit = None
+    self.active = 1
+
+  def OnSimEnd(self, event): self.active = 0
+
+  def add(self, low, high=None, kind=WP_WRITE, cond=None):
+    '''Add a watchpoint on the addresses from 'low' through 'high' (or just
+    'low') and return it. 'cond' is None or an (operator, value) tuple.'''
+    if high is None: high = low
+    if low > high: raise ValueError('Address 2 is lower than address 1')
+    if cond is not None and cond[0] not in Conditions: raise ValueError(f'Unknown condition "{cond[0]}"')
+    wp = ucWatchpoint(low, high, kind, cond)
+    wp.filter = memory.ucMemoryFilter(max(low-1, 0), high, self.makeHandler(wp))
+    self.sim.ucMemory.addFilter(wp.filter)
+    self.list.append(wp)
+    return wp
+
+  def remove(self, wp):
+    self.list.remove(wp)
+    self.sim.ucMemory.removeFilter(wp.filter)
+
+  def __delitem__(self, index): self.remove(self.list[index])
+
+  def clear(self):
+    for wp in list(self.list): self.remove(wp)
+
+  def makeHandler(self, wp):
+    sim = self.sim
+    A = sim.ucMemory.Array
+    low = wp.low
+    high = wp.high
+    kind = wp.kind
+    test = None
+    if wp.cond: test, ref = Conditions[wp.cond[0]], wp.cond[1]
+
+    def handler(addr, bits, val, rw):
+      if not self.active: return
+      for i in range(bits >> 3):
+        a = addr+i & 0xFFFF
+        if not low <= a <= high: continue
+        if rw:
+          new = val >> 8 if bits == 16 and i == 0 else val & 0xFF
+          if not (kind & WP_WRITE or kind & WP_CHANGE and new != A[a]): continue
+        elif kind & WP_READ: new = A[a]
+        else: continue
+        if test and not test(new, ref): continue
+
+        wp.hits += 1
+        if self.hit is None:
+          if rw: self.hit = 'Watchpoint #%d: $%02X written to $%04X (was $%02X)' % (self.list.index(wp), new, a, A[a])
+          else: self.hit = 'Watchpoint #%d: $%02X read from $%04X' % (self.list.index(wp), new, a)
+          # Have SimState.runEvents() called after this instruction
+          sim.nextEvent = 0
+        return
+
+    return handler
+
+  def stopIfHit(self):
+    # Called by SimState.runEvents()
+    if self.hit is not None:
+      hit = self.hit
+      self.hit = None
+      raise WatchpointHit(hit)
@@ -5,12 +5,13 @@ Command-line interface to PySim11 that mimics the Motorola 68HC11 EVBU
 import sys
 import os
 import string
+import re
 import cmdbase
 from safestruct import *
 import EVBUoptions
 from EVBUutil import *
 from G import *
-from PySim11 import asm,ops,mapsym,PySim11,BFORCE_ALWAYS,BFORCE_NEVER
+from PySim11 import asm,ops,mapsym,savestate,history,watchpoints,expr,PySim11,BFORCE_ALWAYS,BFORCE_NEVER
 from PySim11.s19 import *
 
 class EVBUCmd(cmdbase.Cmdbase):
@@ -162,7 +163,7 @@ This command fills the range of memory from Addr1 through Addr2 with the \
 ''')
 
   def do_br(self, line):
-    "BR [<address> | -<bpnum> | -all]"
+    "BR [<address> [<count>] [if <expr>] | -<bpnum> | -all]"
     if len(line) == 0:
       if len(self.simstate.BPlist) == 0:
         self.write('No breakpoints\n')
@@ -181,11 +182,18 @@ This command fills the range of memory from Addr1 through Addr2 with the \
       do_remove = 1
       line = line[1:]
       if line == 'all':
-        self.simstate.BPlist = []
+        self.simstate.BPlist.clear()
         self.write('All breakpoints deleted\n')
         return
 
-    try: addr = getu16(line, self.simstate)
+    cond = None
+    m = re.search(r'\s+if\s+', line, re.IGNORECASE)
+    if m and not do_remove:
+      line, cond = line[:m.start()], line[m.end():].strip()
+    try:
+      addr, count = getu16optu16(line, self.simstate) if not do_remove else (getu16(line, self.simstate), None)
+      if count == 0: raise ValueError('The count must be at least 1')
+      action = expr.condition(cond, self.simstate) if cond else None
     except Exception as detail:
       self.write(str(detail)+'\n')
       return
@@ -209,20 +217,91 @@ This command fills the range of memory from Addr1 through Addr2 with the \
           if sym: text += f' ({sym})'
         except: pass
       except: pass
+    if cond: text += f' if {cond}'
     br = PySim11.ucBreakpoint()
     br.addr = addr
     br.text = text
+    br.action = action
+    if count: br.count = br.basecount = count
     self.simstate.BPlist.append(br)
     self.write('Breakpoint added at $%04X\n' % addr)
 
   def help_br(self): self.write('''\
-BR [<address> | -<bpnum> | -all]
+BR [<address> [<count>] [if <expr>] | -<bpnum> | -all]
 This command manages breakpoints. The first form, 'BR <address>' adds a \
 breakpoint at the specified address (which may be a symbol if a MAP file is \
-loaded). The second form, 'BR -<bpnum>' removes a breakpoint whose number is \
+loaded). With a count, execution stops the <count>th time the breakpoint is \
+reached. With a condition, such as 'BR LOOP if A == 0 && w[PTR] >= $2000', \
+the breakpoint is only counted when the expression is true (nonzero). \
+Expressions may use numbers, MAP file symbols, the registers A, B, D, X, Y, \
+SP, PC and CC, CYCLES (the cycle counter), [<expr>] for the byte at an \
+address and w[<expr>] for the word there, the operators || && | ^ & == != \
+< <= > >= << >> + - * / % and parentheses, and the unary operators - ~ and !. \
+The expression is compiled when the breakpoint is added, so symbols are those \
+of the MAP file loaded then. The second form, 'BR -<bpnum>' removes a breakpoint whose number is \
 given. The first breakpoint is 0. Breakpoint numbers can be found by issuing \
 a 'BR' command by itself which simply lists all breakpoints. The final form \
 of this command, 'BR -all' removes all breakpoints.
+''')
+
+  def do_wp(self, line):
+    "WP [<address> [<address2>] ['r' | 'w' | 'rw' | 'c'] [<op> <value>] | -<wpnum> | -all]"
+    W = self.simstate.watchpoints
+    if len(line) == 0:
+      if len(W) == 0:
+        self.write('No watchpoints\n')
+        return
+
+      self.write('Num  Hits Watchpoint\n')
+      self.write('--- ----- -------------------------------\n')
+      for cnt in range(len(W)): self.write('%3d %5d %s\n' % (cnt, W[cnt].hits, W[cnt].describe()))
+      return
+
+    if line[0] == '-':
+      if line[1:] == 'all':
+        W.clear()
+        self.write('All watchpoints deleted\n')
+        return
+      try: num = getu16(line[1:], self.simstate)
+      except Exception as detail:
+        self.write(str(detail)+'\n')
+        return
+      if num >= len(W):
+        self.write('Illegal watchpoint number\n')
+        return
+      del W[num]
+      self.write('Watchpoint #%d deleted\n' % num)
+      return
+
+    kinds = {'r': watchpoints.WP_READ, 'w': watchpoints.WP_WRITE,
+             'rw': watchpoints.WP_READ | watchpoints.WP_WRITE, 'c': watchpoints.WP_CHANGE}
+    try:
+      cond = None
+      m = re.search(r'(==|!=|<=|>=|=|<|>)\s*(\S+)\s*$', line)
+      if m:
+        cond = (m.group(1), parseu8(m.group(2), self.simstate))
+        line = line[:m.start()]
+      fields = line.split()
+      kind = watchpoints.WP_WRITE
+      if len(fields) > 1 and fields[-1].lower() in kinds: kind = kinds[fields.pop().lower()]
+      addr1, addr2 = getu16optu16(' '.join(fields), self.simstate)
+      wp = W.add(addr1, addr2, kind, cond)
+    except Exception as detail:
+      self.write(str(detail)+'\n')
+      return
+    self.write('Watchpoint added at %s\n' % wp.describe())
+
+  def help_wp(self): self.write('''\
+WP [<address> [<address2>] ['r' | 'w' | 'rw' | 'c'] [<op> <value>] | -<wpnum> | -all]
+This command manages data watchpoints, which stop execution right after an \
+instruction reads ('r'), writes ('w', the default), reads or writes ('rw') \
+or changes ('c', writes a different value to) a byte from the first address \
+through the second (or just the first address). With a condition, such as \
+'= $FF' or '< 10', the watchpoint only triggers when the byte read or written \
+satisfies it; the operators are =, !=, <, <=, > and >=. Use $C for address \
+$C so as not to confuse it with the 'c' type. 'WP -<wpnum>' removes a \
+watchpoint whose number is given, 'WP -all' removes all of them and 'WP' by \
+itself lists them, with the number of times each one triggered.
 ''')
 
   def do_bulk(self, line):
@@ -269,8 +348,7 @@ corresponding RTS instruction terminates execution.
     "CYC ['reset']"
     if len(line):
       if line == 'reset':
-        self.simstate.cycles = 0
-        self.simstate.ucEvents.notifyEvent(self.simstate.ucEvents.CycReset)
+        self.simstate.resetCycles()
       else:
         self.write('Illegal argument. Type "help cyc" for usage information\n')
       return
@@ -292,8 +370,7 @@ clears) the parallel I/O waveform display.
         return
       self.simstate.ucState.setPC(addr)
 
-    self.simstate.cycles = 0
-    self.simstate.ucEvents.notifyEvent(self.simstate.ucEvents.CycReset)
+    self.simstate.resetCycles()
 
     self.simstate.step()
     self.simstate.ucState.display(self.write)
@@ -326,9 +403,18 @@ Change the working directory to the one specified. If no directory is \
 specified, the current one is displayed.
 ''')
 
+  def parseImage(self, line):
+    # Split 'filename [<address>]', the address being that of a binary image
+    words = line.rsplit(None, 1)
+    if len(words) == 2 and imageFormat(words[0]) == 'bin':
+      return words[0], getu16(words[1], self.simstate)
+    return line, None
+
   def do_load(self, line):
-    "LOAD <filename>"
-    try: addr, diag = ReadS19(line, self.simstate.ucMemory)
+    "LOAD <filename> [<address>]"
+    try:
+      line, base = self.parseImage(line)
+      addr, diag = ReadImage(line, self.simstate.ucMemory, base)
     except Exception as detail:
       if detail: self.write(str(detail)+'\n')
       return
@@ -339,9 +425,54 @@ specified, the current one is displayed.
     if statusstr: self.write(statusstr+'\n')
 
   def help_load(self): self.write('''\
-LOAD <filename>
-The S19 file specified is loaded into memory. If a MAP file is present in \
-the same directory, it is loaded too.
+LOAD <filename> [<address>]
+The S19 file specified (.S19, .S28, .S37, .SREC or .MOT; .S19 is added if \
+there is no extension) is loaded into memory. If a MAP file is present in \
+the same directory, it is loaded too. Files with a .HEX (or .IHX) extension \
+are read as Intel HEX files, and files with a .BIN extension as binary \
+images, loaded at the address given or, by default, so that they end at \
+$FFFF.
+''')
+
+  def do_save(self, line):
+    "SAVE <filename>"
+    if len(line) == 0:
+      self.write('Expecting save-state file name\n')
+      return
+
+    try: savestate.saveState(self.simstate, line)
+    except Exception as detail:
+      if detail: self.write(str(detail)+'\n')
+      return
+    self.write(f'State saved to "{line}"\n')
+
+  def help_save(self): self.write('''\
+SAVE <filename>
+The complete state of the simulator (registers, memory, cycle counter and \
+peripherals) is saved to the given file, to be brought back later with the \
+RESTORE command. Breakpoints are not saved.
+''')
+
+  def do_restore(self, line):
+    "RESTORE <filename>"
+    if len(line) == 0:
+      self.write('Expecting save-state file name\n')
+      return
+
+    try: savestate.loadState(self.simstate, line)
+    except Exception as detail:
+      if detail: self.write(str(detail)+'\n')
+      return
+    self.write(f'State restored from "{line}"\n')
+    self.simstate.ucState.display(self.write)
+    self.write('\n')
+    self.simstate.printNextInstruction()
+
+  def help_restore(self): self.write('''\
+RESTORE <filename>
+The state of the simulator is set to the one saved in the given file by the \
+SAVE command. The file must have been saved with the same peripherals \
+installed. Breakpoints and the MAP file are unaffected.
 ''')
 
   def do_loadmap(self, line):
@@ -642,11 +773,248 @@ TY [n]
 Trace through program execution for 'n' instructions, or just 1 instruction \
 if no parameter is specified. If the next instruction is a branch, it is \
 TAKEN regardless of the condition codes state.
+''')
+
+  def do_hist(self, line):
+    "HIST ['on' | 'off']"
+    if line == 'on': self.simstate.enableHistory(1)
+    elif line == 'off': self.simstate.enableHistory(0)
+    elif len(line):
+      self.write('Illegal argument. Type "help hist" for usage information\n')
+      return
+
+    H = self.simstate.history
+    if H is None:
+      self.write('Execution history is off\n')
+      return
+    self.write('Execution history is on, checkpoints every %d cycles, up to %d kept\n' % (H.interval, H.checkpoints.maxlen))
+    if H.checkpoints:
+      self.write('%d checkpoints, going back to cycle %d\n' % (len(H.checkpoints), H.oldest()))
+
+  def help_hist(self): self.write('''\
+HIST ['on' | 'off']
+This command turns the recording of execution history on or off, or \
+displays how far back it goes. While it is on, the TB, GOB and GOC commands \
+can go back to earlier states of the simulation. Resetting the cycle counter \
+(e.g., with GO) clears the history.
+''')
+
+  def historyCheck(self):
+    if self.simstate.history is None:
+      self.write('Execution history is off. Type "help hist" for more information\n')
+      return 0
+    return 1
+
+  def do_tb(self, line):
+    "TB [n]"
+    if len(line):
+      try: count = getu32(line, self.simstate)
+      except Exception as detail:
+        self.write(str(detail)+'\n')
+        return
+    else: count = 1
+    if not self.historyCheck(): return
+
+    back = self.simstate.history.stepBack(count)
+    if back < count: self.write('Went back only %d instructions\n' % back)
+    self.simstate.ucState.display(self.write)
+    self.write('\n')
+    self.simstate.printNextInstruction()
+
+  def help_tb(self): self.write('''\
+TB [n]
+Trace backwards: undo the execution of the last 'n' instructions (a 32-bit \
+number), or just 1 instruction if no parameter is specified. Execution \
+history must be on (see HIST).
+''')
+
+  def do_gob(self, line):
+    "GOB"
+    if len(line) > 0:
+      self.write('This command takes no parameters\n')
+      return
+    if not self.historyCheck(): return
+
+    # Conditions are evaluated and counts counted down at every candidate,
+    # from the most recent one back
+    sim = self.simstate
+    counts = {br: br.basecount for br in sim.BPlist}
+    def accept():
+      stop = 0
+      for br in sim.BPlist.byAddr.get(sim.ucState.PC, ()):
+        if br.action and not br.action(br, sim): continue
+        counts[br] -= 1
+        if counts[br] <= 0: stop = 1
+      return stop
+
+    addrs = {br.addr for br in sim.BPlist}
+    if sim.history.runBack(addrs, accept): self.write('Breakpoint reached\n')
+    else: self.write('No breakpoint found, back at the oldest checkpoint\n')
+    self.simstate.ucState.display(self.write)
+    self.write('\n')
+    self.simstate.printNextInstruction()
+
+  def help_gob(self): self.write('''\
+GOB
+Run backwards: go back to the last time execution reached a breakpoint, or \
+as far back as the execution history goes if no breakpoint was reached. \
+The condition of a conditional breakpoint is evaluated at every place it was \
+reached, and a breakpoint with a count stops at the <count>th place, counting \
+back from the most recent one. Execution history must be on (see HIST).
+''')
+
+  def do_goc(self, line):
+    "GOC <cycles>"
+    try: cycs = getu32(line, self.simstate)
+    except Exception as detail:
+      self.write(str(detail)+'\n')
+      return
+
+    if cycs > self.simstate.cycles: self.simstate.step(0, 0, cycs)
+    elif self.historyCheck():
+      try: self.simstate.history.goToCycle(cycs)
+      except history.HistoryError as detail:
+        self.write(str(detail)+'\n')
+        return
+    else: return
+    self.simstate.ucState.display(self.write)
+    self.write('\n')
+    self.simstate.printNextInstruction()
+
+  def help_goc(self): self.write('''\
+GOC <cycles>
+Go to the given cycle count: execution continues up to it (like STOPWHEN) if \
+it is ahead, or goes back to it if execution history is on (see HIST) and \
+goes back far enough.
+''')
+
+  def do_prof(self, line):
+    "PROF ['on' | 'off' | 'clear' | 'lines' | 'flame' <filename>]"
+    words = line.split(None, 1)
+    arg = words[0].lower() if words else ''
+    if arg == 'on': self.simstate.enableProfiler(1)
+    elif arg == 'off': self.simstate.enableProfiler(0)
+    elif arg not in ('', 'clear', 'lines', 'flame'):
+      self.write('Illegal argument. Type "help prof" for usage information\n')
+      return
+
+    P = self.simstate.profiler
+    if P is None:
+      self.write('Profiling is off\n')
+      return
+    if arg == 'on': self.write('Profiling is on\n')
+    elif arg == 'clear':
+      P.clear()
+      self.write('Profile cleared\n')
+    elif arg == 'flame':
+      if len(words) < 2:
+        self.write('Expecting flame graph file name\n')
+        return
+      try:
+        with open(words[1], 'wt') as fid: P.writeFolded(fid, self.simstate.mapfile)
+      except Exception as detail:
+        if detail: self.write(str(detail)+'\n')
+        return
+      self.write(f'Profile written to "{words[1]}"\n')
+    else: P.report(self.write, self.simstate.mapfile, arg == 'lines')
+
+  def help_prof(self): self.write('''\
+PROF ['on' | 'off' | 'clear' | 'lines' | 'flame' <filename>]
+This command turns profiling on or off, clears the profile or reports it. \
+While it is on, the instructions executed and the cycles they take are \
+counted for every address. With no parameter, the routines that took the \
+most cycles are listed (the addresses, if no MAP file is loaded), and with \
+'lines' the source lines. With 'flame', the profile is written to the given \
+file in the folded stacks format read by flame graph tools.
+''')
+
+  def do_calls(self, line):
+    "CALLS ['on' | 'off' | 'clear']"
+    arg = line.strip().lower()
+    if arg == 'on': self.simstate.enableCallGraph(1)
+    elif arg == 'off': self.simstate.enableCallGraph(0)
+    elif arg not in ('', 'clear'):
+      self.write('Illegal argument. Type "help calls" for usage information\n')
+      return
+
+    C = self.simstate.callgraph
+    if C is None:
+      self.write('Call graph is off\n')
+      return
+    if arg == 'on': self.write('Call graph is on\n')
+    elif arg == 'clear':
+      C.clear()
+      self.write('Call graph cleared\n')
+    else: C.report(self.write, self.simstate.mapfile)
+
+  def help_calls(self): self.write('''\
+CALLS ['on' | 'off' | 'clear']
+This command turns subroutine cycle accounting on or off, clears it or \
+reports it. While it is on, calls (JSR, BSR and interrupts) and returns \
+(RTS, RTI) are followed, and the inclusive and exclusive cycles, worst-case \
+execution time and stack use of every routine are listed, along with the \
+latency of every interrupt taken, the deepest call nesting and the lowest \
+SP reached.
+''')
+
+  def do_cov(self, line):
+    "COV ['on' | 'off' | 'clear' | 'save' | 'load' | 'lcov' | 'xml' <filename>]"
+    words = line.split(None, 1)
+    arg = words[0].lower() if words else ''
+    if arg == 'on': self.simstate.enableCoverage(1)
+    elif arg == 'off': self.simstate.enableCoverage(0)
+    elif arg not in ('', 'clear', 'save', 'load', 'lcov', 'xml'):
+      self.write('Illegal argument. Type "help cov" for usage information\n')
+      return
+
+    C = self.simstate.coverage
+    if C is None:
+      self.write('Coverage is off\n')
+      return
+    mapfile = self.simstate.mapfile
+    code = self.simstate.ucMemory.Array
+    if arg == 'on': self.write('Coverage is on\n')
+    elif arg == 'clear':
+      C.clear()
+      self.write('Coverage cleared\n')
+    elif arg in ('save', 'load', 'lcov', 'xml'):
+      if len(words) < 2:
+        self.write('Expecting file name\n')
+        return
+      if arg in ('lcov', 'xml') and not mapfile:
+        self.write('No MAP file loaded\n')
+        return
+      try:
+        if arg == 'save': C.save(words[1])
+        elif arg == 'load': C.load(words[1])
+        else:
+          with open(words[1], 'wt') as fid:
+            if arg == 'lcov': C.writeLcov(fid, mapfile, code)
+            else: C.writeCobertura(fid, mapfile, code)
+      except Exception as detail:
+        if detail: self.write(str(detail)+'\n')
+        return
+      if arg == 'load': self.write(f'Coverage merged from "{words[1]}"\n')
+      else: self.write(f'Coverage written to "{words[1]}"\n')
+    else: C.report(self.write, mapfile, code)
+
+  def help_cov(self): self.write('''\
+COV ['on' | 'off' | 'clear' | 'save' | 'load' | 'lcov' | 'xml' <filename>]
+This command turns code coverage on or off, clears it or reports it. While \
+it is on, the address of every instruction executed is recorded, and for \
+every conditional branch whether it was taken and whether it was not. With \
+no parameter, the number of addresses executed is displayed, and if a MAP \
+file is loaded, the line and branch coverage of every source file. 'save' \
+writes the coverage to a file and 'load' merges the coverage of a file into \
+it, so that the coverage of several runs can be combined. 'lcov' and 'xml' \
+write the coverage per source line in the lcov and Cobertura XML formats.
 ''')
 
   def do_verf(self, line):
-    "VERF <filename>"
-    try: addr, diag = VerifyS19(line, self.simstate.ucMemory)
+    "VERF <filename> [<address>]"
+    try:
+      line, base = self.parseImage(line)
+      addr, diag = VerifyImage(line, self.simstate.ucMemory, base)
     except Exception as detail:
       if detail: self.write(str(detail)+'\n')
       return
@@ -654,9 +1022,10 @@ TAKEN regardless of the condition codes state.
     self.write(f'Verify of "{line}" successful\n')
 
   def help_verf(self): self.write('''\
-VERF <filename>
+VERF <filename> [<address>]
 This command loads the S19 file specified and compares its contents with the \
-current contents of memory. The first discrepancy (if any) is reported.
+current contents of memory. The first discrepancy (if any) is reported. \
+Intel HEX and binary files are read as with the LOAD command.
 ''')
 
   def do_pshb(self, line):
@@ -764,15 +1133,16 @@ This command pushes the 16-bit 'word' parameter onto the stack.
 
 
   def help_overview(self): self.write('''\
-LOAD     -- Load S19 file             | BF    -- Block fill memory
-LOADMAP  -- Load MAP file             | BULK  -- Erase EEPROM
-VERF     -- Verify memory/S19 file    | CYC   -- Print/clear cycle counter
-CD       -- Change directory          | HELP  -- Get help on any command
-ASM      -- Disassemble instructions  | MOVE  -- Move memory blocks
-BR       -- Set/clear breakpoints     | PRINT -- Evaluate expressions
-CALL     -- Call subroutine           | PSHB  -- Push a byte on the stack
-GO       -- Run from address          | PSHW  -- Push a word on the stack
-L        -- List source lines         | QUIT  -- Exit the program
+LOAD     -- Load S19 file             | BF      -- Block fill memory
+LOADMAP  -- Load MAP file             | BULK    -- Erase EEPROM
+VERF     -- Verify memory/S19 file    | CYC     -- Print/clear cycle counter
+CD       -- Change directory          | HELP    -- Get help on any command
+SAVE     -- Save simulator state      | RESTORE -- Restore simulator state
+ASM      -- Disassemble instructions  | MOVE    -- Move memory blocks
+BR       -- Set/clear breakpoints     | PRINT   -- Evaluate expressions
+CALL     -- Call subroutine           | PSHB    -- Push a byte on the stack
+GO       -- Run from address          | PSHW    -- Push a word on the stack
+L        -- List source lines         | QUIT    -- Exit the program
 MD       -- Display memory contents   |
 MM       -- Modify memory contents    | Expressions:
 P        -- Run at current address    |  [$]HHHH : Hex numbers
@@ -785,10 +1155,14 @@ TN       -- Skip next branch          |
 TY       -- Take next branch          | Default base is hexadecimal. The
                                       | leading $ sign is optional.
 R        -- Register overview         |
-D        -- Set register D value      | A     -- Set register A value
-X        -- Set register X value      | B     -- Set register B value
-Y        -- Set register Y value      | CCR   -- Set register CCR value
+D        -- Set register D value      | A       -- Set register A value
+X        -- Set register X value      | B       -- Set register B value
+Y        -- Set register Y value      | CCR     -- Set register CCR value
 SP       -- Set register SP value
+TB       -- Trace backwards           | HIST    -- Execution history on/off
+GOB      -- Run back to breakpoint    | GOC     -- Go to cycle count
+PROF     -- Profile execution         | CALLS   -- Subroutine cycle accounting
+WP       -- Set/clear watchpoints     | COV     -- Code coverage
 ''')
 
 def main():
@@ -830,7 +1204,7 @@ def main():
           simstate = PySim11.SimState(frame, frame.term.write, simbreak)
 
           if S19FileName:
-            try: addr, diag = ReadS19(S19FileName, simstate.ucMemory)
+            try: addr, diag = ReadImage(S19FileName, simstate.ucMemory)
             except Exception as detail:
               if detail: print(detail)
               return false